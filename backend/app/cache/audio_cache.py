@@ -1,70 +1,223 @@
-import datetime
+import asyncio
+import os
+import sys
+import threading
 import time
-import yt_dlp
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
 
+from cache.data_dir import get_data_path
+from cache.extraction_pool import extraction_pool
+from cache.extractor import extract_audio_info
+from cache.persistent_cache import PersistentAudioCache
 from models.results_models import AudioInfo
-from services.format_service import format_duration
+from services.metrics_service import extraction_duration, register_stats
+from services.scheduler import scheduler, work_priority, Ticket
 
-#variable for in-memory cache
-cached_info: dict[str, dict] = {}
+#limits for the in-memory cache, 0 disables the byte limit
+AUDIO_CACHE_MAX_ENTRIES = int(os.getenv("AUDIO_CACHE_MAX_ENTRIES", 1000))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", 16*1024*1024))
+
+#on-disk copy of the cache, set AUDIO_CACHE_PERSIST=0 to keep everything in memory
+AUDIO_CACHE_PERSIST = os.getenv("AUDIO_CACHE_PERSIST", "1") != "0"
+AUDIO_CACHE_DB = os.getenv("AUDIO_CACHE_DB")
+AUDIO_CACHE_COMPACT_INTERVAL = int(os.getenv("AUDIO_CACHE_COMPACT_INTERVAL", 15*60))
 
-#cache for 6hrs max as yt-dlp link expires in 6 hrs
-CACHE_DURATION = 6*3600
 
 def is_valid(entry: dict) -> bool:
     return time.time() < entry.get("expires_at", 0)
 
-def get_cached_audio_info(video_id: str) -> AudioInfo:
-    entry = cached_info.get(video_id)
-    return entry if entry and is_valid(entry) else None
+
+#rough memory footprint of a cached entry
+def entry_size(video_id: str, entry: dict) -> int:
+    size = sys.getsizeof(video_id) + sys.getsizeof(entry)
+    for key, value in entry.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
+
+
+#in-memory audio info cache with lru eviction, bounded by entry count and bytes
+class AudioCache:
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.sizes: dict[str, int] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        #entries are written from executor threads and read on the event loop
+        self.lock = threading.Lock()
+
+    def get(self, video_id: str) -> Optional[dict]:
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if not is_valid(entry):
+                self.remove(video_id)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(video_id)
+            self.hits += 1
+            return entry
+
+    def set(self, video_id: str, entry: dict):
+        with self.lock:
+            if video_id in self.entries:
+                self.remove(video_id)
+            size = entry_size(video_id, entry)
+            self.entries[video_id] = entry
+            self.sizes[video_id] = size
+            self.total_bytes += size
+            self.evict()
+
+    def invalidate(self, video_id: str):
+        with self.lock:
+            if video_id in self.entries:
+                self.remove(video_id)
+
+    #caller must hold the lock
+    def remove(self, video_id: str):
+        del self.entries[video_id]
+        self.total_bytes -= self.sizes.pop(video_id)
+
+    #drop expired entries first, then least recently used ones until under the limits
+    #caller must hold the lock
+    def evict(self):
+        if not self.over_limit():
+            return
+        for video_id in [vid for vid, entry in self.entries.items() if not is_valid(entry)]:
+            self.remove(video_id)
+            self.expirations += 1
+        while self.entries and self.over_limit():
+            video_id, _ = self.entries.popitem(last=False)
+            self.total_bytes -= self.sizes.pop(video_id)
+            self.evictions += 1
+
+    def over_limit(self) -> bool:
+        if self.max_entries and len(self.entries) > self.max_entries:
+            return True
+        return bool(self.max_bytes) and self.total_bytes > self.max_bytes
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+#variable for in-memory cache
+cached_info = AudioCache(max_entries=AUDIO_CACHE_MAX_ENTRIES, max_bytes=AUDIO_CACHE_MAX_BYTES)
+
+#database is only opened on first lookup so importing this module stays cheap
+persistent_info = PersistentAudioCache(
+    AUDIO_CACHE_DB or get_data_path("audio_cache.db"),
+    compact_interval=AUDIO_CACHE_COMPACT_INTERVAL,
+) if AUDIO_CACHE_PERSIST else None
+
+#extractions currently running, keyed by video id so concurrent callers share one yt-dlp run
+in_flight: dict[str, asyncio.Future] = {}
+#scheduler ticket of each of those, so a playback request can raise a queued prefetch's priority
+in_flight_tickets: dict[str, Ticket] = {}
+
+register_stats("audio_info", cached_info.stats)
+
+
+#memory first, then the on-disk store which also refills memory after a restart
+#sqlite is only touched on a memory miss and then in a worker thread, never on the loop
+async def get_cached_audio_info(video_id: str) -> Optional[AudioInfo]:
+    if entry := cached_info.get(video_id):
+        return entry
+    if persistent_info and (entry := await asyncio.to_thread(persistent_info.get, video_id)):
+        cached_info.set(video_id, entry)
+        return entry
+    return None
+
+
+def store_audio_info(video_id: str, audio_info: dict):
+    cached_info.set(video_id, audio_info)
+    if persistent_info:
+        persistent_info.set(video_id, audio_info)
+
+
+#drop an entry whose stream url stopped working so the next lookup extracts a fresh one
+async def invalidate_audio_info(video_id: str):
+    cached_info.invalidate(video_id)
+    if persistent_info:
+        await asyncio.to_thread(persistent_info.delete, video_id)
+
+
+def get_audio_cache_stats() -> dict:
+    return cached_info.stats()
+
+
+#time spent extracting, not waiting for a slot
+@contextmanager
+def measure_extraction():
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        extraction_duration.observe(time.perf_counter() - started_at, "error")
+        raise
+    extraction_duration.observe(time.perf_counter() - started_at, "ok")
 
 
 def extract_audio_url_and_info(video_id) -> dict:
-    global cached_info #global variable
-
-    ydl_opts = {
-        'quiet': True,
-        'format': 'bestaudio/best',
-        'noplaylist': True,
-        'socket_timeout': 5,
-        'retries': 0,
-        'skip_download': True,
-    }
-
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        try:
-            info = ydl.extract_info(f"https://youtu.be/{video_id}", download=False)
-        except Exception as e:
-            print(f"Error extracting info: {e}")
-            raise Exception("Stream Info error")
-
-        # Filter out unwanted m3u8/hls formats
-        audio_formats = [
-            f for f in info.get("formats", [])
-            if f.get("ext") in ["m4a", "webm", "mp4"]
-            and not f.get("protocol", "").startswith("m3u8")
-            and not f.get("url", "").endswith(".m3u8")
-        ]
-
-        if not audio_formats:
-            raise Exception("No suitable audio formats found")
-
-        # pick best available audio format
-        best_audio = max(audio_formats, key=lambda f: f.get("abr", 0) or 0)
-
-        duration_seconds = info.get('duration', 0)
-        formatted_duration = format_duration(datetime.timedelta(seconds=duration_seconds))
-
-        audio_info = {
-            "url": best_audio['url'],
-            "title": info.get('title', ''),
-            "thumbnail": info.get('thumbnail', ''),
-            "channel": info.get('channel', 'Unknown Channel'),
-            "expires_at": time.time() + CACHE_DURATION,
-            "duration": formatted_duration,
-            "format": best_audio.get("ext", "unknown"),
-            "quality": f"{best_audio.get('abr', 'Unknown')}kbps",
-        }
-
-        cached_info[video_id] = audio_info
-        return audio_info
+    with measure_extraction():
+        audio_info = extract_audio_info(video_id)
+    store_audio_info(video_id, audio_info)
+    return audio_info
+
+
+#extract in the worker pool (or on the scheduler's threads when the pool is off) once the
+#scheduler hands this ticket a slot, and cache the result
+async def run_extraction(video_id: str, ticket: Ticket) -> dict:
+    if not extraction_pool:
+        return await scheduler.run(extract_audio_url_and_info, video_id, ticket=ticket)
+    async with scheduler.slot(ticket=ticket):
+        with measure_extraction():
+            audio_info = await extraction_pool.extract(video_id)
+    await asyncio.to_thread(store_audio_info, video_id, audio_info)
+    return audio_info
+
+
+#run the extraction once per video id, callers arriving while it runs await the same result
+#errors are shared the same way since every caller awaits the same future
+async def extract_audio_info_once(video_id: str) -> dict:
+    future = in_flight.get(video_id)
+    if future is None:
+        ticket = scheduler.ticket()
+        future = asyncio.ensure_future(run_extraction(video_id, ticket))
+        in_flight[video_id] = future
+        in_flight_tickets[video_id] = ticket
+
+        def remove_in_flight(done: asyncio.Future):
+            if in_flight.get(video_id) is done:
+                del in_flight[video_id]
+                del in_flight_tickets[video_id]
+            #mark the exception as retrieved in case every caller went away
+            if not done.cancelled():
+                done.exception()
+
+        future.add_done_callback(remove_in_flight)
+    else:
+        scheduler.promote(in_flight_tickets[video_id], work_priority.get())
+
+    #shield so one disconnected client doesn't cancel the extraction for the others
+    return await asyncio.shield(future)
@@ -0,0 +1,16 @@
+import os
+
+#folder for files that should outlive the process (caches, indexes, job state)
+#bundled builds can't write next to sys._MEIPASS so default to the user's home
+def get_data_dir() -> str:
+    path = os.getenv("SANBEATS_DATA_DIR")
+    if not path:
+        path = os.path.join(os.path.expanduser("~"), ".sanbeats")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_data_path(*parts: str) -> str:
+    path = os.path.join(get_data_dir(), *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
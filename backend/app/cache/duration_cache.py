@@ -0,0 +1,126 @@
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Iterable, Optional
+
+from services.scheduler import prioritize, work_priority, PRIORITIES
+
+#videos.list accepts at most 50 ids per call
+MAX_BATCH_SIZE = 50
+
+#video durations never change so they are kept until the lru limit pushes them out
+DURATION_CACHE_MAX_ENTRIES = int(os.getenv("DURATION_CACHE_MAX_ENTRIES", 100000))
+#seconds to wait for other callers' misses before sending a partial batch
+DURATION_BATCH_WINDOW = float(os.getenv("DURATION_BATCH_WINDOW", 0.01))
+
+
+#per video id cache of iso 8601 durations, misses from concurrent callers are merged
+#into shared videos.list calls of up to 50 ids
+class DurationBatcher:
+    def __init__(
+        self,
+        fetch_batch: Callable[[list[str]], Awaitable[dict[str, str]]],
+        max_entries: int = 100000,
+        window: float = 0.01,
+    ):
+        self.fetch_batch = fetch_batch
+        self.max_entries = max_entries
+        self.window = window
+        self.durations: OrderedDict[str, str] = OrderedDict()
+        #ids waiting for a lookup, queued or already sent
+        self.pending: dict[str, asyncio.Future] = {}
+        self.queue: list[str] = []
+        #highest work priority among the callers waiting on each queued id
+        self.levels: dict[str, str] = {}
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+
+    def remember(self, video_id: str, duration: str):
+        self.durations[video_id] = duration
+        self.durations.move_to_end(video_id)
+        while len(self.durations) > self.max_entries:
+            self.durations.popitem(last=False)
+
+    #returns video id -> iso duration, ids youtube doesn't know are left out
+    async def get_durations(self, video_ids: Iterable[str]) -> dict[str, str]:
+        loop = asyncio.get_running_loop()
+        level = work_priority.get()
+        result: dict[str, str] = {}
+        waiting: dict[str, asyncio.Future] = {}
+
+        for video_id in dict.fromkeys(video_ids):
+            if video_id in self.durations:
+                self.durations.move_to_end(video_id)
+                result[video_id] = self.durations[video_id]
+                self.hits += 1
+                continue
+            self.misses += 1
+            future = self.pending.get(video_id)
+            if future is None:
+                future = loop.create_future()
+                self.pending[video_id] = future
+                self.queue.append(video_id)
+                self.levels[video_id] = level
+            elif video_id in self.levels:
+                self.levels[video_id] = min(self.levels[video_id], level, key=PRIORITIES.index)
+            waiting[video_id] = future
+
+        if self.queue:
+            self.schedule_flush(loop)
+
+        for video_id, future in waiting.items():
+            duration = await asyncio.shield(future)
+            if duration is not None:
+                result[video_id] = duration
+        return result
+
+    def schedule_flush(self, loop: asyncio.AbstractEventLoop):
+        while len(self.queue) >= MAX_BATCH_SIZE:
+            self.send_batch(loop)
+        if self.queue and self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window, self.flush, loop)
+
+    def flush(self, loop: asyncio.AbstractEventLoop):
+        self.flush_handle = None
+        while self.queue:
+            self.send_batch(loop)
+
+    def send_batch(self, loop: asyncio.AbstractEventLoop):
+        batch = self.queue[:MAX_BATCH_SIZE]
+        del self.queue[:MAX_BATCH_SIZE]
+        self.batches += 1
+        #the task copies the context it is created in, so the shared call runs at the
+        #highest priority of its waiters instead of whichever caller's timer fired
+        levels = [self.levels.pop(video_id) for video_id in batch if video_id in self.levels]
+        with prioritize(min(levels, key=PRIORITIES.index, default=work_priority.get())):
+            loop.create_task(self.run_batch(batch))
+
+    async def run_batch(self, batch: list[str]):
+        try:
+            durations = await self.fetch_batch(batch)
+        except Exception as e:
+            for video_id in batch:
+                future = self.pending.pop(video_id, None)
+                if future and not future.done():
+                    future.set_exception(e)
+                    #mark retrieved so an abandoned waiter doesn't log a warning
+                    future.exception()
+            return
+
+        for video_id in batch:
+            duration = durations.get(video_id)
+            if duration is not None:
+                self.remember(video_id, duration)
+            future = self.pending.pop(video_id, None)
+            if future and not future.done():
+                future.set_result(duration)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.durations),
+            "hits": self.hits,
+            "misses": self.misses,
+            "batches": self.batches,
+        }
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from cache.extractor import init_worker, extract_in_worker, warm_up_worker
+from services.metrics_service import register_stats
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#yt-dlp extraction runs in worker processes so its cpu and regex work stays off the api's GIL,
+#set EXTRACTION_POOL_ENABLED=0 to extract in threads instead
+EXTRACTION_POOL_ENABLED = os.getenv("EXTRACTION_POOL_ENABLED", "1") != "0"
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", os.cpu_count() or 2))
+#jobs a worker runs before it is replaced (python 3.11+), keeps slow leaks in yt-dlp from piling up
+EXTRACTION_MAX_JOBS_PER_WORKER = int(os.getenv("EXTRACTION_MAX_JOBS_PER_WORKER", 100))
+#seconds one extraction may take before its worker is killed
+EXTRACTION_TIMEOUT = float(os.getenv("EXTRACTION_TIMEOUT", 30))
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+#pool of pre-warmed processes each holding an initialized YoutubeDL
+class ExtractionPool:
+    def __init__(self, workers: int, max_jobs_per_worker: int, timeout: float):
+        self.workers = workers
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.timeout = timeout
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.timeouts = 0
+        self.restarts = 0
+
+    def create_pool(self) -> ProcessPoolExecutor:
+        #spawn so workers don't inherit the event loop and open sockets, and so
+        #max_tasks_per_child is allowed
+        options = {}
+        #older pythons have no max_tasks_per_child, workers there are never replaced
+        if sys.version_info >= (3, 11):
+            options["max_tasks_per_child"] = self.max_jobs_per_worker
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            **options,
+        )
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.pool is None:
+                self.pool = self.create_pool()
+            return self.pool
+
+    #start every worker now instead of on the first play
+    async def start(self):
+        pool = self.get_pool()
+        loop = asyncio.get_running_loop()
+        warm_ups = [loop.run_in_executor(pool, warm_up_worker) for _ in range(self.workers)]
+        pids = await asyncio.gather(*warm_ups, return_exceptions=True)
+        logger.info(f"Extraction pool ready with {len({pid for pid in pids if isinstance(pid, int)})} workers")
+
+    #kill the workers of a pool that has a stuck job and start a fresh one
+    def restart(self, broken: ProcessPoolExecutor):
+        with self.lock:
+            if self.pool is not broken:
+                return
+            self.restarts += 1
+            for process in list((broken._processes or {}).values()):
+                process.terminate()
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.pool = self.create_pool()
+
+    async def extract(self, video_id: str) -> dict:
+        for attempt in range(2):
+            pool = self.get_pool()
+            try:
+                future = asyncio.wrap_future(pool.submit(extract_in_worker, video_id))
+                self.jobs += 1
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                logger.error(f"Extraction of {video_id} timed out after {self.timeout}s, restarting workers")
+                self.restart(pool)
+                raise ExtractionTimeout(f"Extraction timed out for {video_id}")
+            except BrokenProcessPool:
+                #a worker died or another job's timeout recycled the pool, try once on the new one
+                self.restart(pool)
+                if attempt:
+                    raise
+        raise BrokenProcessPool("Extraction pool unavailable")
+
+    #workers still starting up don't see the shutdown request, stop them directly
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                processes = list((self.pool._processes or {}).values())
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                for process in processes:
+                    process.terminate()
+                self.pool = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "jobs": self.jobs,
+            "timeouts": self.timeouts,
+            "restarts": self.restarts,
+        }
+
+
+extraction_pool = ExtractionPool(
+    EXTRACTION_WORKERS,
+    EXTRACTION_MAX_JOBS_PER_WORKER,
+    EXTRACTION_TIMEOUT,
+) if EXTRACTION_POOL_ENABLED else None
+if extraction_pool:
+    register_stats("extraction_pool", extraction_pool.stats)
@@ -0,0 +1,144 @@
+import datetime
+import importlib
+import os
+import time
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+
+from services.format_service import format_duration
+
+#cache for 6hrs max as yt-dlp link expires in 6 hrs
+#only used when the stream url has no expire= parameter
+CACHE_DURATION = 6*3600
+
+#seconds taken off the url expiry so we never hand out a link that dies mid request
+EXPIRY_SAFETY_MARGIN = int(os.getenv("AUDIO_CACHE_EXPIRY_MARGIN", 10*60))
+
+YDL_OPTS = {
+    'quiet': True,
+    'format': 'bestaudio/best',
+    'noplaylist': True,
+    'socket_timeout': 5,
+    'retries': 0,
+    'skip_download': True,
+}
+
+#"module:function" called instead of YoutubeDL.extract_info(url, download=False),
+#lets the offline benchmarks run without yt-dlp touching the network
+SANBEATS_EXTRACTOR = os.getenv("SANBEATS_EXTRACTOR")
+
+
+#stands in for a YoutubeDL when SANBEATS_EXTRACTOR is set
+class PluggedExtractor:
+    def __init__(self, spec: str):
+        module_name, _, function_name = spec.partition(":")
+        self.extract = getattr(importlib.import_module(module_name), function_name or "extract_info")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def extract_info(self, url: str, download: bool = False) -> dict:
+        return self.extract(url)
+
+    def get_info_extractor(self, name: str):
+        return None
+
+
+#yt-dlp loads hundreds of extractor modules, so it is only imported once something extracts
+def create_ydl():
+    if SANBEATS_EXTRACTOR:
+        return PluggedExtractor(SANBEATS_EXTRACTOR)
+    import yt_dlp
+    return yt_dlp.YoutubeDL(YDL_OPTS)
+
+
+#read the expiry timestamp googlevideo signs into the stream url
+def get_url_expiry(url: str) -> Optional[float]:
+    try:
+        expire = parse_qs(urlparse(url).query).get("expire")
+        return float(expire[0]) if expire else None
+    except (ValueError, TypeError):
+        return None
+
+
+#work out when a cached entry should stop being served
+def get_expires_at(url: str) -> float:
+    now = time.time()
+    url_expiry = get_url_expiry(url)
+    if url_expiry is None:
+        return now + CACHE_DURATION
+    return max(now, url_expiry - EXPIRY_SAFETY_MARGIN)
+
+
+#turn yt-dlp's full info dict into the small audio info dict we cache and return
+def build_audio_info(info: dict) -> dict:
+    # Filter out unwanted m3u8/hls formats
+    audio_formats = [
+        f for f in info.get("formats", [])
+        if f.get("ext") in ["m4a", "webm", "mp4"]
+        and not f.get("protocol", "").startswith("m3u8")
+        and not f.get("url", "").endswith(".m3u8")
+    ]
+
+    if not audio_formats:
+        raise Exception("No suitable audio formats found")
+
+    # pick best available audio format
+    best_audio = max(audio_formats, key=lambda f: f.get("abr", 0) or 0)
+
+    duration_seconds = info.get('duration', 0)
+    formatted_duration = format_duration(datetime.timedelta(seconds=duration_seconds))
+
+    return {
+        "url": best_audio['url'],
+        "title": info.get('title', ''),
+        "thumbnail": info.get('thumbnail', ''),
+        "channel": info.get('channel', 'Unknown Channel'),
+        "expires_at": get_expires_at(best_audio['url']),
+        "duration": formatted_duration,
+        "format": best_audio.get("ext", "unknown"),
+        "quality": f"{best_audio.get('abr', 'Unknown')}kbps",
+    }
+
+
+def extract_with(ydl, video_id: str) -> dict:
+    try:
+        info = ydl.extract_info(f"https://youtu.be/{video_id}", download=False)
+    except Exception as e:
+        print(f"Error extracting info: {e}")
+        raise Exception("Stream Info error")
+    return build_audio_info(info)
+
+
+#one-off extraction with a fresh YoutubeDL, used when the worker pool is disabled
+def extract_audio_info(video_id: str) -> dict:
+    with create_ydl() as ydl:
+        return extract_with(ydl, video_id)
+
+
+#long-lived YoutubeDL of a pool worker process
+worker_ydl = None
+
+
+#runs once in each worker process so extractors are loaded before the first job arrives
+def init_worker():
+    global worker_ydl
+    worker_ydl = create_ydl()
+    worker_ydl.get_info_extractor("Youtube")
+
+
+def extract_in_worker(video_id: str) -> dict:
+    return extract_with(worker_ydl, video_id)
+
+
+def warm_up_worker() -> int:
+    return os.getpid()
+
+
+#imports yt-dlp and loads its youtube extractor ahead of the first play, run in a thread after startup
+def warm_up_extractor():
+    with create_ydl() as ydl:
+        ydl.get_info_extractor("Youtube")
@@ -0,0 +1,91 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+#sqlite backed audio info store so extracted stream urls survive restarts
+#wal mode lets several uvicorn workers read while one of them writes
+class PersistentAudioCache:
+    def __init__(self, path: str, compact_interval: int = 15*60):
+        self.path = path
+        self.compact_interval = compact_interval
+        #sqlite connections can't be shared between threads, so each thread opens its own
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.compactor: Optional[threading.Thread] = None
+
+    #open the database the first time a thread needs it
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS audio_info ("
+                "video_id TEXT PRIMARY KEY, info TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS audio_info_expires ON audio_info(expires_at)")
+            self.local.conn = conn
+            self.start_compactor()
+        return conn
+
+    def get(self, video_id: str) -> Optional[dict]:
+        try:
+            row = self.connect().execute(
+                "SELECT info FROM audio_info WHERE video_id = ? AND expires_at > ?",
+                (video_id, time.time()),
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Persistent cache read error: {str(e)}")
+            return None
+        return json.loads(row[0]) if row else None
+
+    def set(self, video_id: str, entry: dict):
+        try:
+            self.connect().execute(
+                "INSERT OR REPLACE INTO audio_info (video_id, info, expires_at) VALUES (?, ?, ?)",
+                (video_id, json.dumps(entry), entry.get("expires_at", 0)),
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Persistent cache write error: {str(e)}")
+
+    def delete(self, video_id: str):
+        try:
+            self.connect().execute("DELETE FROM audio_info WHERE video_id = ?", (video_id,))
+        except sqlite3.Error as e:
+            logger.error(f"Persistent cache delete error: {str(e)}")
+
+    #remove expired rows and fold the wal back into the main file
+    def compact(self) -> int:
+        conn = self.connect()
+        removed = conn.execute("DELETE FROM audio_info WHERE expires_at <= ?", (time.time(),)).rowcount
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
+
+    def start_compactor(self):
+        with self.lock:
+            if self.compactor is not None:
+                return
+            self.compactor = threading.Thread(
+                target=self.compact_forever, name="audio-cache-compactor", daemon=True
+            )
+            self.compactor.start()
+
+    def compact_forever(self):
+        while True:
+            try:
+                removed = self.compact()
+                if removed:
+                    logger.info(f"Compacted persistent audio cache, removed {removed} expired rows")
+            except sqlite3.Error as e:
+                #another worker holding the write lock is fine, try again next round
+                logger.error(f"Persistent cache compaction error: {str(e)}")
+            time.sleep(self.compact_interval)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from services.metrics_service import register_stats
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#seconds each YouTube Data API response stays fresh, per endpoint
+RESPONSE_CACHE_TTLS = {
+    "search": int(os.getenv("RESPONSE_CACHE_TTL_SEARCH", 30*60)),
+    "trending": int(os.getenv("RESPONSE_CACHE_TTL_TRENDING", 10*60)),
+    "most_viewed": int(os.getenv("RESPONSE_CACHE_TTL_MOST_VIEWED", 30*60)),
+    "channel_videos": int(os.getenv("RESPONSE_CACHE_TTL_CHANNEL", 6*3600)),
+    "same_tags_videos": int(os.getenv("RESPONSE_CACHE_TTL_TAGS", 3600)),
+    "video_snippet": int(os.getenv("RESPONSE_CACHE_TTL_SNIPPET", 24*3600)),
+}
+DEFAULT_RESPONSE_CACHE_TTL = 10*60
+
+#how long past its ttl an entry may still be served when the api call fails
+RESPONSE_CACHE_STALE_TTL = int(os.getenv("RESPONSE_CACHE_STALE_TTL", 24*3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 2000))
+
+#params that don't change the response and must not end up in the key
+IGNORED_PARAMS = {"key"}
+
+
+#free text params whose case and spacing don't change the response, everything else
+#(video and channel ids, page tokens) is case sensitive and kept as is
+NORMALIZED_PARAMS = {"q"}
+
+
+#same query typed with different case or spacing should share one entry
+def normalize_value(name: str, value: Any) -> str:
+    if name in NORMALIZED_PARAMS:
+        return " ".join(str(value).split()).lower()
+    return str(value)
+
+
+def make_cache_key(endpoint: str, params: dict) -> tuple:
+    return (endpoint,) + tuple(sorted(
+        (name, normalize_value(name, value))
+        for name, value in params.items()
+        if name not in IGNORED_PARAMS and value is not None
+    ))
+
+
+#keyed ttl cache for api list responses with stale-while-error fallback
+class ResponseCache:
+    def __init__(self, max_entries: int = 2000, stale_ttl: int = 24*3600):
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        #key -> (fresh until, stale until, value)
+        self.entries: OrderedDict[tuple, tuple[float, float, Any]] = OrderedDict()
+        self.in_flight: dict[tuple, asyncio.Future] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_served = 0
+
+    def get(self, key: tuple, allow_stale: bool = False) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            fresh_until, stale_until, value = entry
+            now = time.time()
+            if now < fresh_until or (allow_stale and now < stale_until):
+                self.entries.move_to_end(key)
+                return value
+            if now >= stale_until:
+                del self.entries[key]
+            return None
+
+    def set(self, key: tuple, value: Any, ttl: int):
+        now = time.time()
+        with self.lock:
+            self.entries[key] = (now + ttl, now + ttl + self.stale_ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    #return a fresh cached response or call fetch, identical concurrent calls share one fetch
+    #if fetch fails and an expired entry is still within the stale window, serve that instead
+    async def get_or_fetch(self, endpoint: str, params: dict, fetch: Callable[[], Awaitable[Any]], ttl: Optional[int] = None) -> Any:
+        key = make_cache_key(endpoint, params)
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fetch())
+            self.in_flight[key] = future
+
+            def remove_in_flight(done: asyncio.Future):
+                self.in_flight.pop(key, None)
+                if not done.cancelled():
+                    done.exception()
+
+            future.add_done_callback(remove_in_flight)
+        try:
+            value = await asyncio.shield(future)
+        except Exception as e:
+            stale = self.get(key, allow_stale=True)
+            if stale is None:
+                raise
+            self.stale_served += 1
+            logger.warning(f"Serving stale {endpoint} response after error: {str(e)}")
+            return stale
+
+        if value is not None:
+            self.set(key, value, RESPONSE_CACHE_TTLS.get(endpoint, DEFAULT_RESPONSE_CACHE_TTL) if ttl is None else ttl)
+        return value
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale_served": self.stale_served,
+            }
+
+
+response_cache = ResponseCache(max_entries=RESPONSE_CACHE_MAX_ENTRIES, stale_ttl=RESPONSE_CACHE_STALE_TTL)
+register_stats("api_responses", response_cache.stats)
@@ -0,0 +1,258 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import AsyncIterator, Optional
+
+from cache.data_dir import get_data_path
+from services.metrics_service import register_stats
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#local copy of streamed audio, set SEGMENT_CACHE_ENABLED=0 to always go upstream
+SEGMENT_CACHE_ENABLED = os.getenv("SEGMENT_CACHE_ENABLED", "1") != "0"
+#total bytes of audio kept on disk before least recently played tracks are removed
+SEGMENT_CACHE_MAX_BYTES = int(os.getenv("SEGMENT_CACHE_MAX_BYTES", 2*1024*1024*1024))
+SEGMENT_CACHE_DIR = os.getenv("SEGMENT_CACHE_DIR")
+
+#new bytes are buffered and written (and the index row updated) once this many arrived,
+#not on every network read
+INDEX_UPDATE_BYTES = 1024*1024
+
+
+#blobs are named after a hash of video id + format so a different format never mixes bytes
+def make_segment_key(video_id: str, format: str) -> str:
+    return hashlib.sha256(f"{video_id}:{format}".encode()).hexdigest()
+
+
+#appends bytes that arrive contiguously after what is already on disk
+#disk and index work runs in a worker thread, never on the event loop
+class SegmentWriter:
+    def __init__(self, cache: "SegmentCache", entry: dict):
+        self.cache = cache
+        self.key = entry["key"]
+        self.total = entry["total"]
+        self.cached = entry["cached"]
+        self.buffer = bytearray()
+        self.file = open(cache.blob_path(self.key), "ab")
+
+    #returns False once the writer can't continue (gap in the data or closed)
+    async def write(self, position: int, data: bytes) -> bool:
+        if self.file is None or position != self.cached:
+            return False
+        self.buffer += data
+        self.cached += len(data)
+        if len(self.buffer) >= INDEX_UPDATE_BYTES or self.cached >= self.total:
+            await asyncio.to_thread(self.flush)
+        return True
+
+    def flush(self):
+        if self.file is None or not self.buffer:
+            return
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.buffer = bytearray()
+        self.cache.update_cached(self.key, self.cached, self.total)
+
+    def finish(self):
+        if self.file is None:
+            return
+        try:
+            self.flush()
+            self.file.close()
+        except OSError as e:
+            logger.error(f"Segment cache write error: {str(e)}")
+        self.file = None
+        self.cache.release(self.key)
+        self.cache.evict()
+
+    #shielded so the key is released even when the stream it belongs to gets cancelled
+    async def close(self):
+        if self.file is not None:
+            await asyncio.shield(asyncio.to_thread(self.finish))
+
+
+#content addressed on-disk audio cache, blobs live in a folder and their metadata in a
+#separate sqlite index holding how many leading bytes of each track are stored
+class SegmentCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        #keys being written by this process, never evicted or opened twice
+        self.writing: set[str] = set()
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.directory, "index.db"), timeout=5, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS segments ("
+                "key TEXT PRIMARY KEY, video_id TEXT NOT NULL, format TEXT NOT NULL, "
+                "total INTEGER NOT NULL, cached INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS segments_video ON segments(video_id)")
+            self.local.conn = conn
+        return conn
+
+    def blob_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.bin")
+
+    #best stored copy of a track, complete ones first then the longest prefix
+    async def lookup(self, video_id: str) -> Optional[dict]:
+        return await asyncio.to_thread(self.find, video_id)
+
+    def find(self, video_id: str) -> Optional[dict]:
+        try:
+            row = self.connect().execute(
+                "SELECT * FROM segments WHERE video_id = ? AND cached > 0 "
+                "ORDER BY cached = total DESC, cached DESC LIMIT 1",
+                (video_id,),
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Segment cache read error: {str(e)}")
+            return None
+        if row is None or not os.path.exists(self.blob_path(row["key"])):
+            self.misses += 1
+            return None
+        entry = dict(row)
+        if entry["cached"] >= entry["total"]:
+            self.hits += 1
+        else:
+            self.partial_hits += 1
+        self.touch(entry["key"])
+        return entry
+
+    def touch(self, key: str):
+        try:
+            self.connect().execute("UPDATE segments SET last_access = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            logger.error(f"Segment cache touch error: {str(e)}")
+
+    #start (or continue) caching a track, None if another stream is already writing it
+    async def open_writer(self, video_id: str, format: str, total: int) -> Optional[SegmentWriter]:
+        return await asyncio.to_thread(self.create_writer, video_id, format, total)
+
+    def create_writer(self, video_id: str, format: str, total: int) -> Optional[SegmentWriter]:
+        key = make_segment_key(video_id, format)
+        with self.lock:
+            if key in self.writing:
+                return None
+            self.writing.add(key)
+        try:
+            conn = self.connect()
+            row = conn.execute("SELECT * FROM segments WHERE key = ?", (key,)).fetchone()
+            path = self.blob_path(key)
+            if row is None or row["total"] != total or not os.path.exists(path) or os.path.getsize(path) != row["cached"]:
+                #unknown, changed or inconsistent blob, start it over
+                open(path, "wb").close()
+                conn.execute(
+                    "INSERT OR REPLACE INTO segments (key, video_id, format, total, cached, last_access) "
+                    "VALUES (?, ?, ?, ?, 0, ?)",
+                    (key, video_id, format, total, time.time()),
+                )
+                entry = {"key": key, "total": total, "cached": 0}
+            else:
+                entry = dict(row)
+            if entry["cached"] >= total:
+                self.release(key)
+                return None
+            return SegmentWriter(self, entry)
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Segment cache write error: {str(e)}")
+            self.release(key)
+            return None
+
+    def release(self, key: str):
+        with self.lock:
+            self.writing.discard(key)
+
+    def update_cached(self, key: str, cached: int, total: int):
+        try:
+            self.connect().execute(
+                "UPDATE segments SET cached = ?, total = ?, last_access = ? WHERE key = ?",
+                (cached, total, time.time(), key),
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Segment cache index error: {str(e)}")
+
+    async def read(self, entry: dict, start: int, end: int, block_size: int = 256*1024) -> AsyncIterator[bytes]:
+        file = await asyncio.to_thread(open, self.blob_path(entry["key"]), "rb")
+        try:
+            await asyncio.to_thread(file.seek, start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = await asyncio.to_thread(file.read, min(block_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        finally:
+            file.close()
+
+    #forget a stored track, e.g. a prefix of a format upstream no longer serves
+    async def remove(self, key: str):
+        await asyncio.to_thread(self.delete, key)
+
+    def delete(self, key: str):
+        try:
+            self.connect().execute("DELETE FROM segments WHERE key = ?", (key,))
+            os.remove(self.blob_path(key))
+        except FileNotFoundError:
+            pass
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Segment cache delete error: {str(e)}")
+
+    #drop least recently played tracks until the stored bytes fit under the cap
+    def evict(self):
+        try:
+            conn = self.connect()
+            used = conn.execute("SELECT COALESCE(SUM(cached), 0) FROM segments").fetchone()[0]
+            if used <= self.max_bytes:
+                return
+            for row in conn.execute("SELECT key, cached FROM segments ORDER BY last_access").fetchall():
+                if used <= self.max_bytes:
+                    break
+                if row["key"] in self.writing:
+                    continue
+                self.delete(row["key"])
+                used -= row["cached"]
+                self.evictions += 1
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Segment cache eviction error: {str(e)}")
+
+    def stats(self) -> dict:
+        try:
+            entries, used = self.connect().execute("SELECT COUNT(*), COALESCE(SUM(cached), 0) FROM segments").fetchone()
+        except sqlite3.Error:
+            entries, used = 0, 0
+        return {
+            "entries": entries,
+            "bytes": used,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "partial_hits": self.partial_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+segment_cache = SegmentCache(
+    SEGMENT_CACHE_DIR or os.path.dirname(get_data_path("audio_segments", "index.db")),
+    SEGMENT_CACHE_MAX_BYTES,
+) if SEGMENT_CACHE_ENABLED else None
+if segment_cache:
+    register_stats("audio_segments", segment_cache.stats)
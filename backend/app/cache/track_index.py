@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional
+
+from cache.data_dir import get_data_path
+from models import SearchResult, PlayListItem
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#index every track the backend sees so search and typeahead can be answered without the api
+TRACK_INDEX_ENABLED = os.getenv("TRACK_INDEX_ENABLED", "1") != "0"
+#rows kept, the ones seen longest ago are dropped first
+TRACK_INDEX_MAX_ENTRIES = int(os.getenv("TRACK_INDEX_MAX_ENTRIES", 200_000))
+#matches ranked per query, a short prefix can match most of the index so only the tracks
+#indexed most recently are scored to keep typeahead in the low milliseconds
+TRACK_INDEX_MAX_CANDIDATES = int(os.getenv("TRACK_INDEX_MAX_CANDIDATES", 2000))
+#seconds between pruning rounds
+TRACK_INDEX_PRUNE_INTERVAL = int(os.getenv("TRACK_INDEX_PRUNE_INTERVAL", 30*60))
+
+#words of a query, the last one is matched as a prefix while the user is still typing it
+QUERY_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+#turn user input into an fts5 match expression, every word has to match
+def build_match(query: str, prefix: bool = True) -> Optional[str]:
+    words = QUERY_WORD.findall(query.lower())
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if prefix:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(QUERY_WORD.findall(query.lower()))
+
+
+#sqlite fts5 index of tracks (title and channel) plus the ids each api search returned
+#same connection handling as the persistent audio cache, one connection per thread in wal mode
+#nothing touches sqlite on the event loop: writes are queued on one writer thread (in order,
+#callers don't wait for them) and reads run in worker threads
+class TrackIndex:
+    def __init__(self, path: str, max_entries: int, max_candidates: int, prune_interval: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_candidates = max_candidates
+        self.prune_interval = prune_interval
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pruner: Optional[threading.Thread] = None
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="track-index-writer")
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            #duration is null for tracks we only know from a playlist, they're left out of search
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tracks ("
+                "id INTEGER PRIMARY KEY, video_id TEXT NOT NULL UNIQUE, title TEXT NOT NULL, "
+                "channel TEXT NOT NULL, duration TEXT, thumbnail TEXT NOT NULL, "
+                "seen INTEGER NOT NULL DEFAULT 1, seen_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS tracks_seen_at ON tracks(seen_at)")
+            #external content table kept in step with tracks by the triggers below
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5("
+                "title, channel, content='tracks', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN "
+                "INSERT INTO tracks_fts(rowid, title, channel) VALUES (new.id, new.title, new.channel); END"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN "
+                "INSERT INTO tracks_fts(tracks_fts, rowid, title, channel) VALUES ('delete', old.id, old.title, old.channel); END"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE OF title, channel ON tracks BEGIN "
+                "INSERT INTO tracks_fts(tracks_fts, rowid, title, channel) VALUES ('delete', old.id, old.title, old.channel); "
+                "INSERT INTO tracks_fts(rowid, title, channel) VALUES (new.id, new.title, new.channel); END"
+            )
+            #video ids (in api order) the last api search for a query returned
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS searches ("
+                "query TEXT PRIMARY KEY, video_ids TEXT NOT NULL, fetched_at REAL NOT NULL)"
+            )
+            self.local.conn = conn
+            self.start_pruner()
+        return conn
+
+    def add(self, rows: Iterable[tuple]):
+        rows = list(rows)
+        if not rows:
+            return
+        now = time.time()
+        conn = None
+        try:
+            conn = self.connect()
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO tracks (video_id, title, channel, duration, thumbnail, seen_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(video_id) DO UPDATE SET title = excluded.title, channel = excluded.channel, "
+                "duration = COALESCE(excluded.duration, tracks.duration), thumbnail = excluded.thumbnail, "
+                "seen = tracks.seen + 1, seen_at = excluded.seen_at",
+                [(*row, now) for row in rows],
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error(f"Track index write error: {str(e)}")
+            if conn is not None and conn.in_transaction:
+                conn.execute("ROLLBACK")
+
+    def add_results(self, results: List[SearchResult]):
+        rows = [(result.id, result.title, result.channel, result.duration, result.thumbnail) for result in results]
+        self.writer.submit(self.add, rows)
+
+    #playlist items have no duration, they can still be suggested
+    def add_playlist_items(self, items: List[PlayListItem]):
+        rows = []
+        for item in items:
+            thumbnail = item.thumbnails.medium or item.thumbnails.high or item.thumbnails.default
+            rows.append((item.id, item.title, item.channelTitle, None, thumbnail.url if thumbnail else ""))
+        self.writer.submit(self.add, rows)
+
+    #best matches first: bm25 over title and channel, nudged up for tracks the api keeps returning
+    async def match(self, query: str, limit: int, prefix: bool = True, with_duration: bool = False) -> List[SearchResult]:
+        return await asyncio.to_thread(self.read_matches, query, limit, prefix, with_duration)
+
+    def read_matches(self, query: str, limit: int, prefix: bool, with_duration: bool) -> List[SearchResult]:
+        expression = build_match(query, prefix)
+        if expression is None:
+            return []
+        try:
+            conn = self.connect()
+            #rowid of the oldest candidate, fts5 walks rowids in order so this is cheap
+            cutoff = conn.execute(
+                "SELECT rowid FROM tracks_fts WHERE tracks_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+                (expression, self.max_candidates),
+            ).fetchone()
+            rows = conn.execute(
+                "SELECT t.video_id, t.title, t.channel, t.duration, t.thumbnail FROM tracks_fts "
+                "JOIN tracks t ON t.id = tracks_fts.rowid "
+                "WHERE tracks_fts MATCH ? AND tracks_fts.rowid > ? "
+                f"{'AND t.duration IS NOT NULL ' if with_duration else ''}"
+                "ORDER BY bm25(tracks_fts, 10.0, 4.0) * (1.0 + 0.05 * MIN(t.seen, 20)) LIMIT ?",
+                (expression, cutoff[0] if cutoff else 0, limit),
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Track index read error: {str(e)}")
+            return []
+        return [self.to_result(row) for row in rows]
+
+    def to_result(self, row: tuple) -> SearchResult:
+        video_id, title, channel, duration, thumbnail = row
+        return SearchResult(id=video_id, title=title, channel=channel, duration=duration or "", thumbnail=thumbnail)
+
+    def remember_search(self, query: str, results: List[SearchResult]):
+        self.writer.submit(self.write_search, normalize_query(query), ",".join(result.id for result in results))
+
+    def write_search(self, query: str, video_ids: str):
+        try:
+            self.connect().execute(
+                "INSERT OR REPLACE INTO searches (query, video_ids, fetched_at) VALUES (?, ?, ?)",
+                (query, video_ids, time.time()),
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Track index write error: {str(e)}")
+
+    #what the api answered for this query last time, if that was within max_age seconds
+    async def recall_search(self, query: str, max_age: float) -> Optional[List[SearchResult]]:
+        return await asyncio.to_thread(self.read_search, query, max_age)
+
+    def read_search(self, query: str, max_age: float) -> Optional[List[SearchResult]]:
+        try:
+            conn = self.connect()
+            row = conn.execute(
+                "SELECT video_ids FROM searches WHERE query = ? AND fetched_at > ?",
+                (normalize_query(query), time.time() - max_age),
+            ).fetchone()
+            if row is None:
+                return None
+        except sqlite3.Error as e:
+            logger.error(f"Track index read error: {str(e)}")
+            return None
+        return self.read_tracks([video_id for video_id in row[0].split(",") if video_id])
+
+    #tracks for these ids in the order given, ids the index doesn't hold are left out
+    async def get_tracks(self, video_ids: List[str], with_duration: bool = False) -> List[SearchResult]:
+        return await asyncio.to_thread(self.read_tracks, video_ids, with_duration)
+
+    def read_tracks(self, video_ids: List[str], with_duration: bool = False) -> List[SearchResult]:
+        if not video_ids:
+            return []
+        try:
+            found = self.connect().execute(
+                "SELECT video_id, title, channel, duration, thumbnail FROM tracks "
+                f"WHERE video_id IN ({','.join('?' * len(video_ids))})"
+                f"{' AND duration IS NOT NULL' if with_duration else ''}",
+                video_ids,
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Track index read error: {str(e)}")
+            return []
+        by_id = {row[0]: self.to_result(row) for row in found}
+        return [by_id[video_id] for video_id in video_ids if video_id in by_id]
+
+    def count(self) -> int:
+        try:
+            return self.connect().execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+    #drop the tracks seen longest ago once the index is over max_entries
+    def prune(self) -> int:
+        conn = self.connect()
+        excess = self.count() - self.max_entries
+        removed = 0
+        if excess > 0:
+            removed = conn.execute(
+                "DELETE FROM tracks WHERE id IN (SELECT id FROM tracks ORDER BY seen_at LIMIT ?)", (excess,)
+            ).rowcount
+        conn.execute("DELETE FROM searches WHERE fetched_at < ?", (time.time() - 30*24*3600,))
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
+
+    def start_pruner(self):
+        with self.lock:
+            if self.pruner is not None:
+                return
+            self.pruner = threading.Thread(target=self.prune_forever, name="track-index-pruner", daemon=True)
+            self.pruner.start()
+
+    def prune_forever(self):
+        while True:
+            try:
+                removed = self.prune()
+                if removed:
+                    logger.info(f"Pruned track index, removed {removed} rows")
+            except sqlite3.Error as e:
+                logger.error(f"Track index prune error: {str(e)}")
+            time.sleep(self.prune_interval)
+
+    def stats(self) -> dict:
+        return {"tracks": self.count(), "local_hits": self.hits, "local_misses": self.misses}
+
+
+track_index = TrackIndex(
+    get_data_path("track_index.db"),
+    max_entries=TRACK_INDEX_MAX_ENTRIES,
+    max_candidates=TRACK_INDEX_MAX_CANDIDATES,
+    prune_interval=TRACK_INDEX_PRUNE_INTERVAL,
+) if TRACK_INDEX_ENABLED else None
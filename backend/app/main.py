@@ -1,10 +1,8 @@
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from routes import youtube, authenticated_youtube, download
-import uvicorn
-from services import auth_service
+import asyncio
+import multiprocessing
 import os
 import sys
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 #load environemnt variable depending on if it is running for ececutable or no
@@ -15,9 +13,68 @@ else:
     # Running as script
     dotenv_path = '.env'
 
+#before the app modules are imported, they read their settings at import time
 load_dotenv(dotenv_path)
 
-app = FastAPI(title="SanBeats API")
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from fastapi.middleware.cors import CORSMiddleware
+from middleware.etag_compression import ETagCompressionMiddleware
+from middleware.metrics import MetricsMiddleware
+from routes import youtube, authenticated_youtube, download, stream
+import uvicorn
+from services import auth_service
+from services.http_client import start_http_client, close_http_client
+from services.download_jobs import download_jobs
+from services.metrics_service import render_metrics
+from cache.extraction_pool import extraction_pool
+from cache.extractor import warm_up_extractor
+from services.scheduler import scheduler, BACKGROUND
+from services.token_service import token_service
+from services.recommendation_graph import recommendation_graph
+
+#yt-dlp is only imported when first used, STARTUP_WARM_UP=1 loads it (and starts the extraction
+#workers) in the background shortly after the server starts accepting connections
+STARTUP_WARM_UP = os.getenv("STARTUP_WARM_UP", "1") != "0"
+#seconds to wait first so the ui's first requests don't compete with the warm-up
+STARTUP_WARM_UP_DELAY = float(os.getenv("STARTUP_WARM_UP_DELAY", 2))
+
+
+async def warm_up():
+    await asyncio.sleep(STARTUP_WARM_UP_DELAY)
+    try:
+        if extraction_pool:
+            await extraction_pool.start()
+        else:
+            await scheduler.run(warm_up_extractor, priority=BACKGROUND)
+    except Exception as e:
+        print(f"Warm up failed: {e}")
+
+
+#open shared resources on startup and release them on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_http_client()
+    scheduler.start()
+    token_service.start()
+    if recommendation_graph:
+        recommendation_graph.start()
+    if STARTUP_WARM_UP:
+        warm_up_task = asyncio.get_running_loop().create_task(warm_up())
+    download_jobs.resume()
+    yield
+    if STARTUP_WARM_UP:
+        warm_up_task.cancel()
+    token_service.shutdown()
+    if recommendation_graph:
+        recommendation_graph.shutdown()
+    download_jobs.shutdown()
+    if extraction_pool:
+        extraction_pool.shutdown()
+    scheduler.shutdown()
+    await close_http_client()
+
+app = FastAPI(title="SanBeats API", lifespan=lifespan)
 
 #setting up middleware
 app.add_middleware(
@@ -27,15 +84,31 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+#etag/304 and zstd or gzip compression for json responses
+app.add_middleware(
+    ETagCompressionMiddleware,
+    minimum_size=int(os.getenv("COMPRESSION_MINIMUM_SIZE", 1024)),
+)
+#outermost so the measured latency includes compression
+app.add_middleware(MetricsMiddleware)
 #root path just return api name
 @app.get("/", tags=["Root"])
 async def root():
     return {"message": "SanBeats API"}
 
 
+#prometheus scrape endpoint
+@app.get("/metrics", tags=["Root"], response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 app.include_router(youtube.router,prefix="/api", tags=["Youtube API"])
 app.include_router(authenticated_youtube.router,prefix="/api", tags=["Logged in Youtube API"])
 app.include_router(auth_service.router, tags=["Google Login"])
 app.include_router(download.router, prefix="/api", tags=["Video dowloader"])
+app.include_router(stream.router, prefix="/api", tags=["Audio stream"])
 if __name__ == "__main__":
+    #needed for the extraction worker processes in the bundled executable
+    multiprocessing.freeze_support()
     uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
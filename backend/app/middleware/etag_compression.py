@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import logging
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#only these are buffered, streamed bodies (audio, ndjson, sse) pass straight through
+BUFFERED_CONTENT_TYPES = ("application/json",)
+
+
+#pick the best encoding the client accepts, zstd over gzip, honouring q=0
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    wildcard = accepted.get("*", 0)
+    for encoding in ("zstd", "gzip"):
+        if encoding == "zstd" and zstandard is None:
+            continue
+        if accepted.get(encoding, wildcard) > 0:
+            return encoding
+    return None
+
+
+def make_etag(body: bytes, encoding: Optional[str] = None) -> str:
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    #strong etags are per representation, so the encoding is part of the tag
+    return f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+
+
+def etag_matches(if_none_match: str, body: bytes) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return any(make_etag(body, encoding) in tags for encoding in (None, "gzip", "zstd"))
+
+
+#adds strong etags to json GET responses, answers If-None-Match with 304 and
+#compresses bodies above minimum_size with zstd or gzip depending on Accept-Encoding
+class ETagCompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, zstd_level: int = 3, gzip_level: int = 6):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.zstd_level = zstd_level
+        self.gzip_level = gzip_level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        start_message: Optional[Message] = None
+        buffering = False
+        chunks: list[bytes] = []
+
+        async def wrapped_send(message: Message):
+            nonlocal start_message, buffering
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                buffering = (
+                    message["status"] == 200
+                    and headers.get("content-type", "").startswith(BUFFERED_CONTENT_TYPES)
+                    and "content-encoding" not in headers
+                )
+                if buffering:
+                    start_message = message
+                else:
+                    await send(message)
+                return
+
+            if message["type"] != "http.response.body" or not buffering:
+                await send(message)
+                return
+
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            await self.send_buffered(start_message, b"".join(chunks), request_headers, send)
+
+        await self.app(scope, receive, wrapped_send)
+
+    async def send_buffered(self, start_message: Message, body: bytes, request_headers: Headers, send: Send):
+        headers = MutableHeaders(raw=list(start_message["headers"]))
+        headers.add_vary_header("Accept-Encoding")
+
+        encoding = None
+        if len(body) >= self.minimum_size:
+            encoding = choose_encoding(request_headers.get("accept-encoding", ""))
+        headers["ETag"] = make_etag(body, encoding)
+
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, body):
+            del headers["content-length"]
+            del headers["content-type"]
+            await send({"type": "http.response.start", "status": 304, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        if encoding == "zstd":
+            payload = zstandard.ZstdCompressor(level=self.zstd_level).compress(body)
+        elif encoding == "gzip":
+            payload = gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+        else:
+            payload = body
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        headers["Content-Length"] = str(len(payload))
+
+        await send({"type": "http.response.start", "status": start_message["status"], "headers": headers.raw})
+        await send({"type": "http.response.body", "body": payload})
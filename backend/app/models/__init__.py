@@ -1,2 +1,3 @@
 from models.authenticated_youtube_models import *
-from models.results_models import *
\ No newline at end of file
+from models.results_models import *
+from models.download_models import *
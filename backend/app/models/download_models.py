@@ -0,0 +1,70 @@
+from pydantic import BaseModel, Field, model_validator
+from typing import Dict, List, Optional
+
+
+class DownloadJob(BaseModel):
+    id: str
+    video_url: str
+    path: str
+    video: bool
+    quality: Optional[int] = None
+    #queued, downloading, processing, completed, failed, cancelled
+    status: str = "queued"
+    #set for items of a bulk download
+    batch_id: Optional[str] = None
+    downloaded_bytes: int = 0
+    total_bytes: Optional[int] = None
+    percent: float = 0.0
+    speed: Optional[float] = None
+    eta: Optional[int] = None
+    filename: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float
+    updated_at: float
+
+
+class DownloadJobList(BaseModel):
+    jobs: List[DownloadJob]
+
+
+#a playlist or a list of video ids to download, exactly one of the two
+class BulkDownloadRequest(BaseModel):
+    path: str
+    video: bool
+    quality: Optional[int] = None
+    playlist_id: Optional[str] = None
+    video_ids: Optional[List[str]] = Field(None, min_length=1, max_length=1000)
+    #needed for private playlists
+    access_token: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_source(self):
+        if (self.playlist_id is None) == (self.video_ids is None):
+            raise ValueError("Give either playlist_id or video_ids")
+        return self
+
+
+#one bulk download, its items are ordinary jobs and the totals are summed over them
+class DownloadBatch(BaseModel):
+    id: str
+    path: str
+    video: bool
+    quality: Optional[int] = None
+    playlist_id: Optional[str] = None
+    job_ids: List[str]
+    #ids already in the download archive, no job is created for them
+    skipped: List[str] = []
+    #queued, downloading, completed, completed_with_errors, failed, cancelled
+    status: str = "queued"
+    total: int = 0
+    counts: Dict[str, int] = {}
+    downloaded_bytes: int = 0
+    total_bytes: int = 0
+    percent: float = 0.0
+    speed: Optional[float] = None
+    created_at: float
+    updated_at: float
+
+
+class DownloadBatchList(BaseModel):
+    batches: List[DownloadBatch]
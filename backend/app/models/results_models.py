@@ -1,4 +1,5 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import List, Optional
 
 
 class SearchResult(BaseModel):
@@ -17,3 +18,14 @@ class AudioInfo(BaseModel):
     thumbnail: str
     channel: str
     expires_at: float
+
+
+class BatchInfoRequest(BaseModel):
+    video_ids: List[str] = Field(..., min_length=1, max_length=200)
+
+
+#one line of the /info/batch ndjson stream, either info or error is set
+class BatchInfoResult(BaseModel):
+    id: str
+    info: Optional[AudioInfo] = None
+    error: Optional[str] = None
@@ -1,27 +1,33 @@
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
 import logging
-import requests
 from typing import Optional
 from models import YoutubePlaylistResponse
 from fastapi import APIRouter, HTTPException, logger
 from services import get_liked_music, get_user_playlist
+from services.http_client import get_http_client, YOUTUBE_API_URL
+from services.quota_service import acquire_quota, check_quota_response
+from services.token_service import get_valid_token
+from services.library_sync_service import (
+    LIBRARY_SYNC_ENABLED,
+    get_synced_liked_music,
+    get_synced_user_playlist,
+    sync_user_library,
+)
 router = APIRouter()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-executor = ThreadPoolExecutor(max_workers=4)
-
 
 #get liked videos if user is authenticated
 @router.get("/list_user_liked_videos", response_model=YoutubePlaylistResponse)
 async def list_liked_music_videos(access_token: str, page_token: Optional[str]= None):
     #for response from youtube
     try:
-        result = await asyncio.get_event_loop().run_in_executor(
-            executor, get_liked_music, access_token, page_token
-        )
+        access_token = await get_valid_token(access_token)
+        if LIBRARY_SYNC_ENABLED:
+            result = await get_synced_liked_music(access_token, page_token)
+        else:
+            result = await get_liked_music(access_token, page_token)
         return result
         
     except Exception as e:
@@ -32,19 +38,34 @@ async def list_liked_music_videos(access_token: str, page_token: Optional[str]=
 @router.get("/list_user_playlist", response_model=YoutubePlaylistResponse)
 async def list_user_playlist(access_token: str, page_token: Optional[str] = None):
     try:
-        result = await asyncio.get_event_loop().run_in_executor(
-            executor, get_user_playlist, access_token, page_token
-        )
+        access_token = await get_valid_token(access_token)
+        if LIBRARY_SYNC_ENABLED:
+            result = await get_synced_user_playlist(access_token, page_token)
+        else:
+            result = await get_user_playlist(access_token, page_token)
         return result
     
     except Exception as e:
         logger.error(f"Get playlist error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Get playlist error {str(e)}")
+
+
+#refresh the local copy of the user's liked music and playlists now
+@router.post("/library/sync")
+async def sync_library(access_token: str):
+    try:
+        access_token = await get_valid_token(access_token)
+        return await sync_user_library(access_token)
+
+    except Exception as e:
+        logger.error(f"Library sync error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Library sync error {str(e)}")
     
 @router.post("/add_to_playlist")
-def add_music_to_playlist(videoId: str, playlistId: str, access_token: str):
+async def add_music_to_playlist(videoId: str, playlistId: str, access_token: str):
     try:
-        url = "https://www.googleapis.com/youtube/v3/playlistItems"
+        access_token = await get_valid_token(access_token)
+        url = f"{YOUTUBE_API_URL}/playlistItems"
         params = {
             "part": "snippet",
         }
@@ -62,7 +83,9 @@ def add_music_to_playlist(videoId: str, playlistId: str, access_token: str):
             }
         }
         
-        response = requests.post(url=url, params=params, json=data, headers=headers)
+        await acquire_quota("playlistItems.insert")
+        response = await get_http_client().post(url=url, params=params, json=data, headers=headers)
+        check_quota_response(response)
         response.raise_for_status()
         
         return {
@@ -1,22 +1,135 @@
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
 from typing import Optional
 from fastapi import APIRouter, HTTPException
-from services.download_service import download_youtube_video
+from fastapi.responses import StreamingResponse
+from models import DownloadJob, DownloadJobList, BulkDownloadRequest, DownloadBatch, DownloadBatchList
+from services.download_jobs import download_jobs, FINISHED_STATUSES, FINISHED_BATCH_STATUSES
+from services.token_service import get_valid_token
+from services.youtube_service import get_playlist_video_ids
 router = APIRouter()
-executor = ThreadPoolExecutor(max_workers=4)
 
+#logger for logging errors
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#seconds between progress checks on the event stream
+EVENT_POLL_INTERVAL = 0.5
+
+#queues the download and returns the job right away, progress is on the job endpoints
 @router.post("/download")
 async def download_video(video_url: str, path:str, video:bool, quality:Optional[int]= None):
     try:
-        download = await asyncio.get_event_loop().run_in_executor(
-            executor, download_youtube_video, path, video_url, video, quality
-        )
-        if not download:
-            raise HTTPException("Something went wrong", 400)
-        
-        return {"message": "Download Successful"}
+        job = download_jobs.submit(video_url, path, video, quality)
+        return {"message": "Download queued", "job_id": job.id, "job": job}
 
     except Exception as e:
         print(f"Download {str(e)}")
-        raise HTTPException(status_code=404, detail="Something went wrong while downlaoding")
\ No newline at end of file
+        raise HTTPException(status_code=404, detail="Something went wrong while downlaoding")
+
+
+#queues a whole playlist or a list of video ids, items already downloaded to the same folder
+#in the same format are skipped, progress is summed over the items on the batch endpoints
+@router.post("/download/batch", response_model=DownloadBatch)
+async def download_batch(request: BulkDownloadRequest):
+    try:
+        video_ids = request.video_ids
+        if video_ids is None:
+            access_token = await get_valid_token(request.access_token) if request.access_token else None
+            video_ids = await get_playlist_video_ids(request.playlist_id, access_token)
+        if not video_ids:
+            raise HTTPException(status_code=404, detail="Playlist is empty or not found")
+        return download_jobs.submit_batch(video_ids, request.path, request.video, request.quality, request.playlist_id)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Bulk download error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Bulk download failed {str(e)}")
+
+
+@router.get("/download/batches", response_model=DownloadBatchList)
+async def list_download_batches():
+    return DownloadBatchList(batches=download_jobs.list_batches())
+
+
+@router.get("/download/batch/{batch_id}", response_model=DownloadBatch)
+async def download_batch_status(batch_id: str):
+    batch = download_jobs.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Bulk download not found")
+    return batch
+
+
+#server-sent events with the batch totals every time one of its items changes
+@router.get("/download/batch/{batch_id}/events")
+async def download_batch_events(batch_id: str):
+    if download_jobs.get_batch(batch_id) is None:
+        raise HTTPException(status_code=404, detail="Bulk download not found")
+
+    async def events():
+        last_update = None
+        while True:
+            batch = download_jobs.get_batch(batch_id)
+            if batch is None:
+                return
+            if batch.updated_at != last_update:
+                last_update = batch.updated_at
+                yield f"event: progress\ndata: {json.dumps(batch.model_dump())}\n\n"
+            if batch.status in FINISHED_BATCH_STATUSES:
+                return
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-store"})
+
+
+@router.delete("/download/batch/{batch_id}", response_model=DownloadBatch)
+async def cancel_download_batch(batch_id: str):
+    batch = download_jobs.cancel_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Bulk download not found")
+    return batch
+
+
+@router.get("/download/jobs", response_model=DownloadJobList)
+async def list_download_jobs():
+    return DownloadJobList(jobs=download_jobs.list())
+
+
+@router.get("/download/{job_id}", response_model=DownloadJob)
+async def download_status(job_id: str):
+    job = download_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Download job not found")
+    return job
+
+
+#server-sent events with the job state every time it changes, ends when the job finishes
+@router.get("/download/{job_id}/events")
+async def download_events(job_id: str):
+    if download_jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Download job not found")
+
+    async def events():
+        last_update = None
+        while True:
+            job = download_jobs.get(job_id)
+            if job is None:
+                return
+            if job.updated_at != last_update:
+                last_update = job.updated_at
+                yield f"event: progress\ndata: {json.dumps(job.model_dump())}\n\n"
+            if job.status in FINISHED_STATUSES:
+                return
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-store"})
+
+
+@router.delete("/download/{job_id}", response_model=DownloadJob)
+async def cancel_download(job_id: str):
+    job = download_jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Download job not found")
+    return job
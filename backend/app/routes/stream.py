@@ -0,0 +1,45 @@
+import logging
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from services.stream_service import (
+    open_audio_stream,
+    find_cached_segment,
+    get_cached_audio_file,
+    RangeNotSatisfiable,
+)
+from services.scheduler import SchedulerBusy
+
+router = APIRouter()
+
+#logger for logging errors
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+#GET METHOD FOR STREAMING AUDIO BYTES THROUGH THE BACKEND, SUPPORTS RANGE REQUESTS FOR SEEKING
+@router.get("/stream/{video_id}")
+async def stream_audio(video_id: str, range: Optional[str] = Header(None)):
+    #tracks played to the end before are answered from disk, FileResponse handles the range
+    segment = await find_cached_segment(video_id)
+    if cached_file := get_cached_audio_file(segment):
+        path, media_type = cached_file
+        return FileResponse(path, media_type=media_type, headers={"Cache-Control": "no-store"})
+
+    try:
+        stream = await open_audio_stream(video_id, range, segment)
+    except RangeNotSatisfiable as e:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{e.total}"})
+    except SchedulerBusy as e:
+        logger.error(f"Stream error {str(e)}")
+        raise HTTPException(status_code=503, detail="Server busy, try again", headers={"Retry-After": "1"})
+    except Exception as e:
+        logger.error(f"Stream error {str(e)}")
+        raise HTTPException(status_code=404, detail="Stream not available")
+
+    return StreamingResponse(
+        stream.body(),
+        status_code=stream.status_code,
+        headers=stream.headers,
+        media_type=stream.media_type,
+    )
@@ -1,16 +1,26 @@
-from concurrent.futures import ThreadPoolExecutor
 import logging
 from fastapi import APIRouter, HTTPException, Query, logger
-from models import SearchResult, AudioInfo
-from typing import List
-import asyncio
+from fastapi.responses import StreamingResponse
+from models import SearchResult, AudioInfo, BatchInfoRequest
+from typing import List, Optional
 from services.youtube_service import(
     get_most_viewed_music,
     get_similar_videos,
     get_trending_music,
-    get_search_result,
-    get_audio_info
+    search_music,
+    get_suggestions,
+    get_audio_info,
+    get_audio_info_batch,
 )
+from cache.audio_cache import get_audio_cache_stats
+from cache.segment_cache import segment_cache
+from cache.extraction_pool import extraction_pool
+from services.prefetch_service import schedule_prefetch
+from services.quota_service import get_quota_usage
+from services.scheduler import scheduler, prioritize, SchedulerBusy, PLAYBACK
+from cache.response_cache import response_cache
+from services.youtube_service import duration_batcher
+from services.recommendation_graph import recommendation_graph
 
 router = APIRouter()
 
@@ -18,45 +28,69 @@ router = APIRouter()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-#threads to execute functions asynchronously
-executor = ThreadPoolExecutor(max_workers=4)
-
 #Get method on /search with required query parameter and optional max results 
 #for sending search videos to youtube API
 @router.get('/search', response_model=List[SearchResult])
 async def search_youtube(
-    q: str = Query(..., description="Youtube search query")):
+    q: str = Query(..., description="Youtube search query"),
+    fresh: bool = Query(False, description="Skip the local track index and ask youtube")):
     try:
-        search = await asyncio.get_event_loop().run_in_executor(
-            executor, get_search_result, q
-        )
+        search = await search_music(q, fresh)
+        schedule_prefetch(search)
         return search
          
     except Exception as e:
         logger.error(f"Search error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Search failed {str(e)}")
 
+
+#GET METHOD FOR TYPEAHEAD, ANSWERED FROM THE LOCAL TRACK INDEX WITHOUT CALLING YOUTUBE
+@router.get('/suggest', response_model=List[SearchResult])
+async def suggest(
+    q: str = Query(..., description="What the user typed so far"),
+    limit: int = Query(10, ge=1, le=50)):
+    try:
+        return await get_suggestions(q, limit)
+
+    except Exception as e:
+        logger.error(f"Suggest error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Suggest failed {str(e)}")
+
         
 #GET METHOD FOR GETTING YOUTUBE AUDIO URL
 @router.get("/info/{video_id}", response_model=AudioInfo)
-async def get_audio_url_and_info(video_id: str):
+async def get_audio_url_and_info(video_id: str, client_id: Optional[str] = None):
     try:
-        audio_info = await asyncio.get_event_loop().run_in_executor(
-            executor, get_audio_info, video_id
-        )
+        #the player is waiting on this url
+        with prioritize(PLAYBACK):
+            audio_info = await get_audio_info(video_id)
+        #plays close together from the same client link their tracks in the recommendation graph
+        if recommendation_graph:
+            recommendation_graph.record_play(video_id, audio_info.get("channel"), client_id)
         return audio_info
     
+    except SchedulerBusy as e:
+        logger.error(f"Stream Info error {str(e)}")
+        raise HTTPException(status_code=503, detail="Server busy, try again", headers={"Retry-After": "1"})
     except Exception as e:
         logger.error(f"Stream Info error {str(e)}")
         raise HTTPException(status_code=404, detail="Video not found")
     
+#POST METHOD FOR GETTING AUDIO INFO OF MANY TRACKS, STREAMS ONE JSON LINE PER TRACK AS IT RESOLVES
+@router.post("/info/batch")
+async def get_batch_audio_info(request: BatchInfoRequest):
+    async def lines():
+        async for result in get_audio_info_batch(request.video_ids):
+            yield result.model_dump_json() + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+    
 #GET METHOD FOR GETTING REALTED VIEDO TO THE MUSIC BEING PLAYED
 @router.get("/recommendation/{video_id}", response_model=List[SearchResult])
 async def music_recommendation(video_id: str):
     try:
-        recommendation = await asyncio.get_event_loop().run_in_executor(
-            executor, get_similar_videos, video_id
-        )
+        recommendation = await get_similar_videos(video_id)
+        schedule_prefetch(recommendation)
         return recommendation
     except Exception as e:
         logger.error(f"Recommendation error: {str(e)}")
@@ -65,9 +99,8 @@ async def music_recommendation(video_id: str):
 @router.get("/trending", response_model=List[SearchResult])
 async def trending_music():
     try:
-        trending = await asyncio.get_event_loop().run_in_executor(
-            executor, get_trending_music
-        )
+        trending = await get_trending_music()
+        schedule_prefetch(trending)
         return trending
     except Exception as e:
         logger.error(f"Recommendation error: {str(e)}")
@@ -77,10 +110,29 @@ async def trending_music():
 @router.get("/most_viewed_music", response_model=List[SearchResult])
 async def most_viewed_music():
     try:
-        popular_music = await asyncio.get_event_loop().run_in_executor(
-            executor, get_most_viewed_music
-        )
+        popular_music = await get_most_viewed_music()
         return popular_music
     except Exception as e:
         logger.error(f"popular error {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error getting trending: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error getting trending: {str(e)}")
+
+#hit, miss and eviction counters for the audio info cache
+@router.get("/cache/stats")
+async def audio_cache_stats():
+    stats = get_audio_cache_stats()
+    if segment_cache:
+        stats["segments"] = segment_cache.stats()
+    if extraction_pool:
+        stats["extraction_pool"] = extraction_pool.stats()
+    stats["scheduler"] = scheduler.stats()
+    return stats
+
+
+#YouTube Data API quota units spent today (resets at midnight pacific) and response cache counters
+@router.get("/quota")
+async def quota_usage():
+    return {
+        **get_quota_usage(),
+        "response_cache": response_cache.stats(),
+        "duration_cache": duration_batcher.stats(),
+    }
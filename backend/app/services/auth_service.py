@@ -1,18 +1,12 @@
 import os
-import requests
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 from urllib.parse import urlencode
+from services.token_service import token_service, TokenError, GOOGLE_CLIENT_ID, GOOGLE_REDIRECT_URI
 
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 router = APIRouter()
 
-#google api client id and secret from .env
-GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
-GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
-GOOGLE_REDIRECT_URI = os.getenv("REDIRECT_URI")
-
-
 #this get method returns a url when you goto url it redirects to google login page
 @router.get("/api/login/google")
 async def google_login():
@@ -43,39 +37,27 @@ async def google_login():
 #and this returns user info including id, email, name and picture
 @router.get("/auth/callback")
 async def auth_google(code: str):
-    token_url = "https://accounts.google.com/o/oauth2/token"
-    data = {
-        "code": code,
-        "client_id": GOOGLE_CLIENT_ID,
-        "client_secret": GOOGLE_CLIENT_SECRET,
-        "redirect_uri": GOOGLE_REDIRECT_URI,
-        "grant_type": "authorization_code",
-    }
-    response = requests.post(token_url, data=data)
-    data = response.json()
-    access_token = data["access_token"]
-    access_token_expires_in = data["expires_in"]
-    refresh_token = data["refresh_token"]
-    refresh_token_expires_in = data["refresh_token_expires_in"]
-    
-    user_info_resp = requests.get(
-        "https://www.googleapis.com/oauth2/v1/userinfo",
-        headers={"Authorization": f"Bearer {access_token}"})
-    user_info = user_info_resp.json()
-    
+    try:
+        session, data = await token_service.exchange_code(code)
+    except TokenError as e:
+        raise HTTPException(status_code=400, detail=f"Google login failed: {str(e)}")
+
     user_data = {
-        "name": user_info["name"],
-        "email": user_info["email"],
-        "picture": user_info["picture"],
+        "name": session.user.get("name"),
+        "email": session.user.get("email"),
+        "picture": session.user.get("picture"),
     }
 
     #return user info like id, name, email and also access and refresh tokens
+    #the server keeps its own copy and refreshes the access token, clients send session_token as
+    #their access_token so they never hold one that expired
     return {
         "user": user_data,
         "token": {
-            "access_token": access_token,
-            "access_token_expires_in": access_token_expires_in,
-            "refresh_token": refresh_token,
-            "refresh_token_expires_in": refresh_token_expires_in,
+            "session_token": session.handle,
+            "access_token": session.access_token,
+            "access_token_expires_in": data.get("expires_in"),
+            "refresh_token": data.get("refresh_token"),
+            "refresh_token_expires_in": data.get("refresh_token_expires_in"),
         }
     }
@@ -1,8 +1,11 @@
 import logging
 from typing import Optional
 from fastapi import HTTPException, logger
-import requests
+from services.http_client import get_http_client, YOUTUBE_API_URL
+from services.quota_service import acquire_quota, check_quota_response
 from models import YoutubePlaylistResponse, PlayListItem
+from cache.track_index import track_index
+from services.recommendation_graph import recommendation_graph
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -31,10 +34,10 @@ def parse_youtube_response(raw_response: dict) -> YoutubePlaylistResponse:
         raise HTTPException(status_code=500, detail=f"Parse youtube response error {str(e)}")
 
 
-def get_liked_music(access_token: str, page_token: Optional[str]= None) -> YoutubePlaylistResponse:
+async def get_liked_music(access_token: str, page_token: Optional[str]= None) -> YoutubePlaylistResponse:
 #for response from youtube
     try:
-        url = "https://www.googleapis.com/youtube/v3/videos"
+        url = f"{YOUTUBE_API_URL}/videos"
         params = {
             "part": "snippet",
             "myRating": "like",
@@ -45,7 +48,9 @@ def get_liked_music(access_token: str, page_token: Optional[str]= None) -> Youtu
         if page_token:
             params["pageToken"] = page_token
             
-        response = requests.get(url, params=params, headers=headers)
+        await acquire_quota("videos.list")
+        response = await get_http_client().get(url, params=params, headers=headers)
+        check_quota_response(response)
         response.raise_for_status()
         data = response.json()
         
@@ -61,23 +66,32 @@ def get_liked_music(access_token: str, page_token: Optional[str]= None) -> Youtu
         }
         
         parsed_response = parse_youtube_response(filtered_data)
+        if track_index:
+            track_index.add_playlist_items(parsed_response.items)
+        if recommendation_graph:
+            recommendation_graph.record_playlist((item.id, item.channelTitle) for item in parsed_response.items)
         return parsed_response
         
     except Exception as e:
         logger.error(f"liked music error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Liked music error {str(e)}")
 
-def get_user_playlist(access_token: str, page_token: Optional[str] = None) -> YoutubePlaylistResponse:
+async def get_user_playlist(access_token: str, page_token: Optional[str] = None) -> YoutubePlaylistResponse:
     try:
-        url = "https://www.googleapis.com/youtube/v3/playlists"
+        url = f"{YOUTUBE_API_URL}/playlists"
         params = {
             "part": "snippet,contentDetails",
             "mine": True,
             "maxResults": 10,
         }
         headers = {"Authorization": f"Bearer {access_token}"}
+
+        if page_token:
+            params["pageToken"] = page_token
         
-        response = requests.get(url, params=params, headers=headers)
+        await acquire_quota("playlists.list")
+        response = await get_http_client().get(url, params=params, headers=headers)
+        check_quota_response(response)
         response.raise_for_status()
         data = response.json()
 
@@ -0,0 +1,432 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Optional
+
+from cache.data_dir import get_data_path
+from models import DownloadJob, DownloadBatch
+from services.download_service import download_youtube_video, fetch_audio, transcode_audio, finalize_audio
+from services.metrics_service import register_stats
+from services.scheduler import scheduler, BULK
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#downloads fetching from youtube at once
+DOWNLOAD_FETCH_CONCURRENCY = int(os.getenv("DOWNLOAD_FETCH_CONCURRENCY", 3))
+#ffmpeg conversions at once, cpu bound so it defaults to the core count
+DOWNLOAD_TRANSCODE_CONCURRENCY = int(os.getenv("DOWNLOAD_TRANSCODE_CONCURRENCY", os.cpu_count() or 2))
+#items of one bulk download running at once, one fetch slot is left for single downloads
+DOWNLOAD_BATCH_CONCURRENCY = int(os.getenv("DOWNLOAD_BATCH_CONCURRENCY", max(1, DOWNLOAD_FETCH_CONCURRENCY - 1)))
+#finished jobs kept in the list (and the state file) before the oldest are dropped
+DOWNLOAD_JOB_HISTORY = int(os.getenv("DOWNLOAD_JOB_HISTORY", 200))
+#finished bulk downloads kept, their jobs are dropped with them
+DOWNLOAD_BATCH_HISTORY = int(os.getenv("DOWNLOAD_BATCH_HISTORY", 20))
+#progress is written to disk at most this often, status changes are written right away
+PERSIST_INTERVAL = 2.0
+
+ACTIVE_STATUSES = ("queued", "downloading", "processing")
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+#a batch is failed when nothing in it succeeded and completed_with_errors when only some items failed
+FINISHED_BATCH_STATUSES = ("completed", "completed_with_errors", "failed", "cancelled")
+
+
+#runs yt-dlp downloads in the background with progress, cancellation and separate limits
+#for fetching and transcoding, unfinished jobs are saved to disk and resumed on the next start
+class DownloadJobManager:
+    def __init__(self, state_path: str, batches_path: str, fetch_limit: int, transcode_limit: int, batch_limit: int):
+        self.state_path = state_path
+        self.batches_path = batches_path
+        self.jobs: dict[str, DownloadJob] = {}
+        self.batches: dict[str, DownloadBatch] = {}
+        self.batch_limit = batch_limit
+        self.cancelled: set[str] = set()
+        self.fetch_slots = asyncio.Semaphore(fetch_limit)
+        self.transcode_slots = asyncio.Semaphore(transcode_limit)
+        #jobs run on the app scheduler's threads as bulk work, waiting for a slot there
+        self.tasks: dict[str, asyncio.Task] = {}
+        #jobs with a stage on a thread right now
+        self.working: set[str] = set()
+        self.lock = threading.Lock()
+        #batch items of different jobs append to the same archive
+        self.archive_lock = threading.Lock()
+        self.last_persist = 0.0
+        self.shutting_down = False
+
+    def submit(self, video_url: str, path: str, video: bool, quality: Optional[int] = None) -> DownloadJob:
+        job = self.new_job(video_url, path, video, quality)
+        with self.lock:
+            self.jobs[job.id] = job
+        self.persist(force=True)
+        self.schedule(job)
+        return job
+
+    def new_job(self, video_url: str, path: str, video: bool, quality: Optional[int], batch_id: Optional[str] = None) -> DownloadJob:
+        now = time.time()
+        return DownloadJob(
+            id=uuid.uuid4().hex,
+            video_url=video_url,
+            path=path,
+            video=video,
+            quality=quality,
+            batch_id=batch_id,
+            created_at=now,
+            updated_at=now,
+        )
+
+    #queue many videos as one bulk download, ids already in the archive for this folder and
+    #format are skipped and at most batch_limit items of the batch run at once
+    def submit_batch(self, video_ids: list[str], path: str, video: bool, quality: Optional[int] = None,
+                     playlist_id: Optional[str] = None) -> DownloadBatch:
+        archived = self.archived_ids(self.archive_path(path, video, quality))
+        now = time.time()
+        batch = DownloadBatch(id=uuid.uuid4().hex, path=path, video=video, quality=quality,
+                              playlist_id=playlist_id, job_ids=[], created_at=now, updated_at=now)
+        jobs = []
+        for video_id in dict.fromkeys(video_ids):
+            if video_id in archived:
+                batch.skipped.append(video_id)
+            else:
+                jobs.append(self.new_job(f"https://www.youtube.com/watch?v={video_id}", path, video, quality, batch.id))
+        batch.job_ids = [job.id for job in jobs]
+        with self.lock:
+            for job in jobs:
+                self.jobs[job.id] = job
+            self.batches[batch.id] = batch
+        self.persist(force=True)
+        self.fill(batch)
+        return self.summarize(batch)
+
+    #must be called on the event loop
+    def schedule(self, job: DownloadJob):
+        task = asyncio.get_running_loop().create_task(self.process(job))
+        self.tasks[job.id] = task
+
+        def forget(done: asyncio.Task):
+            if self.tasks.get(job.id) is done:
+                del self.tasks[job.id]
+            if not done.cancelled() and done.exception():
+                logger.error(f"Download job {job.id} could not run: {str(done.exception())}")
+            #the next item of the batch takes its place
+            if job.batch_id and not self.shutting_down and (batch := self.batches.get(job.batch_id)):
+                self.fill(batch)
+
+        task.add_done_callback(forget)
+
+    #start queued items of a batch until batch_limit of them are running
+    def fill(self, batch: DownloadBatch):
+        running = sum(1 for job_id in batch.job_ids if job_id in self.tasks)
+        for job_id in batch.job_ids:
+            if running >= self.batch_limit:
+                return
+            job = self.jobs.get(job_id)
+            if job is not None and job.status == "queued" and job_id not in self.tasks:
+                self.schedule(job)
+                running += 1
+
+    #yt-dlp archive of what was downloaded into a folder in one format, kept in the data dir
+    def archive_path(self, path: str, video: bool, quality: Optional[int]) -> str:
+        kind = f"video{quality or ''}" if video else "audio"
+        key = hashlib.sha256(f"{os.path.realpath(os.path.expanduser(path))}|{kind}".encode()).hexdigest()[:32]
+        return get_data_path("download_archive", f"{key}.txt")
+
+    #archive lines look like "youtube <video id>"
+    def archived_ids(self, archive_path: str) -> set[str]:
+        try:
+            with open(archive_path) as file:
+                return {line.split()[1] for line in file if len(line.split()) == 2}
+        except FileNotFoundError:
+            return set()
+        except OSError as e:
+            logger.error(f"Could not read download archive: {str(e)}")
+            return set()
+
+    def get(self, job_id: str) -> Optional[DownloadJob]:
+        return self.jobs.get(job_id)
+
+    def get_batch(self, batch_id: str) -> Optional[DownloadBatch]:
+        batch = self.batches.get(batch_id)
+        return self.summarize(batch) if batch else None
+
+    #persist() prunes jobs and batches from yt-dlp hook threads, so they're copied under the lock
+    #before anything on the loop iterates them
+    def snapshot(self) -> tuple[dict[str, DownloadJob], dict[str, DownloadBatch]]:
+        with self.lock:
+            return dict(self.jobs), dict(self.batches)
+
+    def list_batches(self) -> list[DownloadBatch]:
+        jobs, batches = self.snapshot()
+        return [self.summarize(batch, jobs) for batch in sorted(batches.values(), key=lambda batch: batch.created_at, reverse=True)]
+
+    #fill in the totals of a batch from its jobs, finished and skipped items count as 100%
+    def summarize(self, batch: DownloadBatch, all_jobs: Optional[dict[str, DownloadJob]] = None) -> DownloadBatch:
+        if all_jobs is None:
+            all_jobs, _ = self.snapshot()
+        jobs = [all_jobs[job_id] for job_id in batch.job_ids if job_id in all_jobs]
+        counts = {status: 0 for status in ACTIVE_STATUSES + FINISHED_STATUSES}
+        for job in jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        counts["skipped"] = len(batch.skipped)
+        batch.counts = counts
+        batch.total = len(batch.job_ids) + len(batch.skipped)
+        batch.downloaded_bytes = sum(job.downloaded_bytes for job in jobs)
+        batch.total_bytes = sum(job.total_bytes or 0 for job in jobs)
+        done = sum(job.percent if job.status in ACTIVE_STATUSES else 100.0 for job in jobs) + 100.0 * len(batch.skipped)
+        batch.percent = round(done / batch.total, 1) if batch.total else 100.0
+        speeds = [job.speed for job in jobs if job.status == "downloading" and job.speed]
+        batch.speed = sum(speeds) if speeds else None
+        if counts["downloading"] or counts["processing"]:
+            batch.status = "downloading"
+        elif counts["queued"]:
+            batch.status = "queued"
+        elif jobs and counts["cancelled"] == len(jobs):
+            batch.status = "cancelled"
+        elif counts["failed"] and not counts["completed"] and not batch.skipped:
+            batch.status = "failed"
+        elif counts["failed"]:
+            batch.status = "completed_with_errors"
+        else:
+            batch.status = "completed"
+        batch.updated_at = max([batch.created_at] + [job.updated_at for job in jobs])
+        return batch
+
+    def list(self) -> list[DownloadJob]:
+        jobs, _ = self.snapshot()
+        return sorted(jobs.values(), key=lambda job: job.created_at, reverse=True)
+
+    def cancel(self, job_id: str) -> Optional[DownloadJob]:
+        job = self.jobs.get(job_id)
+        if job is None or job.status in FINISHED_STATUSES:
+            return job
+        self.cancelled.add(job_id)
+        if job.status == "queued":
+            self.update(job, status="cancelled")
+        #still waiting for a slot, stop waiting
+        if job_id not in self.working and (task := self.tasks.get(job_id)):
+            task.cancel()
+        return job
+
+    def cancel_batch(self, batch_id: str) -> Optional[DownloadBatch]:
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            return None
+        for job_id in batch.job_ids:
+            self.cancel(job_id)
+        return self.summarize(batch)
+
+    def update(self, job: DownloadJob, **fields):
+        for name, value in fields.items():
+            setattr(job, name, value)
+        job.updated_at = time.time()
+        self.persist(force="status" in fields)
+
+    #a job runs in stages on the scheduler's bulk threads, each stage behind its own limit, so a
+    #job queued for a transcode slot holds neither a thread nor a fetch slot:
+    #fetch the stream with yt-dlp, transcode it with ffmpeg (audio only), move the file in place
+    async def process(self, job: DownloadJob):
+        if job.id in self.cancelled or self.shutting_down:
+            self.cancelled.discard(job.id)
+            return
+        info = None
+        try:
+            async with self.fetch_slots:
+                if job.id in self.cancelled:
+                    self.update(job, status="cancelled")
+                    return
+                self.update(job, status="downloading")
+                info = await self.run_stage(job, self.fetch, job)
+            if info is not None and job.id not in self.cancelled:
+                self.update(job, status="processing")
+                async with self.transcode_slots:
+                    await self.run_stage(job, self.transcode, job, info)
+            if self.shutting_down and job.id not in self.cancelled:
+                #left active in the state file so it resumes after the restart
+                return
+            if job.id in self.cancelled:
+                self.discard_source(info)
+                self.update(job, status="cancelled")
+            else:
+                self.update(job, status="completed", percent=100.0, eta=0)
+        except asyncio.CancelledError:
+            if job.id in self.cancelled:
+                self.discard_source(info)
+                self.update(job, status="cancelled")
+            raise
+        except Exception as e:
+            if job.id in self.cancelled:
+                self.discard_source(info)
+                self.update(job, status="cancelled")
+            elif self.shutting_down:
+                #stopped midway by the shutdown, resumes after the restart
+                return
+            else:
+                logger.error(f"Download job {job.id} error: {str(e)}")
+                self.discard_source(info)
+                self.update(job, status="failed", error=str(e))
+        finally:
+            self.cancelled.discard(job.id)
+
+    #the fetched file only feeds the transcode, remove it when the job stops before it is finalized
+    def discard_source(self, info: Optional[dict]):
+        if info is None or info.get("finalized"):
+            return
+        try:
+            os.remove(info["filepath"])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Could not remove {info['filepath']}: {str(e)}")
+
+    #while a stage runs on a thread, cancelling the job is left to the hooks that poll for it
+    async def run_stage(self, job: DownloadJob, fn, *args):
+        self.working.add(job.id)
+        try:
+            return await scheduler.run(fn, *args, priority=BULK)
+        finally:
+            self.working.discard(job.id)
+
+    #first stage, returns what the transcode stage needs or None when there is nothing to convert
+    def fetch(self, job: DownloadJob) -> Optional[dict]:
+        #yt-dlp is imported on first use, it's a big part of startup time
+        from yt_dlp.utils import DownloadCancelled
+
+        def progress_hook(progress: dict):
+            if job.id in self.cancelled or self.shutting_down:
+                raise DownloadCancelled()
+            if progress.get("status") == "downloading":
+                downloaded = progress.get("downloaded_bytes") or 0
+                total = progress.get("total_bytes") or progress.get("total_bytes_estimate")
+                self.update(
+                    job,
+                    downloaded_bytes=downloaded,
+                    total_bytes=total,
+                    percent=round(downloaded * 100 / total, 1) if total else job.percent,
+                    speed=progress.get("speed"),
+                    eta=progress.get("eta"),
+                    filename=os.path.basename(progress.get("filename") or "") or job.filename,
+                )
+
+        def postprocessor_hook(progress: dict):
+            if progress.get("status") == "started" and job.status != "processing":
+                self.update(job, status="processing")
+
+        if not job.video:
+            return fetch_audio(job.path, job.video_url, progress_hook=progress_hook)
+
+        #merging video and audio is a remux, yt-dlp does it in place
+        ok = download_youtube_video(
+            job.path, job.video_url, job.video, job.quality,
+            progress_hook=progress_hook,
+            postprocessor_hook=postprocessor_hook,
+            archive_path=self.archive_path(job.path, job.video, job.quality) if job.batch_id else None,
+        )
+        if not ok and job.id not in self.cancelled and not self.shutting_down:
+            raise RuntimeError("Something went wrong while downloading")
+        return None
+
+    #second and last stage for audio, ffmpeg runs in its own process so the cores are the limit
+    def transcode(self, job: DownloadJob, info: dict):
+        temp, final = transcode_audio(
+            info["filepath"], info["acodec"],
+            cancelled=lambda: job.id in self.cancelled or self.shutting_down,
+        )
+        archive_path = self.archive_path(job.path, job.video, job.quality) if job.batch_id else None
+        #from here on the source may already be the final file
+        info["finalized"] = True
+        with self.archive_lock:
+            final = finalize_audio(info["filepath"], temp, final, info, archive_path)
+        self.update(job, filename=os.path.basename(final))
+
+    def persist(self, force: bool = False):
+        now = time.time()
+        if not force and now - self.last_persist < PERSIST_INTERVAL:
+            return
+        with self.lock:
+            self.last_persist = now
+            #batch items go with their batch, not one by one
+            finished = [job for job in self.jobs.values() if job.status in FINISHED_STATUSES and not job.batch_id]
+            for job in sorted(finished, key=lambda job: job.updated_at)[:max(0, len(finished) - DOWNLOAD_JOB_HISTORY)]:
+                del self.jobs[job.id]
+            finished_batches = [
+                batch for batch in self.batches.values()
+                if all(job_id not in self.jobs or self.jobs[job_id].status in FINISHED_STATUSES for job_id in batch.job_ids)
+            ]
+            for batch in sorted(finished_batches, key=lambda batch: batch.created_at)[:max(0, len(finished_batches) - DOWNLOAD_BATCH_HISTORY)]:
+                for job_id in batch.job_ids:
+                    self.jobs.pop(job_id, None)
+                del self.batches[batch.id]
+            data = [job.model_dump() for job in self.jobs.values()]
+            batches = [batch.model_dump() for batch in self.batches.values()]
+        self.write(self.state_path, data)
+        self.write(self.batches_path, batches)
+
+    def write(self, path: str, data: list):
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(data, file)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Could not save download jobs: {str(e)}")
+
+    def load(self, path: str) -> list:
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load download jobs: {str(e)}")
+            return []
+
+    #load saved jobs and queue the unfinished ones again, yt-dlp continues their .part files
+    def resume(self):
+        resumed = []
+        with self.lock:
+            for data in self.load(self.state_path):
+                job = DownloadJob(**data)
+                if job.status in ACTIVE_STATUSES:
+                    job.status = "queued"
+                    if not job.batch_id:
+                        resumed.append(job)
+                self.jobs[job.id] = job
+            for data in self.load(self.batches_path):
+                batch = DownloadBatch(**data)
+                self.batches[batch.id] = batch
+        for job in resumed:
+            logger.info(f"Resuming download job {job.id} for {job.video_url}")
+            self.schedule(job)
+        for batch in self.batches.values():
+            self.fill(batch)
+
+    def stats(self) -> dict:
+        counts = {status: 0 for status in ACTIVE_STATUSES + FINISHED_STATUSES}
+        jobs, _ = self.snapshot()
+        for job in jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
+
+    #stop running downloads without marking them finished so they resume on the next start
+    def shutdown(self):
+        self.shutting_down = True
+        self.persist(force=True)
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+
+download_jobs = DownloadJobManager(
+    get_data_path("download_jobs.json"),
+    get_data_path("download_batches.json"),
+    DOWNLOAD_FETCH_CONCURRENCY,
+    DOWNLOAD_TRANSCODE_CONCURRENCY,
+    DOWNLOAD_BATCH_CONCURRENCY,
+)
+#a job holds either a fetch or a transcode slot, so that many can make progress at once
+if not os.getenv("SCHEDULER_LIMIT_BULK"):
+    scheduler.configure(BULK, limit=DOWNLOAD_FETCH_CONCURRENCY + DOWNLOAD_TRANSCODE_CONCURRENCY)
+register_stats("download_jobs", download_jobs.stats)
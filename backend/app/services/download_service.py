@@ -1,7 +1,42 @@
 import os
-from yt_dlp import YoutubeDL
+import shutil
+import subprocess
+from typing import Callable, Optional
+
+#fragments of one dash/hls download fetched at once
+DOWNLOAD_FRAGMENT_CONCURRENCY = int(os.getenv("DOWNLOAD_FRAGMENT_CONCURRENCY", 4))
+#audio downloads: "mp3" always re-encodes, "auto" keeps aac and opus sources as they are
+#(remuxed into .m4a/.opus) and only re-encodes anything else to mp3
+DOWNLOAD_AUDIO_FORMAT = os.getenv("DOWNLOAD_AUDIO_FORMAT", "mp3")
+#ffmpeg binary, found on PATH when not set
+FFMPEG_LOCATION = os.getenv("FFMPEG_LOCATION") or shutil.which("ffmpeg") or "ffmpeg"
+
+#source codec -> container it is copied into when DOWNLOAD_AUDIO_FORMAT is auto
+REMUX_CONTAINERS = {
+    "mp4a": "m4a",
+    "aac": "m4a",
+    "opus": "opus",
+    "mp3": "mp3",
+}
+#seconds between cancellation checks while ffmpeg runs
+TRANSCODE_POLL_INTERVAL = 0.5
+
+
+class TranscodeCancelled(Exception):
+    pass
+
+def download_youtube_video(
+    path: str,
+    video_url: str,
+    video: bool = True,
+    quality: int = None,
+    progress_hook: Optional[Callable[[dict], None]] = None,
+    postprocessor_hook: Optional[Callable[[dict], None]] = None,
+    archive_path: Optional[str] = None,
+):
+    #yt-dlp is imported on first use, it's a big part of startup time
+    from yt_dlp import YoutubeDL
 
-def download_youtube_video(path: str, video_url: str, video: bool = True, quality: int = None):
     path = os.path.expanduser(path)
     os.makedirs(path, exist_ok=True)
 
@@ -10,8 +45,18 @@ def download_youtube_video(path: str, video_url: str, video: bool = True, qualit
         'outtmpl': os.path.join(path, '%(title)s.%(ext)s'),
         'noplaylist': True,
         'quiet': False,
-        'keep_video': True
+        'keep_video': True,
+        # pick up .part files left behind by an interrupted run
+        'continuedl': True,
+        'concurrent_fragment_downloads': DOWNLOAD_FRAGMENT_CONCURRENCY,
     }
+    if archive_path:
+        # ids already downloaded are skipped, finished ones are added
+        ydl_opts['download_archive'] = archive_path
+    if progress_hook:
+        ydl_opts['progress_hooks'] = [progress_hook]
+    if postprocessor_hook:
+        ydl_opts['postprocessor_hooks'] = [postprocessor_hook]
 
     if video:
         # if video is true in parameter and qualit is given it download based on that else default
@@ -38,3 +83,86 @@ def download_youtube_video(path: str, video_url: str, video: bool = True, qualit
         except Exception as e:
             print(f"Error while downloading: {e}")
             return False
+
+
+#first stage of an audio download: fetch the best audio stream as it is, no postprocessing
+#returns the downloaded file and what yt-dlp knows about its codec
+def fetch_audio(path: str, video_url: str, progress_hook: Optional[Callable[[dict], None]] = None) -> dict:
+    #yt-dlp is imported on first use, it's a big part of startup time
+    from yt_dlp import YoutubeDL
+
+    path = os.path.expanduser(path)
+    os.makedirs(path, exist_ok=True)
+    ydl_opts = {
+        'outtmpl': os.path.join(path, '%(title)s.%(ext)s'),
+        'noplaylist': True,
+        'quiet': False,
+        'continuedl': True,
+        'concurrent_fragment_downloads': DOWNLOAD_FRAGMENT_CONCURRENCY,
+        'format': 'bestaudio/best',
+    }
+    if progress_hook:
+        ydl_opts['progress_hooks'] = [progress_hook]
+
+    with YoutubeDL(ydl_opts) as ydl:
+        print(f"Audio download started for: {video_url}")
+        info = ydl.extract_info(video_url, download=True)
+        downloads = info.get("requested_downloads") or [{}]
+        return {
+            "id": info["id"],
+            "extractor": info.get("extractor_key", "youtube"),
+            "filepath": downloads[0].get("filepath") or ydl.prepare_filename(info),
+            "acodec": info.get("acodec") or "",
+        }
+
+
+#container the fetched audio ends up in, None when it has to be re-encoded to mp3
+def remux_container(acodec: str) -> Optional[str]:
+    if DOWNLOAD_AUDIO_FORMAT != "auto":
+        return "mp3" if acodec.startswith("mp3") else None
+    return next((ext for codec, ext in REMUX_CONTAINERS.items() if acodec.startswith(codec)), None)
+
+
+#second stage: copy or re-encode the fetched file with ffmpeg in its own process, the caller
+#limits how many run at once; the result is written next to the source as <name>.temp.<ext>
+#and returned with the final path, nothing is run when the source can be kept as it is
+def transcode_audio(source: str, acodec: str, cancelled: Optional[Callable[[], bool]] = None) -> tuple[Optional[str], str]:
+    base, source_ext = os.path.splitext(source)
+    container = remux_container(acodec)
+    ext = container or "mp3"
+    final = f"{base}.{ext}"
+    if container and source_ext.lstrip(".") == container:
+        return None, final
+
+    temp = f"{base}.temp.{ext}"
+    codec_args = ["-c:a", "copy"] if container else ["-c:a", "libmp3lame", "-b:a", "192k"]
+    command = [FFMPEG_LOCATION, "-y", "-loglevel", "error", "-i", source, "-vn", "-map_metadata", "0", *codec_args, temp]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    while True:
+        try:
+            _, stderr = process.communicate(timeout=TRANSCODE_POLL_INTERVAL)
+            break
+        except subprocess.TimeoutExpired:
+            if cancelled and cancelled():
+                process.kill()
+                process.communicate()
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise TranscodeCancelled()
+    if process.returncode != 0:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise RuntimeError(f"ffmpeg failed: {stderr.decode(errors='replace').strip()[-500:]}")
+    return temp, final
+
+
+#last stage: put the result in place of the fetched file and record it in the archive
+def finalize_audio(source: str, temp: Optional[str], final: str, info: dict, archive_path: Optional[str] = None) -> str:
+    if temp:
+        os.replace(temp, final)
+        if os.path.abspath(source) != os.path.abspath(final) and os.path.exists(source):
+            os.remove(source)
+    if archive_path:
+        with open(archive_path, "a", encoding="utf-8") as file:
+            file.write(f"{info['extractor'].lower()} {info['id']}\n")
+    return final
@@ -0,0 +1,76 @@
+import logging
+import os
+import time
+from typing import Optional
+
+import httpx
+
+from services.metrics_service import google_api_requests, google_api_duration
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+#httpx logs every request at info level, which floods the console
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+#googleapis.com unless pointed at a local stand-in (the offline benchmarks do this)
+GOOGLE_API_BASE_URL = os.getenv("GOOGLE_API_BASE_URL", "https://www.googleapis.com").rstrip("/")
+GOOGLE_API_HOST = httpx.URL(GOOGLE_API_BASE_URL).host
+YOUTUBE_API_URL = f"{GOOGLE_API_BASE_URL}/youtube/v3"
+USERINFO_URL = f"{GOOGLE_API_BASE_URL}/oauth2/v1/userinfo"
+
+#one pooled client for the whole app so calls to googleapis reuse tcp+tls connections
+client: Optional[httpx.AsyncClient] = None
+
+
+#googleapis path (or host for everything else) used as the metrics label
+def get_endpoint_label(url: httpx.URL) -> str:
+    if url.host == GOOGLE_API_HOST or url.host.endswith("googleapis.com"):
+        return url.path
+    if url.host.endswith("googlevideo.com"):
+        return "googlevideo"
+    return url.host
+
+
+async def start_timer(request: httpx.Request):
+    request.extensions["started_at"] = time.perf_counter()
+
+
+async def record_response(response: httpx.Response):
+    request = response.request
+    endpoint = get_endpoint_label(request.url)
+    google_api_requests.inc(endpoint, response.status_code)
+    if "started_at" in request.extensions:
+        google_api_duration.observe(time.perf_counter() - request.extensions["started_at"], endpoint)
+
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=True,
+        event_hooks={"request": [start_timer], "response": [record_response]},
+        timeout=httpx.Timeout(30, connect=10),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+    )
+
+
+#called from the app lifespan on startup
+async def start_http_client():
+    global client
+    if client is None:
+        client = create_http_client()
+
+
+#called from the app lifespan on shutdown
+async def close_http_client():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+
+#created on first use too, so services still work when the lifespan didn't run (scripts, shells)
+def get_http_client() -> httpx.AsyncClient:
+    global client
+    if client is None:
+        logger.info("HTTP client used before startup, creating it now")
+        client = create_http_client()
+    return client
@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from cache.data_dir import get_data_path
+from cache.track_index import track_index
+from services.recommendation_graph import recommendation_graph
+from models import YoutubePlaylistResponse
+from services.authenticated_youtube_service import parse_youtube_response
+from services.http_client import get_http_client, YOUTUBE_API_URL
+from services.quota_service import acquire_quota, check_quota_response
+from services.token_service import get_user_id
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#serve liked music and playlists from a local snapshot, LIBRARY_SYNC_ENABLED=0 goes back to
+#asking youtube for every page
+LIBRARY_SYNC_ENABLED = os.getenv("LIBRARY_SYNC_ENABLED", "1") != "0"
+#seconds a snapshot is served before a background refresh is started
+LIBRARY_REFRESH_INTERVAL = int(os.getenv("LIBRARY_REFRESH_INTERVAL", 10*60))
+#known pages revalidated at once during a refresh
+LIBRARY_SYNC_CONCURRENCY = int(os.getenv("LIBRARY_SYNC_CONCURRENCY", 4))
+#stop walking after this many pages (50 items each)
+LIBRARY_MAX_PAGES = int(os.getenv("LIBRARY_MAX_PAGES", 200))
+
+#what each library list fetches and how many items the api pages hold
+LIBRARY_KINDS = {
+    "liked": {
+        "resource": "videos",
+        "params": {"part": "snippet", "myRating": "like", "maxResults": 50},
+        "page_size": 25,
+    },
+    "playlists": {
+        "resource": "playlists",
+        "params": {"part": "snippet,contentDetails", "mine": True, "maxResults": 50},
+        "page_size": 10,
+    },
+}
+
+#(user id, kind) -> loaded snapshot
+snapshots: dict[tuple[str, str], dict] = {}
+#(user id, kind) -> running sync, so one user's refreshes never overlap
+syncs: dict[tuple[str, str], asyncio.Task] = {}
+#(user id, kind) -> first servable snapshot of the running sync, set before the walk
+#past the known pages so a first sync answers after one page
+ready: dict[tuple[str, str], asyncio.Future] = {}
+
+
+def snapshot_path(user_id: str, kind: str) -> str:
+    name = hashlib.sha256(user_id.encode()).hexdigest()[:32]
+    return get_data_path("library", f"{name}_{kind}.json")
+
+
+def load_snapshot(user_id: str, kind: str) -> Optional[dict]:
+    key = (user_id, kind)
+    if key not in snapshots:
+        try:
+            with open(snapshot_path(user_id, kind)) as file:
+                snapshots[key] = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load library snapshot: {str(e)}")
+            return None
+    return snapshots[key]
+
+
+def save_snapshot(user_id: str, kind: str, snapshot: dict):
+    snapshots[(user_id, kind)] = snapshot
+    path = snapshot_path(user_id, kind)
+    try:
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(snapshot, file)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.error(f"Could not save library snapshot: {str(e)}")
+
+
+#fetch one api page, sending the etag we have so an unchanged page comes back as a 304
+#returns None when the page did not change
+async def fetch_page(kind: str, access_token: str, page_token: Optional[str], etag: Optional[str]) -> Optional[dict]:
+    config = LIBRARY_KINDS[kind]
+    params = dict(config["params"])
+    if page_token:
+        params["pageToken"] = page_token
+    headers = {"Authorization": f"Bearer {access_token}"}
+    if etag:
+        headers["If-None-Match"] = etag
+
+    await acquire_quota(f"{config['resource']}.list")
+    response = await get_http_client().get(f"{YOUTUBE_API_URL}/{config['resource']}", params=params, headers=headers)
+    if response.status_code == 304:
+        return None
+    check_quota_response(response)
+    response.raise_for_status()
+    data = response.json()
+    return {
+        "token": page_token,
+        "etag": data.get("etag") or response.headers.get("etag"),
+        "items": data.get("items", []),
+        "next": data.get("nextPageToken"),
+    }
+
+
+#bring a snapshot up to date: pages we already know are revalidated concurrently with
+#If-None-Match, then any pages past the last known one are walked in order
+#first_snapshot is resolved as soon as there is something to serve, the walk continues after it
+async def sync_library(user_id: str, kind: str, access_token: str, first_snapshot: asyncio.Future) -> dict:
+    old_pages = (load_snapshot(user_id, kind) or {}).get("pages", [])
+    semaphore = asyncio.Semaphore(LIBRARY_SYNC_CONCURRENCY)
+
+    async def revalidate(page: dict) -> dict:
+        async with semaphore:
+            fresh = await fetch_page(kind, access_token, page["token"], page.get("etag"))
+            return fresh if fresh is not None else page
+
+    pages = list(await asyncio.gather(*(revalidate(page) for page in old_pages)))
+
+    #keep the chain only as long as each page still points at the next one we have
+    for index, page in enumerate(pages[:-1]):
+        if page["next"] != pages[index + 1]["token"]:
+            pages = pages[:index + 1]
+            break
+
+    if not pages:
+        pages.append(await fetch_page(kind, access_token, None, None))
+    if pages[-1]["next"] and len(pages) < LIBRARY_MAX_PAGES:
+        #incomplete snapshots are refreshed on the next request if the walk never finishes
+        partial = {"synced_at": time.time(), "pages": list(pages), "complete": False}
+        save_snapshot(user_id, kind, partial)
+        first_snapshot.set_result(partial)
+    while pages[-1]["next"] and len(pages) < LIBRARY_MAX_PAGES:
+        pages.append(await fetch_page(kind, access_token, pages[-1]["next"], None))
+
+    snapshot = {"synced_at": time.time(), "pages": pages, "complete": True}
+    save_snapshot(user_id, kind, snapshot)
+    if not first_snapshot.done():
+        first_snapshot.set_result(snapshot)
+    if kind == "liked" and track_index:
+        items = parse_youtube_response({"items": snapshot_items(snapshot, kind)}).items
+        track_index.add_playlist_items(items)
+        if recommendation_graph:
+            recommendation_graph.record_playlist((item.id, item.channelTitle) for item in items)
+    return snapshot
+
+
+#returns the sync's first servable snapshot, the sync itself keeps running in the background
+def start_sync(user_id: str, kind: str, access_token: str) -> asyncio.Future:
+    key = (user_id, kind)
+    task = syncs.get(key)
+    if task is None or task.done():
+        first_snapshot = asyncio.get_running_loop().create_future()
+        task = asyncio.ensure_future(sync_library(user_id, kind, access_token, first_snapshot))
+        syncs[key] = task
+        ready[key] = first_snapshot
+
+        def log_failure(done: asyncio.Task):
+            if done.cancelled():
+                first_snapshot.cancel()
+            elif done.exception():
+                logger.error(f"Library sync failed for {kind}: {str(done.exception())}")
+                if not first_snapshot.done():
+                    first_snapshot.set_exception(done.exception())
+                    #mark retrieved so a sync nobody waits on doesn't log a warning
+                    first_snapshot.exception()
+
+        task.add_done_callback(log_failure)
+    return ready[key]
+
+
+#snapshot to serve from, the first page is synced in the foreground the first time and the
+#rest in the background, refreshed once it is older than LIBRARY_REFRESH_INTERVAL or incomplete
+async def get_snapshot(access_token: str, kind: str, force: bool = False) -> dict:
+    user_id = await get_user_id(access_token)
+    snapshot = load_snapshot(user_id, kind)
+    if snapshot is None or force:
+        return await asyncio.shield(start_sync(user_id, kind, access_token))
+    if not snapshot.get("complete", True) or time.time() - snapshot["synced_at"] > LIBRARY_REFRESH_INTERVAL:
+        start_sync(user_id, kind, access_token)
+    return snapshot
+
+
+def snapshot_items(snapshot: dict, kind: str) -> list:
+    items = [item for page in snapshot["pages"] for item in page["items"]]
+    if kind == "liked":
+        #filter videos with category 10(i.e music)
+        items = [item for item in items if item.get("snippet", {}).get("categoryId") == "10"]
+    return items
+
+
+#page through the snapshot, page tokens are plain offsets into it
+#an incomplete snapshot always offers a next page, the walk may not have reached it yet
+def page_snapshot(snapshot: dict, kind: str, page_token: Optional[str]) -> YoutubePlaylistResponse:
+    items = snapshot_items(snapshot, kind)
+    page_size = LIBRARY_KINDS[kind]["page_size"]
+    offset = int(page_token) if page_token and page_token.isdigit() else 0
+    next_offset = offset + page_size
+    has_next = next_offset < len(items) or not snapshot.get("complete", True)
+    return parse_youtube_response({
+        "items": items[offset:next_offset],
+        "nextPageToken": str(next_offset) if has_next else None,
+    })
+
+
+#a page past the end of an incomplete snapshot waits for the walk that is filling it in
+async def get_synced_page(access_token: str, kind: str, page_token: Optional[str]) -> YoutubePlaylistResponse:
+    snapshot = await get_snapshot(access_token, kind)
+    offset = int(page_token) if page_token and page_token.isdigit() else 0
+    if not snapshot.get("complete", True) and offset + LIBRARY_KINDS[kind]["page_size"] > len(snapshot_items(snapshot, kind)):
+        task = syncs.get((await get_user_id(access_token), kind))
+        if task is not None:
+            snapshot = await asyncio.shield(task)
+    return page_snapshot(snapshot, kind, page_token)
+
+
+async def get_synced_liked_music(access_token: str, page_token: Optional[str] = None) -> YoutubePlaylistResponse:
+    return await get_synced_page(access_token, "liked", page_token)
+
+
+async def get_synced_user_playlist(access_token: str, page_token: Optional[str] = None) -> YoutubePlaylistResponse:
+    return await get_synced_page(access_token, "playlists", page_token)
+
+
+#full refresh right now, returns how many items each list holds so far and whether the
+#walk past the known pages is still running
+async def sync_user_library(access_token: str) -> dict:
+    synced = await asyncio.gather(*(get_snapshot(access_token, kind, force=True) for kind in LIBRARY_KINDS))
+    return {
+        kind: {
+            "items": len(snapshot_items(snapshot, kind)),
+            "synced_at": snapshot["synced_at"],
+            "complete": snapshot.get("complete", True),
+        }
+        for kind, snapshot in zip(LIBRARY_KINDS, synced)
+    }
@@ -0,0 +1,172 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable
+
+#seconds, covers quick cache hits up to slow yt-dlp runs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                yield f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float("inf"),)
+        #label values -> (bucket counts, sum, count)
+        self.values: dict[tuple, list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self.lock:
+            entry = self.values.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = format_labels(self.labels + ("le",), label_values + (format_value(bound),))
+                    yield f"{self.name}_bucket{labels} {bucket_count}"
+                labels = format_labels(self.labels, label_values)
+                yield f"{self.name}_sum{labels} {format_value(total)}"
+                yield f"{self.name}_count{labels} {count}"
+
+
+#value read at scrape time from the object that already tracks it
+class Gauge:
+    def __init__(self, name: str, help: str, labels: tuple, collect: Callable[[], Iterable[tuple]]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        #returns (label values tuple, value) pairs
+        self.collect = collect
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for label_values, value in self.collect():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}"
+
+
+metrics: list = []
+
+
+def register(metric):
+    metrics.append(metric)
+    return metric
+
+
+#prometheus text exposition format
+def render_metrics() -> str:
+    lines = []
+    for metric in metrics:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            lines.append(f"# {metric.name} collection failed: {str(e)}")
+    return "\n".join(lines) + "\n"
+
+
+http_requests = register(Counter(
+    "sanbeats_http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status")
+))
+http_request_duration = register(Histogram(
+    "sanbeats_http_request_duration_seconds", "HTTP request latency until the response finished", ("route", "method")
+))
+google_api_requests = register(Counter(
+    "sanbeats_google_api_requests_total", "Calls to Google APIs by endpoint and status", ("endpoint", "status")
+))
+google_api_duration = register(Histogram(
+    "sanbeats_google_api_duration_seconds", "Google API latency until response headers", ("endpoint",)
+))
+extraction_duration = register(Histogram(
+    "sanbeats_extraction_duration_seconds", "yt-dlp stream info extraction time", ("result",)
+))
+
+#name -> executor, filled by the modules that own them
+executors: dict[str, ThreadPoolExecutor] = {}
+
+
+def register_executor(name: str, executor: ThreadPoolExecutor):
+    executors[name] = executor
+
+
+def collect_executor_queue_depth():
+    for name, executor in executors.items():
+        yield (name,), executor._work_queue.qsize()
+
+
+def collect_executor_active_workers():
+    for name, executor in executors.items():
+        #started threads minus the ones parked waiting for work
+        yield (name,), max(0, len(executor._threads) - executor._idle_semaphore._value)
+
+
+def collect_executor_max_workers():
+    for name, executor in executors.items():
+        yield (name,), executor._max_workers
+
+
+register(Gauge("sanbeats_executor_queue_depth", "Tasks waiting for a worker thread", ("executor",), collect_executor_queue_depth))
+register(Gauge("sanbeats_executor_active_workers", "Worker threads running a task", ("executor",), collect_executor_active_workers))
+register(Gauge("sanbeats_executor_max_workers", "Configured worker threads", ("executor",), collect_executor_max_workers))
+
+
+#cache name -> function returning its stats dict, every numeric field is exported
+stats_sources: dict[str, Callable[[], dict]] = {}
+
+
+def register_stats(name: str, stats: Callable[[], dict]):
+    stats_sources[name] = stats
+
+
+def collect_stats():
+    for name, stats in stats_sources.items():
+        for stat, value in stats().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield (name, stat), value
+
+
+register(Gauge("sanbeats_cache_stats", "Counters and sizes reported by caches and pools", ("cache", "stat"), collect_stats))
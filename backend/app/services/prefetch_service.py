@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import os
+from typing import List, Optional
+
+from cache.audio_cache import get_cached_audio_info, extract_audio_info_once
+from models import SearchResult
+from services.scheduler import prioritize, BACKGROUND, INTERACTIVE
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#prefetch is optional, turn it on with PREFETCH_ENABLED=1
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "0") == "1"
+#how many results from the top of each list get their stream url resolved ahead of time
+PREFETCH_TOP_K = int(os.getenv("PREFETCH_TOP_K", 5))
+#max prefetch extractions running at once
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", 2))
+#"low" runs as background work on slots nothing else wants, "high" competes with real clicks
+PREFETCH_PRIORITY = os.getenv("PREFETCH_PRIORITY", "low")
+#seconds to wait before a low priority batch starts
+PREFETCH_DELAY = float(os.getenv("PREFETCH_DELAY", 1.0))
+
+#shared by every batch so parallel result sets from different clients stay within the limit
+semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+#ids waiting for or running a prefetch, a newer list skips them instead of queueing twice
+queued: set[str] = set()
+#running batches, kept referenced so they aren't garbage collected mid-run
+batches: set[asyncio.Task] = set()
+
+
+async def prefetch_one(video_id: str):
+    try:
+        async with semaphore:
+            if await get_cached_audio_info(video_id):
+                return
+            try:
+                with prioritize(BACKGROUND if PREFETCH_PRIORITY == "low" else INTERACTIVE):
+                    await extract_audio_info_once(video_id)
+            except Exception as e:
+                logger.info(f"Prefetch skipped {video_id}: {str(e)}")
+    finally:
+        queued.discard(video_id)
+
+
+async def prefetch_batch(video_ids: List[str]):
+    try:
+        if PREFETCH_PRIORITY == "low":
+            await asyncio.sleep(PREFETCH_DELAY)
+    except asyncio.CancelledError:
+        queued.difference_update(video_ids)
+        raise
+    await asyncio.gather(*(prefetch_one(video_id) for video_id in video_ids))
+
+
+#queue the top results of a list endpoint for background extraction
+#batches from different result sets run side by side under the shared concurrency limit,
+#ids that are already queued are left to the batch that queued them
+def schedule_prefetch(results: Optional[List[SearchResult]]):
+    if not PREFETCH_ENABLED or not results or PREFETCH_TOP_K <= 0:
+        return
+    top_ids = dict.fromkeys(result.id for result in results[:PREFETCH_TOP_K])
+    video_ids = [video_id for video_id in top_ids if video_id not in queued]
+    if not video_ids:
+        return
+    queued.update(video_ids)
+    task = asyncio.get_running_loop().create_task(prefetch_batch(video_ids))
+    batches.add(task)
+    task.add_done_callback(batches.discard)
@@ -0,0 +1,224 @@
+import asyncio
+import datetime
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from services.scheduler import work_priority, PLAYBACK, INTERACTIVE, BACKGROUND
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#units charged by the YouTube Data API per call
+#https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_COSTS = {
+    "search.list": 100,
+    "videos.list": 1,
+    "channels.list": 1,
+    "playlists.list": 1,
+    "playlistItems.list": 1,
+    "playlistItems.insert": 50,
+}
+
+#interactive calls (search, library) always go before background ones (recommendation, trending)
+#the level comes from the scheduler's work priority, playback counts as interactive and
+#bulk (downloads) as background
+def get_quota_level() -> str:
+    return INTERACTIVE if work_priority.get() in (PLAYBACK, INTERACTIVE) else BACKGROUND
+
+#units per day the google cloud project is allowed to spend
+QUOTA_DAILY_BUDGET = int(os.getenv("QUOTA_DAILY_BUDGET", 10000))
+#share of the daily budget only interactive calls may use
+QUOTA_INTERACTIVE_RESERVE = float(os.getenv("QUOTA_INTERACTIVE_RESERVE", 0.2))
+#seconds a call waits for a rate limit token before giving up, per priority
+QUOTA_MAX_WAIT = {
+    INTERACTIVE: float(os.getenv("QUOTA_MAX_WAIT_INTERACTIVE", 5)),
+    BACKGROUND: float(os.getenv("QUOTA_MAX_WAIT_BACKGROUND", 0.5)),
+}
+
+#the daily quota resets at midnight pacific time
+try:
+    from zoneinfo import ZoneInfo
+    QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+except Exception:
+    #no tz database (e.g. windows without tzdata), pacific standard time is close enough
+    QUOTA_TIMEZONE = datetime.timezone(datetime.timedelta(hours=-8))
+
+
+def get_quota_day() -> str:
+    return datetime.datetime.now(QUOTA_TIMEZONE).date().isoformat()
+
+
+def get_quota_cost(method: str) -> int:
+    return QUOTA_COSTS.get(method, 1)
+
+
+#calls are rate limited per cost class so a burst of 100 unit searches can't drain the day
+def get_cost_class(method: str) -> str:
+    cost = get_quota_cost(method)
+    if cost >= 100:
+        return "search"
+    if cost > 1:
+        return "write"
+    return "read"
+
+
+#raised instead of calling the api when the budget or rate limit says no,
+#callers behind the response cache get stale data instead
+class QuotaExhausted(Exception):
+    pass
+
+
+#refills at rate tokens per second up to capacity
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        #interactive callers currently waiting, background callers step aside while this is non-zero
+        self.interactive_waiting = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self) -> bool:
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self) -> float:
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+#calls per second and burst size for each cost class
+buckets = {
+    "search": TokenBucket(float(os.getenv("QUOTA_RATE_SEARCH", 1)), float(os.getenv("QUOTA_BURST_SEARCH", 5))),
+    "read": TokenBucket(float(os.getenv("QUOTA_RATE_READ", 20)), float(os.getenv("QUOTA_BURST_READ", 50))),
+    "write": TokenBucket(float(os.getenv("QUOTA_RATE_WRITE", 1)), float(os.getenv("QUOTA_BURST_WRITE", 5))),
+}
+
+
+#running count of quota units spent today, per api method
+class QuotaUsage:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.day = get_quota_day()
+        self.units = 0
+        self.calls: dict[str, int] = {}
+        self.units_by_method: dict[str, int] = {}
+        #set when google answered quotaExceeded, nothing else is sent until the day rolls over
+        self.exhausted = False
+
+    #caller must hold the lock
+    def roll_over(self):
+        today = get_quota_day()
+        if today != self.day:
+            logger.info(f"Quota day {self.day} ended with {self.units} units used")
+            self.day = today
+            self.units = 0
+            self.calls = {}
+            self.units_by_method = {}
+            self.exhausted = False
+
+    #most units a call of this priority may bring the day's total up to
+    def limit_for(self, priority: str) -> int:
+        if priority == INTERACTIVE:
+            return QUOTA_DAILY_BUDGET
+        return int(QUOTA_DAILY_BUDGET * (1 - QUOTA_INTERACTIVE_RESERVE))
+
+    def check(self, method: str, priority: str):
+        cost = get_quota_cost(method)
+        with self.lock:
+            self.roll_over()
+            if self.exhausted:
+                raise QuotaExhausted("YouTube API daily quota exhausted")
+            if self.units + cost > self.limit_for(priority):
+                raise QuotaExhausted(f"YouTube API daily budget reached for {priority} calls")
+
+    def mark_exhausted(self):
+        with self.lock:
+            self.roll_over()
+            if not self.exhausted:
+                logger.warning(f"YouTube API reported quota exceeded after {self.units} units today")
+            self.exhausted = True
+
+    def record(self, method: str, units: Optional[int] = None) -> int:
+        units = get_quota_cost(method) if units is None else units
+        with self.lock:
+            self.roll_over()
+            self.units += units
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.units_by_method[method] = self.units_by_method.get(method, 0) + units
+            return self.units
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            self.roll_over()
+            return {
+                "day": self.day,
+                "units": self.units,
+                "calls": dict(self.calls),
+                "units_by_method": dict(self.units_by_method),
+                "budget": QUOTA_DAILY_BUDGET,
+                "remaining": max(0, QUOTA_DAILY_BUDGET - self.units),
+                "exhausted": self.exhausted,
+            }
+
+
+quota_usage = QuotaUsage()
+
+
+def record_quota(method: str, units: Optional[int] = None) -> int:
+    return quota_usage.record(method, units)
+
+
+def get_quota_usage() -> dict:
+    return quota_usage.snapshot()
+
+
+#wait for a rate limit token and reserve the call's units against today's budget
+#background calls only get a token when no interactive call is waiting for one,
+#and give up quickly so the response cache can serve what it already has
+async def acquire_quota(method: str):
+    level = get_quota_level()
+    quota_usage.check(method, level)
+    bucket = buckets[get_cost_class(method)]
+    deadline = time.monotonic() + QUOTA_MAX_WAIT.get(level, 0)
+
+    if level == INTERACTIVE:
+        bucket.interactive_waiting += 1
+    try:
+        while True:
+            if (level == INTERACTIVE or bucket.interactive_waiting == 0) and bucket.try_take():
+                break
+            wait = max(bucket.wait_time(), 0.01)
+            if time.monotonic() + wait > deadline:
+                raise QuotaExhausted(f"YouTube API rate limit reached for {method}")
+            await asyncio.sleep(wait)
+    finally:
+        if level == INTERACTIVE:
+            bucket.interactive_waiting -= 1
+
+    #check again, other calls may have spent the budget while this one waited
+    quota_usage.check(method, level)
+    record_quota(method)
+
+
+#google answers 403 with reason quotaExceeded once the project's daily quota is gone
+def check_quota_response(response):
+    if response.status_code != 403:
+        return
+    try:
+        errors = response.json().get("error", {}).get("errors", [])
+    except ValueError:
+        return
+    if any(error.get("reason") in ("quotaExceeded", "dailyLimitExceeded") for error in errors):
+        quota_usage.mark_exhausted()
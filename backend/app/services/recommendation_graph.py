@@ -0,0 +1,401 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import struct
+import time
+from array import array
+from collections import OrderedDict, deque
+from typing import Iterable, List, Optional
+
+from cache.data_dir import get_data_path
+from cache.track_index import track_index
+from models import SearchResult
+from services.metrics_service import register_stats
+from services.scheduler import scheduler, BACKGROUND
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#serve /api/recommendation from a graph built out of what the backend already sees,
+#RECOMMENDATION_GRAPH_ENABLED=0 asks the api for every seed again
+RECOMMENDATION_GRAPH_ENABLED = os.getenv("RECOMMENDATION_GRAPH_ENABLED", "1") != "0"
+#tracks kept in the graph, the one touched longest ago is dropped to make room
+RECOMMENDATION_GRAPH_MAX_NODES = int(os.getenv("RECOMMENDATION_GRAPH_MAX_NODES", 50_000))
+#neighbors kept per track, strongest first
+RECOMMENDATION_GRAPH_NEIGHBORS = int(os.getenv("RECOMMENDATION_GRAPH_NEIGHBORS", 40))
+#seconds between folding new edges into the neighbor lists
+RECOMMENDATION_GRAPH_UPDATE_INTERVAL = int(os.getenv("RECOMMENDATION_GRAPH_UPDATE_INTERVAL", 5))
+#seconds between saves of the graph to the data dir
+RECOMMENDATION_GRAPH_SAVE_INTERVAL = int(os.getenv("RECOMMENDATION_GRAPH_SAVE_INTERVAL", 10*60))
+#tracks returned for a seed and how many the graph needs before the api is skipped
+RECOMMENDATION_COUNT = int(os.getenv("RECOMMENDATION_COUNT", 30))
+RECOMMENDATION_MIN_LOCAL = int(os.getenv("RECOMMENDATION_MIN_LOCAL", 10))
+
+#edge weights per signal
+#plays in one listening session, divided by how many plays apart the two were
+SESSION_WEIGHT = 3.0
+#tracks near each other in a playlist or the liked list, divided by their distance
+PLAYLIST_WEIGHT = 1.0
+#what the api recommended for a seed by shared tags and from the seed's channel
+TAG_WEIGHT = 1.0
+CHANNEL_WEIGHT = 0.5
+
+#a gap longer than this between two plays starts a new session
+SESSION_GAP = 30*60
+#clients whose listening session is kept, the one that played longest ago is dropped first
+SESSION_CLIENTS = 1000
+#earlier plays (or playlist items) a track is linked to
+CO_OCCURRENCE_WINDOW = 5
+#most recent tracks remembered per channel, used to fill up short neighbor lists
+CHANNEL_MEMBERS = 50
+#tracks that are folded per step before the update yields to the event loop
+FOLD_CHUNK = 64
+
+
+#top-n neighbor graph over video ids, stored as id-indexed arrays:
+#a slot per track, neighbor lists as packed (generation << 32 | slot) refs with float weights
+#slots are reused after eviction, the generation tells a stale ref from the slot's new track
+#runs on the event loop only, new edges collect in pending and are folded in the background
+class RecommendationGraph:
+    def __init__(self, path: str, max_nodes: int, neighbor_limit: int):
+        self.path = path
+        self.max_nodes = max_nodes
+        self.neighbor_limit = neighbor_limit
+        #video id -> slot, oldest touch first
+        self.slots: OrderedDict[str, int] = OrderedDict()
+        self.video_ids: list[Optional[str]] = []
+        self.channels: list[Optional[str]] = []
+        self.generations = array("L")
+        self.neighbors: list[Optional[array]] = []
+        self.weights: list[Optional[array]] = []
+        self.free: list[int] = []
+        #channel -> refs of its most recent tracks
+        self.members: OrderedDict[str, array] = OrderedDict()
+        #slot -> {ref: weight} not yet folded into the neighbor lists
+        self.pending: dict[int, dict[int, float]] = {}
+        #client id -> its recent plays as (slot ref, played at), least recently playing client first
+        self.sessions: OrderedDict[str, deque] = OrderedDict()
+        #lists already linked, a synced playlist that didn't change adds nothing
+        self.seen_lists: OrderedDict[int, None] = OrderedDict()
+        self.updater: Optional[asyncio.Task] = None
+        #set once the saved graph is loaded, plays and lookups before that are left to the api
+        self.ready = False
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        self.local_hits = 0
+        self.cold_seeds = 0
+
+    def ref(self, slot: int) -> int:
+        return self.generations[slot] << 32 | slot
+
+    def resolve(self, ref: int) -> Optional[int]:
+        slot = ref & 0xFFFFFFFF
+        if slot < len(self.generations) and self.generations[slot] == ref >> 32 and self.video_ids[slot] is not None:
+            return slot
+        return None
+
+    #slot of a track, added (evicting the least recently touched one when full) if new
+    def node(self, video_id: str, channel: Optional[str] = None) -> int:
+        slot = self.slots.get(video_id)
+        if slot is None:
+            if len(self.slots) >= self.max_nodes:
+                self.evict()
+            if self.free:
+                slot = self.free.pop()
+                self.video_ids[slot] = video_id
+            else:
+                slot = len(self.video_ids)
+                self.video_ids.append(video_id)
+                self.channels.append(None)
+                self.generations.append(0)
+                self.neighbors.append(None)
+                self.weights.append(None)
+            self.slots[video_id] = slot
+        else:
+            self.slots.move_to_end(video_id)
+        if channel and self.channels[slot] != channel:
+            self.channels[slot] = channel
+            self.add_member(channel, slot)
+        return slot
+
+    def evict(self):
+        _, slot = self.slots.popitem(last=False)
+        self.video_ids[slot] = None
+        self.channels[slot] = None
+        self.neighbors[slot] = None
+        self.weights[slot] = None
+        self.pending.pop(slot, None)
+        #every ref still pointing at the slot is stale from here on
+        self.generations[slot] += 1
+        self.free.append(slot)
+
+    def add_member(self, channel: str, slot: int):
+        refs = self.members.pop(channel, array("q"))
+        refs = refs[-(CHANNEL_MEMBERS - 1):] + array("q", [self.ref(slot)])
+        self.members[channel] = refs
+        if len(self.members) > self.max_nodes // 4:
+            self.members.popitem(last=False)
+
+    def add_edge(self, a: int, b: int, weight: float):
+        if a == b:
+            return
+        a_edges = self.pending.setdefault(a, {})
+        a_edges[self.ref(b)] = a_edges.get(self.ref(b), 0.0) + weight
+        b_edges = self.pending.setdefault(b, {})
+        b_edges[self.ref(a)] = b_edges.get(self.ref(a), 0.0) + weight
+        self.dirty = True
+
+    #what the api recommended for a seed, from its tags or its channel
+    def add_related(self, video_id: str, channel: Optional[str], results: List[SearchResult], weight: float):
+        if not self.ready:
+            return
+        seed = self.node(video_id, channel)
+        for result in results:
+            self.add_edge(seed, self.node(result.id, result.channel), weight)
+
+    #link a track to the plays before it in the same client's listening session
+    #plays without a client id only add the track, they can't be told apart from other users' plays
+    def record_play(self, video_id: str, channel: Optional[str] = None, client: Optional[str] = None):
+        if not self.ready:
+            return
+        slot = self.node(video_id, channel)
+        if client is None:
+            return
+        now = time.time()
+        session = self.sessions.pop(client, None)
+        if session is None or (session and now - session[-1][1] > SESSION_GAP):
+            session = deque(maxlen=CO_OCCURRENCE_WINDOW)
+        self.sessions[client] = session
+        if len(self.sessions) > SESSION_CLIENTS:
+            self.sessions.popitem(last=False)
+        if session and self.resolve(session[-1][0]) == slot:
+            return
+        for distance, (ref, _) in enumerate(reversed(session), start=1):
+            other = self.resolve(ref)
+            if other is not None:
+                self.add_edge(slot, other, SESSION_WEIGHT / distance)
+        session.append((self.ref(slot), now))
+
+    #link tracks that sit close together in a playlist, given as (video id, channel) pairs
+    def record_playlist(self, items: Iterable[tuple[str, Optional[str]]]):
+        if not self.ready:
+            return
+        #a list bigger than the graph would evict its own first tracks while being linked
+        items = list(items)[:self.max_nodes // 2]
+        key = hash(tuple(video_id for video_id, _ in items))
+        if key in self.seen_lists:
+            return
+        self.seen_lists[key] = None
+        if len(self.seen_lists) > 1000:
+            self.seen_lists.popitem(last=False)
+        #newest tracks are at the front of liked lists, walk from the back so they stay in the graph
+        slots = [self.node(video_id, channel) for video_id, channel in reversed(items)]
+        for index, slot in enumerate(slots):
+            for distance in range(1, CO_OCCURRENCE_WINDOW + 1):
+                if index - distance < 0:
+                    break
+                self.add_edge(slot, slots[index - distance], PLAYLIST_WEIGHT / distance)
+
+    #merge a track's pending edges into its neighbor list and keep the strongest ones
+    def fold(self, slot: int):
+        edges = self.pending.pop(slot, {})
+        if self.neighbors[slot] is not None:
+            for ref, weight in zip(self.neighbors[slot], self.weights[slot]):
+                edges[ref] = edges.get(ref, 0.0) + weight
+        strongest = heapq.nlargest(
+            self.neighbor_limit,
+            ((weight, ref) for ref, weight in edges.items() if self.resolve(ref) is not None),
+        )
+        self.neighbors[slot] = array("q", [ref for _, ref in strongest])
+        self.weights[slot] = array("f", [weight for weight, _ in strongest])
+
+    async def fold_pending(self):
+        for index, slot in enumerate(list(self.pending)):
+            if slot in self.pending:
+                self.fold(slot)
+            if index % FOLD_CHUNK == FOLD_CHUNK - 1:
+                await asyncio.sleep(0)
+
+    #a seed is cold until it has edges of its own, channel members alone don't count
+    async def recommend(self, video_id: str, count: int) -> List[SearchResult]:
+        if not self.ready:
+            return []
+        slot = self.slots.get(video_id)
+        if slot is None:
+            return []
+        if slot in self.pending:
+            self.fold(slot)
+        if not self.neighbors[slot]:
+            return []
+        self.slots.move_to_end(video_id)
+
+        picked = [slot]
+        for ref in self.neighbors[slot]:
+            other = self.resolve(ref)
+            if other is not None and other not in picked:
+                picked.append(other)
+        channel = self.channels[slot]
+        if channel in self.members:
+            for ref in reversed(self.members[channel]):
+                other = self.resolve(ref)
+                if other is not None and other not in picked:
+                    picked.append(other)
+        #tracks only known from a playlist have no duration yet, ask for a few extra
+        video_ids = [self.video_ids[other] for other in picked[1:count * 2 + 1]]
+        return (await track_index.get_tracks(video_ids, with_duration=True))[:count]
+
+    #shallow copies only, neighbor and member arrays are replaced rather than changed in place
+    #so the write thread can serialise them while the loop keeps updating the graph
+    def snapshot(self) -> tuple:
+        return (
+            list(self.slots.values()),
+            list(self.video_ids),
+            list(self.channels),
+            array("q", self.generations),
+            list(self.neighbors),
+            list(self.weights),
+            list(self.members.items()),
+        )
+
+    #file is a json header (slots in recency order, video ids and channels per slot) followed by
+    #the raw arrays, each section prefixed with its length
+    def write(self, snapshot: tuple):
+        order, video_ids, channels, generations, neighbors, weights, members = snapshot
+        header = {"version": 1, "order": order, "video_ids": video_ids, "channels": channels,
+                  "member_channels": [channel for channel, _ in members]}
+        sections = [
+            json.dumps(header).encode(),
+            generations.tobytes(),
+            array("I", [len(refs) if refs is not None else 0 for refs in neighbors]).tobytes(),
+            b"".join(refs.tobytes() for refs in neighbors if refs),
+            b"".join(values.tobytes() for values in weights if values),
+            array("I", [len(refs) for _, refs in members]).tobytes(),
+            b"".join(refs.tobytes() for _, refs in members),
+        ]
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "wb") as file:
+                for section in sections:
+                    file.write(struct.pack("<Q", len(section)))
+                    file.write(section)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Could not save recommendation graph: {str(e)}")
+
+    #snapshot on the loop, serialise and write the file on a background slot
+    async def save(self):
+        await self.fold_pending()
+        snapshot = self.snapshot()
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        try:
+            await scheduler.run(self.write, snapshot, priority=BACKGROUND)
+        except Exception:
+            self.dirty = True
+            raise
+
+    #runs in a worker thread before the graph is ready, nothing else touches it meanwhile
+    def read(self):
+        try:
+            with open(self.path, "rb") as file:
+                data = file.read()
+            sections = []
+            offset = 0
+            while offset < len(data):
+                (length,) = struct.unpack_from("<Q", data, offset)
+                sections.append(data[offset + 8:offset + 8 + length])
+                offset += 8 + length
+            header = json.loads(sections[0])
+            generations = array("q")
+            generations.frombytes(sections[1])
+            degrees, refs, weights = array("I"), array("q"), array("f")
+            degrees.frombytes(sections[2])
+            refs.frombytes(sections[3])
+            weights.frombytes(sections[4])
+            member_counts, member_refs = array("I"), array("q")
+            member_counts.frombytes(sections[5])
+            member_refs.frombytes(sections[6])
+            video_ids, channels = header["video_ids"], header["channels"]
+            if not len(video_ids) == len(channels) == len(generations) == len(degrees) or sum(degrees) != len(refs):
+                raise ValueError("sections don't match")
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, IndexError, struct.error) as e:
+            logger.error(f"Could not load recommendation graph: {str(e)}")
+            return
+
+        neighbors, neighbor_weights = [], []
+        offset = 0
+        for degree in degrees:
+            neighbors.append(refs[offset:offset + degree] if video_ids[len(neighbors)] is not None else None)
+            neighbor_weights.append(weights[offset:offset + degree] if neighbors[-1] is not None else None)
+            offset += degree
+        offset = 0
+        for channel, count in zip(header["member_channels"], member_counts):
+            self.members[channel] = member_refs[offset:offset + count]
+            offset += count
+        self.video_ids = video_ids
+        self.channels = channels
+        self.generations = array("L", generations)
+        self.neighbors = neighbors
+        self.weights = neighbor_weights
+        self.slots = OrderedDict((video_ids[slot], slot) for slot in header["order"])
+        self.free = [slot for slot, video_id in enumerate(video_ids) if video_id is None]
+        #the node limit may have been lowered since the file was written
+        while len(self.slots) > self.max_nodes:
+            self.evict()
+        logger.info(f"Loaded recommendation graph with {len(self.slots)} tracks")
+
+    async def load(self):
+        try:
+            await asyncio.to_thread(self.read)
+        finally:
+            self.ready = True
+
+    async def update_loop(self):
+        await self.load()
+        while True:
+            await asyncio.sleep(RECOMMENDATION_GRAPH_UPDATE_INTERVAL)
+            try:
+                await self.fold_pending()
+                if self.dirty and time.monotonic() - self.saved_at > RECOMMENDATION_GRAPH_SAVE_INTERVAL:
+                    await self.save()
+            except Exception as e:
+                logger.error(f"Recommendation graph update failed: {str(e)}")
+
+    #called from the app lifespan, the saved graph is loaded in the background
+    def start(self):
+        if self.updater is None:
+            self.updater = asyncio.get_running_loop().create_task(self.update_loop())
+
+    def shutdown(self):
+        if self.updater is not None:
+            self.updater.cancel()
+            self.updater = None
+        if self.ready and self.dirty:
+            for slot in list(self.pending):
+                self.fold(slot)
+            self.write(self.snapshot())
+
+    def stats(self) -> dict:
+        return {
+            "tracks": len(self.slots),
+            "edges": sum(len(neighbors) for neighbors in self.neighbors if neighbors is not None),
+            "pending": len(self.pending),
+            "channels": len(self.members),
+            "sessions": len(self.sessions),
+            "local_hits": self.local_hits,
+            "cold_seeds": self.cold_seeds,
+        }
+
+
+#the graph answers from the track index, without it there is nothing to serve
+recommendation_graph = RecommendationGraph(
+    get_data_path("recommendation_graph.bin"),
+    max_nodes=RECOMMENDATION_GRAPH_MAX_NODES,
+    neighbor_limit=RECOMMENDATION_GRAPH_NEIGHBORS,
+) if RECOMMENDATION_GRAPH_ENABLED and track_index else None
+if recommendation_graph:
+    register_stats("recommendation_graph", recommendation_graph.stats)
@@ -0,0 +1,261 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Optional
+
+from services.metrics_service import register_executor, register_stats
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#priority classes, highest first
+#playback: the stream url a user is waiting on to start or keep playing
+#interactive: things a user clicked on (batch info for a queue)
+#background: prefetch and warm-up, only runs on slots nothing else wants
+#bulk: downloads, long jobs with slots of their own
+PLAYBACK = "playback"
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+BULK = "bulk"
+PRIORITIES = (PLAYBACK, INTERACTIVE, BACKGROUND, BULK)
+
+#bulk jobs run for minutes, they count against their own limit instead of the shared capacity
+DEDICATED = (BULK,)
+
+#priority of the blocking work started from the current task, inherited by tasks it spawns
+work_priority: contextvars.ContextVar[str] = contextvars.ContextVar("work_priority", default=INTERACTIVE)
+
+#extractions in threads mostly wait on the network, so without the worker pool there are
+#more slots than cores (enough for a full info batch next to a few plays)
+SCHEDULER_THREAD_CAPACITY = int(os.getenv("SCHEDULER_THREAD_CAPACITY", 16))
+#jobs (extractions in the worker pool or in threads) running at once across the shared classes,
+#one per worker process when the pool is on (its settings are read here rather than imported,
+#the pool's worker processes import this module)
+SCHEDULER_CAPACITY = int(os.getenv(
+    "SCHEDULER_CAPACITY",
+    int(os.getenv("EXTRACTION_WORKERS", os.cpu_count() or 2))
+    if os.getenv("EXTRACTION_POOL_ENABLED", "1") != "0" else SCHEDULER_THREAD_CAPACITY,
+))
+#shared slots only playback may take, so a play never waits behind a full queue of other work
+SCHEDULER_PLAYBACK_RESERVE = int(os.getenv("SCHEDULER_PLAYBACK_RESERVE", 1))
+#jobs of each class running at once
+SCHEDULER_LIMITS = {
+    PLAYBACK: int(os.getenv("SCHEDULER_LIMIT_PLAYBACK", SCHEDULER_CAPACITY)),
+    INTERACTIVE: int(os.getenv("SCHEDULER_LIMIT_INTERACTIVE", SCHEDULER_CAPACITY)),
+    BACKGROUND: int(os.getenv("SCHEDULER_LIMIT_BACKGROUND", max(1, SCHEDULER_CAPACITY // 2))),
+    BULK: int(os.getenv("SCHEDULER_LIMIT_BULK", 4)),
+}
+#seconds a job may wait for a slot before it is rejected, 0 rejects unless a slot is free
+#right away and a negative value waits as long as it takes
+SCHEDULER_MAX_WAIT = {
+    PLAYBACK: float(os.getenv("SCHEDULER_MAX_WAIT_PLAYBACK", 30)),
+    INTERACTIVE: float(os.getenv("SCHEDULER_MAX_WAIT_INTERACTIVE", 10)),
+    BACKGROUND: float(os.getenv("SCHEDULER_MAX_WAIT_BACKGROUND", 2)),
+    BULK: float(os.getenv("SCHEDULER_MAX_WAIT_BULK", -1)),
+}
+
+
+#raised when a job waited longer than its class allows, routes answer 503
+class SchedulerBusy(Exception):
+    pass
+
+
+#a job waiting for a slot, its priority can be raised while it waits
+class Ticket:
+    def __init__(self, priority: str, seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.admitted: Optional[asyncio.Future] = None
+
+    def rank(self) -> tuple:
+        return PRIORITIES.index(self.priority), self.seq
+
+
+#hands out slots for blocking work by priority class, one instance for the whole app
+#waiting jobs are admitted highest class first, then oldest first, within the class limits
+class PriorityScheduler:
+    def __init__(self, capacity: int, reserve: int, limits: dict[str, int], max_wait: dict[str, float]):
+        self.capacity = capacity
+        self.reserve = min(reserve, max(0, capacity - 1))
+        self.limits = dict(limits)
+        self.max_wait = dict(max_wait)
+        self.running = {level: 0 for level in PRIORITIES}
+        self.admitted = {level: 0 for level in PRIORITIES}
+        self.rejected = {level: 0 for level in PRIORITIES}
+        self.waiting: list[Ticket] = []
+        self.counter = itertools.count()
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.executor_lock = threading.Lock()
+        #loop the slots are handed out on, releases from threads are sent to it
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    #set a class limit or wait before the first job of that class runs
+    def configure(self, priority: str, limit: Optional[int] = None, max_wait: Optional[float] = None):
+        if limit is not None:
+            self.limits[priority] = limit
+        if max_wait is not None:
+            self.max_wait[priority] = max_wait
+
+    #called from the app lifespan once every module has configured its class
+    def start(self):
+        limits = ", ".join(f"{level}={self.limits[level]}" for level in PRIORITIES)
+        logger.info(f"Scheduler capacity {self.capacity} (playback reserve {self.reserve}), limits {limits}")
+
+    #one thread per slot, so admitted work never queues again inside the executor
+    def get_executor(self) -> ThreadPoolExecutor:
+        with self.executor_lock:
+            if self.executor is None:
+                workers = self.capacity + sum(self.limits[level] for level in DEDICATED)
+                self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scheduler")
+                register_executor("scheduler", self.executor)
+            return self.executor
+
+    def shared_running(self) -> int:
+        return sum(count for level, count in self.running.items() if level not in DEDICATED)
+
+    def can_start(self, priority: str) -> bool:
+        if self.running[priority] >= self.limits[priority]:
+            return False
+        if priority in DEDICATED:
+            return True
+        free = self.capacity - self.shared_running()
+        if priority == PLAYBACK:
+            return free > 0
+        return free > self.reserve
+
+    def admit(self, ticket: Ticket):
+        self.running[ticket.priority] += 1
+        self.admitted[ticket.priority] += 1
+
+    #admit waiting jobs in priority order, a class held back by the shared capacity also holds
+    #back every class below it so lower work can't take the slot a higher job is waiting for
+    def dispatch(self):
+        capacity_blocked = False
+        for ticket in sorted(self.waiting, key=Ticket.rank):
+            if capacity_blocked and ticket.priority not in DEDICATED:
+                continue
+            if self.can_start(ticket.priority):
+                self.waiting.remove(ticket)
+                self.admit(ticket)
+                ticket.admitted.set_result(True)
+            elif ticket.priority not in DEDICATED and self.running[ticket.priority] < self.limits[ticket.priority]:
+                capacity_blocked = True
+
+    def release(self, priority: str):
+        self.running[priority] -= 1
+        self.dispatch()
+
+    def release_threadsafe(self, priority: str):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.release, priority)
+
+    def ticket(self, priority: Optional[str] = None) -> Ticket:
+        return Ticket(priority or work_priority.get(), next(self.counter))
+
+    #a playback request joined work queued at a lower class, move it up
+    #work that already has its slot keeps its class so the slot is returned to the right one
+    def promote(self, ticket: Ticket, priority: str):
+        if PRIORITIES.index(priority) >= PRIORITIES.index(ticket.priority):
+            return
+        if ticket.admitted is not None and ticket.admitted.done():
+            return
+        ticket.priority = priority
+        if ticket in self.waiting:
+            self.dispatch()
+
+    def deadline(self, ticket: Ticket) -> float:
+        max_wait = self.max_wait.get(ticket.priority, 0)
+        return float("inf") if max_wait < 0 else ticket.enqueued_at + max_wait
+
+    async def acquire(self, ticket: Ticket):
+        self.loop = asyncio.get_running_loop()
+        ticket.admitted = self.loop.create_future()
+        self.waiting.append(ticket)
+        self.dispatch()
+        try:
+            #the deadline moves when the ticket is promoted, so wait in steps
+            while not ticket.admitted.done():
+                remaining = self.deadline(ticket) - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(asyncio.shield(ticket.admitted), None if remaining == float("inf") else remaining)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            #admitted at the same moment the caller was cancelled, hand the slot back
+            if ticket.admitted.done() and not ticket.admitted.cancelled():
+                self.release(ticket.priority)
+            raise
+        finally:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+
+        if ticket.admitted.done() and not ticket.admitted.cancelled():
+            return
+        self.rejected[ticket.priority] += 1
+        if ticket.admitted.cancelled():
+            raise SchedulerBusy("Scheduler is shutting down")
+        raise SchedulerBusy(f"No slot for {ticket.priority} work within {self.max_wait[ticket.priority]}s")
+
+    #hold a slot for the block, for work that runs somewhere else (the extraction worker pool)
+    @asynccontextmanager
+    async def slot(self, priority: Optional[str] = None, ticket: Optional[Ticket] = None):
+        ticket = ticket or self.ticket(priority)
+        await self.acquire(ticket)
+        try:
+            yield
+        finally:
+            self.release(ticket.priority)
+
+    #run a blocking function on the shared threads once its class gets a slot, the slot is
+    #held until the function returns even if the caller stops waiting for it
+    async def run(self, fn: Callable, *args, priority: Optional[str] = None, ticket: Optional[Ticket] = None):
+        ticket = ticket or self.ticket(priority)
+        await self.acquire(ticket)
+        try:
+            future = self.get_executor().submit(fn, *args)
+        except Exception:
+            self.release(ticket.priority)
+            raise
+        future.add_done_callback(lambda _: self.release_threadsafe(ticket.priority))
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        for ticket in list(self.waiting):
+            if not ticket.admitted.done():
+                ticket.admitted.cancel()
+        with self.executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+    def stats(self) -> dict:
+        stats = {"capacity": self.capacity, "reserve": self.reserve}
+        for level in PRIORITIES:
+            stats[f"{level}_running"] = self.running[level]
+            stats[f"{level}_waiting"] = sum(1 for ticket in self.waiting if ticket.priority == level)
+            stats[f"{level}_admitted"] = self.admitted[level]
+            stats[f"{level}_rejected"] = self.rejected[level]
+        return stats
+
+
+#run the blocking work started inside the block at a different priority
+@contextmanager
+def prioritize(level: str):
+    token = work_priority.set(level)
+    try:
+        yield
+    finally:
+        work_priority.reset(token)
+
+
+scheduler = PriorityScheduler(SCHEDULER_CAPACITY, SCHEDULER_PLAYBACK_RESERVE, SCHEDULER_LIMITS, SCHEDULER_MAX_WAIT)
+register_stats("scheduler", scheduler.stats)
@@ -0,0 +1,263 @@
+import logging
+import os
+import re
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from cache.audio_cache import invalidate_audio_info, extract_audio_info_once
+from cache.segment_cache import segment_cache
+from services.http_client import get_http_client
+from services.youtube_service import get_audio_info
+from services.scheduler import prioritize, PLAYBACK
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#bytes asked from googlevideo per upstream request, larger unranged requests get throttled
+STREAM_UPSTREAM_CHUNK = int(os.getenv("STREAM_UPSTREAM_CHUNK", 10*1024*1024))
+#times one stream may re-extract an expired url before giving up
+STREAM_MAX_REFRESHES = int(os.getenv("STREAM_MAX_REFRESHES", 2))
+
+#googlevideo answers these once a signed url expired or got revoked
+EXPIRED_STATUSES = (403, 410)
+
+MEDIA_TYPES = {
+    "m4a": "audio/mp4",
+    "mp4": "audio/mp4",
+    "webm": "audio/webm",
+}
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+class RangeNotSatisfiable(Exception):
+    def __init__(self, total: int):
+        super().__init__(f"Range not satisfiable for {total} bytes")
+        self.total = total
+
+
+#parse a single "bytes=start-end" range, suffix ranges (bytes=-500) are kept as negative starts
+def parse_range_header(header: Optional[str]) -> Optional[tuple[int, Optional[int]]]:
+    if not header:
+        return None
+    match = RANGE_PATTERN.match(header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        #multiple or malformed ranges, serve the whole file like most servers do
+        return None
+    start, end = match.group(1), match.group(2)
+    if start == "":
+        return -int(end), None
+    return int(start), int(end) if end else None
+
+
+def get_total_size(response: httpx.Response) -> Optional[int]:
+    match = CONTENT_RANGE_PATTERN.match(response.headers.get("content-range", ""))
+    if match:
+        return int(match.group(3))
+    if response.status_code == 200 and "content-length" in response.headers:
+        return int(response.headers["content-length"])
+    return None
+
+
+#proxies one audio track from googlevideo in ranged chunks without buffering it,
+#re-extracting the url and resuming where it left off if the url dies mid-stream
+#bytes already in the segment cache are read from disk, new contiguous bytes are added to it
+class AudioStream:
+    def __init__(self, video_id: str, byte_range: Optional[tuple[int, Optional[int]]], segment: Optional[dict] = None):
+        self.video_id = video_id
+        self.byte_range = byte_range
+        self.segment = segment
+        self.url: str = ""
+        self.format: str = ""
+        self.total: int = 0
+        self.start: int = 0
+        self.end: int = 0
+        self.refreshes = 0
+        self.first_response: Optional[httpx.Response] = None
+
+    @property
+    def status_code(self) -> int:
+        return 206 if self.byte_range else 200
+
+    @property
+    def headers(self) -> dict:
+        headers = {
+            "Accept-Ranges": "bytes",
+            "Content-Length": str(self.end - self.start + 1),
+            "Cache-Control": "no-store",
+        }
+        if self.byte_range:
+            headers["Content-Range"] = f"bytes {self.start}-{self.end}/{self.total}"
+        return headers
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES.get(self.format, "application/octet-stream")
+
+    #playback is waiting on this, it goes ahead of every other extraction
+    async def load_info(self, refresh: bool = False):
+        with prioritize(PLAYBACK):
+            if refresh:
+                self.refreshes += 1
+                logger.info(f"Stream url for {self.video_id} expired, extracting a new one")
+                await invalidate_audio_info(self.video_id)
+                info = await extract_audio_info_once(self.video_id)
+            else:
+                info = await get_audio_info(self.video_id)
+        self.url = info["url"]
+        self.format = info.get("format", "")
+
+    #send a ranged request upstream, re-extracting once per expired url
+    async def request(self, start: int, end: int) -> httpx.Response:
+        if not self.url:
+            await self.load_info()
+        client = get_http_client()
+        while True:
+            request = client.build_request("GET", self.url, headers={"Range": f"bytes={start}-{end}"})
+            response = await client.send(request, stream=True)
+            if response.status_code in EXPIRED_STATUSES and self.refreshes < STREAM_MAX_REFRESHES:
+                await response.aclose()
+                await self.load_info(refresh=True)
+                continue
+            if response.status_code not in (200, 206) or (response.status_code == 200 and start > 0):
+                await response.aclose()
+                raise Exception(f"Upstream returned {response.status_code} for range {start}-{end}")
+            return response
+
+    #turn the requested range into absolute start/end offsets within total
+    def settle_range(self):
+        start, end = self.byte_range if self.byte_range else (0, None)
+        if start < 0:
+            start = max(0, self.total + start)
+        end = self.total - 1 if end is None else min(end, self.total - 1)
+        if start >= self.total or start > end:
+            raise RangeNotSatisfiable(self.total)
+        self.start, self.end = start, end
+
+    #resolve the url, learn the total size and settle the byte range before any body is sent
+    async def open(self):
+        if self.segment:
+            self.format = self.segment["format"]
+            self.total = self.segment["total"]
+            self.settle_range()
+            if self.end < self.segment["cached"]:
+                #the whole range is stored, upstream isn't touched
+                return
+            #the bytes after the stored prefix are asked for before any of it is sent, if upstream
+            #no longer serves a file of that size the prefix is dropped and the track streamed fresh
+            first_start = max(self.start, self.segment["cached"])
+        else:
+            first_start = max(self.byte_range[0], 0) if self.byte_range else 0
+
+        await self.load_info()
+        response = await self.request(first_start, first_start + STREAM_UPSTREAM_CHUNK - 1)
+        total = get_total_size(response)
+        if total is None:
+            await response.aclose()
+            raise Exception("Upstream did not report the stream size")
+        if self.segment and total != self.segment["total"]:
+            #the stored prefix belongs to another format, forget it
+            await segment_cache.remove(self.segment["key"])
+            self.segment = None
+
+        if self.segment is None:
+            self.total = total
+            try:
+                self.settle_range()
+            except RangeNotSatisfiable:
+                await response.aclose()
+                raise
+            if self.start != first_start:
+                #suffix range, the first request guessed the wrong offset
+                await response.aclose()
+                response = await self.request(self.start, min(self.end, self.start + STREAM_UPSTREAM_CHUNK - 1))
+        self.first_response = response
+
+    async def body(self) -> AsyncIterator[bytes]:
+        position = self.start
+        response = self.first_response
+        self.first_response = None
+        writer = None
+        writer_opened = False
+        try:
+            while position <= self.end:
+                chunk_start = position
+                if self.segment and position < self.segment["cached"]:
+                    stop = min(self.end, self.segment["cached"] - 1)
+                    async for data in segment_cache.read(self.segment, position, stop):
+                        position += len(data)
+                        yield data
+                    if position == chunk_start:
+                        #blob is shorter than the index says, stop trusting it
+                        self.segment = None
+                        if response is not None:
+                            #it was asked for from the end of the prefix, not from here
+                            await response.aclose()
+                            response = None
+                    continue
+
+                if response is None:
+                    chunk_end = min(self.end, position + STREAM_UPSTREAM_CHUNK - 1)
+                    response = await self.request(position, chunk_end)
+                    if get_total_size(response) != self.total:
+                        #a refreshed url can point at a different format, resuming would corrupt the file
+                        #what is stored of the old one is dropped so the next play streams it fresh
+                        stale = writer.key if writer else self.segment["key"] if self.segment else None
+                        if writer:
+                            await writer.close()
+                            writer = None
+                        if stale:
+                            await segment_cache.remove(stale)
+                        raise Exception("Upstream stream changed size, cannot resume")
+                if segment_cache and not writer_opened:
+                    writer_opened = True
+                    writer = await segment_cache.open_writer(self.video_id, self.format, self.total)
+                try:
+                    async for data in response.aiter_bytes():
+                        data = data[:self.end - position + 1]
+                        if writer and not await writer.write(position, data):
+                            await writer.close()
+                            writer = None
+                        position += len(data)
+                        yield data
+                        if position > self.end:
+                            break
+                except httpx.TransportError as e:
+                    #connection dropped mid chunk, pick up from the current position
+                    if self.refreshes >= STREAM_MAX_REFRESHES:
+                        raise
+                    logger.info(f"Stream for {self.video_id} interrupted at {position}: {str(e)}")
+                    self.refreshes += 1
+                else:
+                    if position == chunk_start:
+                        #upstream answered with an empty body, asking again counts as a retry
+                        self.refreshes += 1
+                finally:
+                    await response.aclose()
+                    response = None
+                if position == chunk_start and self.refreshes >= STREAM_MAX_REFRESHES:
+                    raise Exception("Upstream stopped sending data")
+        finally:
+            if response is not None:
+                await response.aclose()
+            if writer:
+                await writer.close()
+
+
+#fully stored copy of a track, served straight from disk
+def get_cached_audio_file(segment: Optional[dict]) -> Optional[tuple[str, str]]:
+    if segment and segment["cached"] >= segment["total"]:
+        return segment_cache.blob_path(segment["key"]), MEDIA_TYPES.get(segment["format"], "application/octet-stream")
+    return None
+
+
+async def find_cached_segment(video_id: str) -> Optional[dict]:
+    return await segment_cache.lookup(video_id) if segment_cache else None
+
+
+async def open_audio_stream(video_id: str, range_header: Optional[str], segment: Optional[dict] = None) -> AudioStream:
+    stream = AudioStream(video_id, parse_range_header(range_header), segment)
+    await stream.open()
+    return stream
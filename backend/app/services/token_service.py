@@ -0,0 +1,316 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import time
+from typing import Optional
+
+from cache.data_dir import get_data_path
+from services.http_client import get_http_client, USERINFO_URL
+from services.metrics_service import register_stats
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+#google api client id and secret from .env
+GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
+GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
+GOOGLE_REDIRECT_URI = os.getenv("REDIRECT_URI")
+GOOGLE_TOKEN_URL = os.getenv("GOOGLE_TOKEN_URL", "https://accounts.google.com/o/oauth2/token")
+
+#access tokens are refreshed this many seconds before google expires them
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", 5*60))
+#seconds between checks for sessions about to expire
+TOKEN_REFRESH_INTERVAL = int(os.getenv("TOKEN_REFRESH_INTERVAL", 60))
+#only sessions used within this many seconds are refreshed ahead of time, idle ones on next use
+TOKEN_ACTIVE_WINDOW = int(os.getenv("TOKEN_ACTIVE_WINDOW", 24*3600))
+#earlier access tokens of a session still accepted from clients until google expires them
+MAX_ALIASES = 20
+#seconds a token -> user lookup is kept for tokens we didn't issue
+USER_INFO_TTL = int(os.getenv("USER_INFO_TTL", 50*60))
+
+
+#google turned down a code exchange or refresh, error is its oauth error code
+class TokenError(Exception):
+    def __init__(self, message: str, error: Optional[str] = None):
+        super().__init__(message)
+        self.error = error
+
+
+#everything we know about a logged in user, kept on the server so clients can keep sending
+#the session token they got at login and we swap in a fresh access token
+class TokenSession:
+    def __init__(self, user_id: str, access_token: str, expires_at: float, refresh_token: Optional[str],
+                 refresh_expires_at: Optional[float], user: dict, last_used: Optional[float] = None,
+                 aliases: Optional[dict] = None, handle: Optional[str] = None):
+        self.user_id = user_id
+        self.access_token = access_token
+        self.expires_at = expires_at
+        self.refresh_token = refresh_token
+        self.refresh_expires_at = refresh_expires_at
+        self.user = user
+        self.last_used = last_used or time.time()
+        #access tokens handed out earlier -> when google expires them, clients may send them until then
+        #(sessions saved before aliases had an expiry stored a plain list, those are dropped)
+        self.aliases: dict[str, float] = dict(aliases) if isinstance(aliases, dict) else {}
+        #opaque token we issue at login, stands for the session for as long as it can be refreshed
+        self.handle = handle or secrets.token_urlsafe(32)
+
+    def add_alias(self, access_token: str, expires_at: float):
+        self.aliases[access_token] = expires_at
+        while len(self.aliases) > MAX_ALIASES:
+            del self.aliases[next(iter(self.aliases))]
+
+    #a session whose refresh token is gone is only good until its last access token expires
+    def is_alive(self) -> bool:
+        return bool(self.refresh_token) or time.time() < self.expires_at
+
+    def needs_refresh(self) -> bool:
+        return bool(self.refresh_token) and time.time() > self.expires_at - TOKEN_REFRESH_MARGIN
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+class TokenService:
+    def __init__(self, state_path: str):
+        self.state_path = state_path
+        self.sessions: dict[str, TokenSession] = {}
+        #any access token we issued (current or earlier) -> user id
+        self.token_users: dict[str, str] = {}
+        #userinfo lookups for tokens that don't belong to a session, token -> (user info, looked up at)
+        self.user_infos: dict[str, tuple[dict, float]] = {}
+        #user id -> running refresh, so concurrent requests share one call to google
+        self.refreshing: dict[str, asyncio.Future] = {}
+        self.loaded = False
+        self.refresher: Optional[asyncio.Task] = None
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with open(self.state_path) as file:
+                saved = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load token sessions: {str(e)}")
+            return
+        for data in saved:
+            session = TokenSession(**data)
+            self.add_session(session)
+            self.prune_aliases(session)
+
+    #refresh tokens are secrets, the file is only readable by the user running the backend
+    def persist(self):
+        data = [session.to_dict() for session in self.sessions.values()]
+        tmp_path = f"{self.state_path}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as file:
+                json.dump(data, file)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            logger.error(f"Could not save token sessions: {str(e)}")
+
+    def add_session(self, session: TokenSession):
+        self.sessions[session.user_id] = session
+        self.token_users[session.access_token] = session.user_id
+        self.token_users[session.handle] = session.user_id
+        for alias in session.aliases:
+            self.token_users[alias] = session.user_id
+
+    def remove_aliases(self, session: TokenSession, aliases: list):
+        for alias in aliases:
+            session.aliases.pop(alias, None)
+            if self.token_users.get(alias) == session.user_id:
+                del self.token_users[alias]
+
+    #drop the earlier tokens google has expired, returns whether any were dropped
+    def prune_aliases(self, session: TokenSession) -> bool:
+        now = time.time()
+        expired = [alias for alias, expires_at in session.aliases.items() if now > expires_at]
+        self.remove_aliases(session, expired)
+        return bool(expired)
+
+    #the session handle leads to its session while that can still be refreshed, an earlier access
+    #token only until it expires, so one that leaked from a log can't be traded for fresh tokens
+    def get_session(self, access_token: str) -> Optional[TokenSession]:
+        self.load()
+        user_id = self.token_users.get(access_token)
+        session = self.sessions.get(user_id) if user_id else None
+        if session is None or access_token == session.access_token:
+            return session
+        if access_token == session.handle:
+            return session if session.is_alive() else None
+        if time.time() > session.aliases.get(access_token, 0):
+            self.remove_aliases(session, [access_token])
+            self.persist()
+            return None
+        return session
+
+    async def post_token(self, data: dict) -> dict:
+        response = await get_http_client().post(GOOGLE_TOKEN_URL, data={
+            "client_id": GOOGLE_CLIENT_ID,
+            "client_secret": GOOGLE_CLIENT_SECRET,
+            **data,
+        })
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        if response.status_code != 200 or "access_token" not in body:
+            message = body.get("error_description") or body.get("error") or f"Token endpoint answered {response.status_code}"
+            raise TokenError(message, body.get("error"))
+        return body
+
+    async def fetch_user_info(self, access_token: str) -> dict:
+        response = await get_http_client().get(USERINFO_URL, headers={"Authorization": f"Bearer {access_token}"})
+        response.raise_for_status()
+        return response.json()
+
+    #login callback: trade the code for tokens and remember the session
+    async def exchange_code(self, code: str) -> tuple[TokenSession, dict]:
+        self.load()
+        data = await self.post_token({
+            "code": code,
+            "redirect_uri": GOOGLE_REDIRECT_URI,
+            "grant_type": "authorization_code",
+        })
+        user_info = await self.fetch_user_info(data["access_token"])
+        now = time.time()
+        refresh_expires_in = data.get("refresh_token_expires_in")
+        session = TokenSession(
+            user_id=user_info["id"],
+            access_token=data["access_token"],
+            expires_at=now + data.get("expires_in", 3600),
+            refresh_token=data.get("refresh_token"),
+            refresh_expires_at=now + refresh_expires_in if refresh_expires_in else None,
+            user=user_info,
+        )
+        previous = self.sessions.get(session.user_id)
+        if previous:
+            #a second login on another device, tokens of the first one keep working
+            session.handle = previous.handle
+            session.aliases = dict(previous.aliases)
+            session.add_alias(previous.access_token, previous.expires_at)
+            self.prune_aliases(session)
+            session.refresh_token = session.refresh_token or previous.refresh_token
+        self.add_session(session)
+        self.persist()
+        return session, data
+
+    async def refresh(self, session: TokenSession) -> TokenSession:
+        future = self.refreshing.get(session.user_id)
+        if future is None:
+            future = asyncio.ensure_future(self.run_refresh(session))
+            self.refreshing[session.user_id] = future
+
+            def remove_refreshing(done: asyncio.Future):
+                if self.refreshing.get(session.user_id) is done:
+                    del self.refreshing[session.user_id]
+                if not done.cancelled():
+                    done.exception()
+
+            future.add_done_callback(remove_refreshing)
+        return await asyncio.shield(future)
+
+    async def run_refresh(self, session: TokenSession) -> TokenSession:
+        try:
+            data = await self.post_token({
+                "refresh_token": session.refresh_token,
+                "grant_type": "refresh_token",
+            })
+        except TokenError as e:
+            logger.warning(f"Token refresh for {session.user_id} failed: {str(e)}")
+            #google turned the refresh down, earlier tokens stop leading to this session
+            self.remove_aliases(session, list(session.aliases))
+            if e.error == "invalid_grant":
+                #revoked or expired refresh token, the user has to log in again
+                session.refresh_token = None
+            self.persist()
+            raise
+        session.add_alias(session.access_token, session.expires_at)
+        session.access_token = data["access_token"]
+        session.expires_at = time.time() + data.get("expires_in", 3600)
+        if data.get("refresh_token"):
+            session.refresh_token = data["refresh_token"]
+        self.add_session(session)
+        self.persist()
+        logger.info(f"Refreshed access token for {session.user_id}")
+        return session
+
+    #the token to send to google for a token a client sent us, refreshed first if it is about
+    #to expire; tokens we don't know are passed through unchanged
+    async def get_valid_token(self, access_token: str) -> str:
+        session = self.get_session(access_token)
+        if session is None:
+            return access_token
+        session.last_used = time.time()
+        if session.needs_refresh():
+            try:
+                session = await self.refresh(session)
+            except Exception as e:
+                logger.error(f"Using the old access token, refresh failed: {str(e)}")
+        return session.access_token
+
+    async def get_user_id(self, access_token: str) -> str:
+        session = self.get_session(access_token)
+        if session:
+            return session.user_id
+        cached = self.user_infos.get(access_token)
+        if cached and time.time() - cached[1] < USER_INFO_TTL:
+            return cached[0]["id"]
+        user_info = await self.fetch_user_info(access_token)
+        self.user_infos[access_token] = (user_info, time.time())
+        return user_info["id"]
+
+    #refresh active sessions ahead of expiry so requests never wait on google's token endpoint
+    async def refresh_loop(self):
+        while True:
+            await asyncio.sleep(TOKEN_REFRESH_INTERVAL)
+            now = time.time()
+            if any([self.prune_aliases(session) for session in self.sessions.values()]):
+                self.persist()
+            for session in list(self.sessions.values()):
+                if session.needs_refresh() and now - session.last_used < TOKEN_ACTIVE_WINDOW:
+                    try:
+                        await self.refresh(session)
+                    except Exception as e:
+                        logger.error(f"Background token refresh failed: {str(e)}")
+            for token, (_, looked_up_at) in list(self.user_infos.items()):
+                if now - looked_up_at > USER_INFO_TTL:
+                    del self.user_infos[token]
+
+    #called from the app lifespan
+    def start(self):
+        self.load()
+        if self.refresher is None:
+            self.refresher = asyncio.get_running_loop().create_task(self.refresh_loop())
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.sessions),
+            "refreshable": sum(1 for session in self.sessions.values() if session.refresh_token),
+            "refreshing": len(self.refreshing),
+            "user_infos": len(self.user_infos),
+        }
+
+    def shutdown(self):
+        if self.refresher is not None:
+            self.refresher.cancel()
+            self.refresher = None
+
+
+token_service = TokenService(get_data_path("auth_sessions.json"))
+register_stats("tokens", token_service.stats)
+
+
+async def get_valid_token(access_token: str) -> str:
+    return await token_service.get_valid_token(access_token)
+
+
+async def get_user_id(access_token: str) -> str:
+    return await token_service.get_user_id(access_token)
@@ -1,25 +1,88 @@
-import requests
+import asyncio
 import os
 import logging
 
 from fastapi import HTTPException
 from isodate import parse_duration
-from typing import List
+from typing import AsyncIterator, List, Optional
 
 from services.format_service import format_duration
-from cache.audio_cache import get_cached_audio_info, extract_audio_url_and_info
-from models import SearchResult, AudioInfo
+from services.http_client import get_http_client, YOUTUBE_API_URL
+from services.quota_service import acquire_quota, check_quota_response
+from services.scheduler import prioritize, BACKGROUND
+from services.metrics_service import register_stats
+from cache.response_cache import response_cache
+from cache.duration_cache import DurationBatcher, DURATION_CACHE_MAX_ENTRIES, DURATION_BATCH_WINDOW
+from cache.audio_cache import get_cached_audio_info, extract_audio_info_once
+from cache.track_index import track_index
+from services.recommendation_graph import (
+    recommendation_graph,
+    RECOMMENDATION_COUNT,
+    RECOMMENDATION_MIN_LOCAL,
+    TAG_WEIGHT,
+    CHANNEL_WEIGHT,
+)
+from models import SearchResult, BatchInfoResult
 
 #Get api key from .env
 YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
 
+#max extractions one /api/info/batch request runs at once
+BATCH_INFO_CONCURRENCY = int(os.getenv("BATCH_INFO_CONCURRENCY", 8))
+
+#seconds /api/recommendation waits for the channel and tag searches before answering with what it has
+RECOMMENDATION_TIMEOUT = float(os.getenv("RECOMMENDATION_TIMEOUT", 8))
+
+#answer /api/search from the local track index when it knows the query or has enough matches
+SEARCH_LOCAL_FIRST = os.getenv("SEARCH_LOCAL_FIRST", "1") != "0"
+#local matches needed to skip the api for a query it hasn't answered before
+SEARCH_LOCAL_MIN_RESULTS = int(os.getenv("SEARCH_LOCAL_MIN_RESULTS", 10))
+#seconds the ids an api search returned are reused for the same query
+SEARCH_LOCAL_MAX_AGE = int(os.getenv("SEARCH_LOCAL_MAX_AGE", 24*3600))
+SEARCH_MAX_RESULTS = 25
+
 #logger for logging errors
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+#GET on a YouTube Data API list resource, goes through the quota budget first
+async def youtube_api_get(resource: str, params: dict, timeout: float = 30, headers: Optional[dict] = None) -> dict:
+    await acquire_quota(f"{resource}.list")
+    response = await get_http_client().get(f"{YOUTUBE_API_URL}/{resource}", params=params, timeout=timeout, headers=headers)
+    check_quota_response(response)
+    response.raise_for_status()
+    return response.json()
+
+
+#contentDetails lookup for one batch of up to 50 ids, used by the duration batcher
+async def fetch_durations(video_ids: List[str]) -> dict:
+    details_params = {
+        "part": "contentDetails",
+        "id": ",".join(video_ids),
+        "key": YOUTUBE_API_KEY
+    }
+    details_data = await youtube_api_get("videos", details_params)
+    durations = {}
+    for item in details_data.get("items", []):
+        video_id = item.get("id")
+        if isinstance(video_id, str):
+            durations[video_id] = item.get("contentDetails", {}).get("duration", "PT0S")
+    return durations
+
+
+duration_batcher = DurationBatcher(
+    fetch_durations,
+    max_entries=DURATION_CACHE_MAX_ENTRIES,
+    window=DURATION_BATCH_WINDOW,
+)
+register_stats("video_durations", duration_batcher.stats)
+if track_index:
+    register_stats("track_index", track_index.stats)
+
+
 #function to process youtube search and return informtaion about each video
-def list_videos(data: dict) -> List[SearchResult]:
+async def list_videos(data: dict) -> List[SearchResult]:
     results = []
     videos_ids = []
     
@@ -33,23 +96,8 @@ def list_videos(data: dict) -> List[SearchResult]:
         if video_id:
             videos_ids.append(video_id)
         
-    #get additional video details i.e duration
-    details_url = "https://www.googleapis.com/youtube/v3/videos"
-    details_params = {
-        "part": "contentDetails",
-        "id": ",".join(videos_ids),
-        "key": YOUTUBE_API_KEY
-    }
-        
-    detail_response = requests.get(details_url, params=details_params, timeout=30)
-    detail_response.raise_for_status()
-    details_data = detail_response.json()
-    #lookup dict for details
-    details_lookup = {}
-    for item in details_data.get("items", []):
-        video_id = item.get("id")
-        if isinstance(video_id, str):
-            details_lookup[video_id] = item
+    #get additional video details i.e duration, only ids we haven't seen go to the api
+    durations = await duration_batcher.get_durations(videos_ids)
         
     for item in data["items"]:
         vid = item.get("id")
@@ -59,10 +107,9 @@ def list_videos(data: dict) -> List[SearchResult]:
             continue
         
         snippet = item.get("snippet", {})
-        details = details_lookup.get(video_id, {})
 
         #parse duration from ISO format to human readable format like 4:13
-        duration_iso = details.get("contentDetails",{}).get("duration", "PT0S")
+        duration_iso = durations.get(video_id, "PT0S")
         try:
             duration_full = parse_duration(duration_iso)   
             if duration_full.total_seconds() < 120: #skip if duration is less than 2 min
@@ -79,47 +126,105 @@ def list_videos(data: dict) -> List[SearchResult]:
             channel=snippet["channelTitle"]
         ))     
         
+    if track_index:
+        track_index.add_results(results)
     return results
 
 #funciton for getting audio url
-def get_audio_info(video_id: str) -> AudioInfo:
-    if cached := get_cached_audio_info(video_id):
+async def get_audio_info(video_id: str) -> dict:
+    if cached := await get_cached_audio_info(video_id):
         return cached
     try:
-        return extract_audio_url_and_info(video_id)
+        return await extract_audio_info_once(video_id)
 
     except Exception as e:
         logger.error(f"Error while gettting audio info {str(e)}")
         raise
 
+
+
+#resolve many tracks at once, yielding each result as soon as it is ready
+#cache hits come out first, misses are extracted concurrently under BATCH_INFO_CONCURRENCY
+async def get_audio_info_batch(video_ids: List[str]) -> AsyncIterator[BatchInfoResult]:
+    semaphore = asyncio.Semaphore(BATCH_INFO_CONCURRENCY)
+
+    async def resolve(video_id: str) -> BatchInfoResult:
+        try:
+            if cached := await get_cached_audio_info(video_id):
+                return BatchInfoResult(id=video_id, info=cached)
+            async with semaphore:
+                return BatchInfoResult(id=video_id, info=await get_audio_info(video_id))
+        except Exception as e:
+            return BatchInfoResult(id=video_id, error=str(e) or "Stream Info error")
+
+    tasks = [asyncio.ensure_future(resolve(video_id)) for video_id in dict.fromkeys(video_ids)]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            yield await next_result
+    finally:
+        #client went away, extractions already started still finish into the cache
+        for task in tasks:
+            task.cancel()
+
         
 #function forsearchiing in youtube
-def get_search_result(q: str) -> List[SearchResult]:
+async def get_search_result(q: str) -> List[SearchResult]:
     try:
-        search_url = "https://www.googleapis.com/youtube/v3/search"
         params = {
             "part": "snippet",
             "q": q,
             "type": "video",
-            "maxResults": 25,
+            "maxResults": SEARCH_MAX_RESULTS,
             "key": YOUTUBE_API_KEY,
             "videoCategoryId": "10", #music category
             "order": "relevance",
         }
         
-        response = requests.get(search_url, params=params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        return list_videos(data)
+        async def fetch():
+            data = await youtube_api_get("search", params)
+            results = await list_videos(data)
+            if track_index:
+                track_index.remember_search(q, results)
+            return results
+
+        return await response_cache.get_or_fetch("search", params, fetch)
          
     except Exception as e:
         logger.error(f"Search error: {str(e)}")
     
     
+#search that costs no quota when it can: a query the api answered recently or one the index
+#has enough matches for is served locally, fresh or long tail queries go to the api
+async def search_music(q: str, fresh: bool = False) -> List[SearchResult]:
+    if not track_index or not SEARCH_LOCAL_FIRST or fresh:
+        return await get_search_result(q)
+
+    local = await track_index.recall_search(q, SEARCH_LOCAL_MAX_AGE)
+    if not local:
+        matches = await track_index.match(q, SEARCH_MAX_RESULTS, prefix=False, with_duration=True)
+        local = matches if len(matches) >= SEARCH_LOCAL_MIN_RESULTS else None
+    if local:
+        track_index.hits += 1
+        return local
+
+    track_index.misses += 1
+    results = await get_search_result(q)
+    if not results:
+        #api failed or out of quota, whatever the index has beats nothing
+        return await track_index.match(q, SEARCH_MAX_RESULTS, prefix=False, with_duration=True)
+    return results
+
+
+#typeahead suggestions straight from the track index, the last word matches as a prefix
+async def get_suggestions(q: str, limit: int = 10) -> List[SearchResult]:
+    if not track_index:
+        return []
+    return await track_index.match(q, limit)
+
+
 #function for getting videos from the channel(helper function for music recommendation)
-def get_channel_videos(channelId: str) -> List[SearchResult]:
+async def get_channel_videos(channelId: str) -> List[SearchResult]:
     try:
-        url = f"https://www.googleapis.com/youtube/v3/search"
         params = {
             "part": "snippet",
             "channelId": channelId,
@@ -129,18 +234,19 @@ def get_channel_videos(channelId: str) -> List[SearchResult]:
             "videoCategoryId": "10",
             "key": YOUTUBE_API_KEY
         }
-        response = requests.get(url, params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        return list_videos(data)
+
+        async def fetch():
+            data = await youtube_api_get("search", params)
+            return await list_videos(data)
+
+        return await response_cache.get_or_fetch("channel_videos", params, fetch)
        
     except Exception as e:
         logger.error(f"Recommendation error {str(e)}")
 
 #function for getting similar videos based on tag(helper function for music recommendation)
-def get_same_tags_videos(filtered_tags: str) -> List[SearchResult]:
+async def get_same_tags_videos(filtered_tags: str) -> List[SearchResult]:
     try:
-        url = f"https://www.googleapis.com/youtube/v3/search"
         params = {
             "part": "snippet",
             "q": filtered_tags,
@@ -150,37 +256,106 @@ def get_same_tags_videos(filtered_tags: str) -> List[SearchResult]:
             "videoCategoryId": "10",
             "key": YOUTUBE_API_KEY
         }
-        response = requests.get(url, params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        
-        return list_videos(data)
+
+        async def fetch():
+            data = await youtube_api_get("search", params)
+            return await list_videos(data)
+
+        return await response_cache.get_or_fetch("same_tags_videos", params, fetch)
 
     except Exception as e:
         logger.error(f"Recommendation error {str(e)}")
 
 
-#function for returning similar videos to one being played
-def get_similar_videos(video_id: str) -> List[SearchResult]:
-    try:
-        url = f"https://www.googleapis.com/youtube/v3/videos"
+#video ids of a playlist in order, public playlists with the api key and private ones with
+#the user's token, 1 quota unit per 50 items
+async def get_playlist_video_ids(playlist_id: str, access_token: Optional[str] = None, limit: int = 1000) -> List[str]:
+    video_ids = []
+    page_token = None
+    while len(video_ids) < limit:
         params = {
-            "part": "snippet",
-            "key": YOUTUBE_API_KEY,
-            "id": video_id
+            "part": "contentDetails",
+            "playlistId": playlist_id,
+            "maxResults": 50,
         }
-        response = requests.get(url, params)
-        response.raise_for_status()
-        data = response.json()
-        if not data.get("items"):
+        headers = None
+        if access_token:
+            headers = {"Authorization": f"Bearer {access_token}"}
+        else:
+            params["key"] = YOUTUBE_API_KEY
+        if page_token:
+            params["pageToken"] = page_token
+        data = await youtube_api_get("playlistItems", params, headers=headers)
+        for item in data.get("items", []):
+            if video_id := item.get("contentDetails", {}).get("videoId"):
+                video_ids.append(video_id)
+        page_token = data.get("nextPageToken")
+        if not page_token:
+            break
+    return video_ids[:limit]
+
+
+#seed video's snippet (channelId, tags), cached since it doesn't change between plays
+async def get_video_snippet(video_id: str) -> dict:
+    params = {
+        "part": "snippet",
+        "key": YOUTUBE_API_KEY,
+        "id": video_id
+    }
+
+    async def fetch():
+        data = await youtube_api_get("videos", params)
+        items = data.get("items")
+        return items[0].get("snippet", {}) if items else {}
+
+    return await response_cache.get_or_fetch("video_snippet", params, fetch)
+
+
+#function for returning similar videos to one being played
+#seeds the local graph knows are answered from it, only cold seeds go to the api
+#channel and tag searches run concurrently under one deadline, a branch that misses it
+#is left out of the response but keeps running so its result lands in the response cache
+async def get_similar_videos(video_id: str) -> List[SearchResult]:
+    if recommendation_graph:
+        local = await recommendation_graph.recommend(video_id, RECOMMENDATION_COUNT)
+        if len(local) >= RECOMMENDATION_MIN_LOCAL:
+            recommendation_graph.local_hits += 1
+            return local
+        recommendation_graph.cold_seeds += 1
+    with prioritize(BACKGROUND):
+        return await find_similar_videos(video_id)
+
+
+async def find_similar_videos(video_id: str) -> List[SearchResult]:
+    try:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + RECOMMENDATION_TIMEOUT
+
+        snippet = await asyncio.wait_for(get_video_snippet(video_id), RECOMMENDATION_TIMEOUT)
+        if not snippet:
             return []
-        item = data["items"][0]
-        tags = item.get("tags", [])
+        tags = snippet.get("tags", [])
         filtered_tags = "|".join(tag.replace(" ", "+") for tag in tags[:3]) if tags else ""
-        channel_id = item["snippet"]["channelId"]
-        channel_results = get_channel_videos(channel_id)
-        tags_results = get_same_tags_videos(filtered_tags)
-        combined_results = channel_results + tags_results
+        channel_id = snippet["channelId"]
+
+        #every branch feeds the graph when it finishes, late ones included
+        async def related(search, weight: float) -> List[SearchResult]:
+            results = await search
+            if recommendation_graph and results:
+                recommendation_graph.add_related(video_id, snippet.get("channelTitle"), results, weight)
+            return results
+
+        branches = [asyncio.ensure_future(related(get_channel_videos(channel_id), CHANNEL_WEIGHT))]
+        if filtered_tags:
+            branches.append(asyncio.ensure_future(related(get_same_tags_videos(filtered_tags), TAG_WEIGHT)))
+        done, pending = await asyncio.wait(branches, timeout=max(0, deadline - loop.time()))
+        if pending:
+            logger.warning(f"Recommendation for {video_id} returned partial results after timeout")
+
+        combined_results = []
+        for branch in branches:
+            if branch in done and branch.result():
+                combined_results.extend(branch.result())
         recommend_result = {}
         for video in combined_results:
             vid_id = getattr(video, "video_id", None) or getattr(video, "id", None)
@@ -193,9 +368,8 @@ def get_similar_videos(video_id: str) -> List[SearchResult]:
         logger.error(f"Recommendation error {str(e)}")
 
 
-def get_trending_music() -> List[SearchResult]:
+async def get_trending_music() -> List[SearchResult]:
     try:
-        url = "https://www.googleapis.com/youtube/v3/videos"
         params = {
             "part": "snippet",
             "type": "video",
@@ -207,19 +381,20 @@ def get_trending_music() -> List[SearchResult]:
             "maxResults": "10",
             "key": YOUTUBE_API_KEY
         }
-        response = requests.get(url, params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        
-        return list_videos(data)
+
+        async def fetch():
+            data = await youtube_api_get("videos", params)
+            return await list_videos(data)
+
+        with prioritize(BACKGROUND):
+            return await response_cache.get_or_fetch("trending", params, fetch)
 
     except Exception as e:
         logger.error(f"Recommendation error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Trending music error: {str(e)}")
 
-def get_most_viewed_music() -> List[SearchResult]:
+async def get_most_viewed_music() -> List[SearchResult]:
     try:
-        url = "https://www.googleapis.com/youtube/v3/search"
         params = {
             "part": "snippet",
             "type": "video",
@@ -231,10 +406,13 @@ def get_most_viewed_music() -> List[SearchResult]:
             "regionCode": "US",
             "key": YOUTUBE_API_KEY
         }
-        response = requests.get(url, params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        return list_videos(data)
+
+        async def fetch():
+            data = await youtube_api_get("search", params)
+            return await list_videos(data)
+
+        with prioritize(BACKGROUND):
+            return await response_cache.get_or_fetch("most_viewed", params, fetch)
     
     except Exception as e:
         logger.error(f"Most Viewed music error {str(e)}")
@@ -0,0 +1,39 @@
+import hashlib
+import os
+import time
+
+#plugged in with SANBEATS_EXTRACTOR=fake_extractor:extract_info in place of YoutubeDL.extract_info
+#milliseconds spent waiting (youtube round trips) and burning cpu (yt-dlp's parsing) per call
+FAKE_EXTRACTOR_LATENCY = float(os.getenv("FAKE_EXTRACTOR_LATENCY", 600))
+FAKE_EXTRACTOR_CPU = float(os.getenv("FAKE_EXTRACTOR_CPU", 50))
+#seconds the fake stream urls stay valid, like googlevideo's expire= parameter
+FAKE_URL_LIFETIME = 6*3600
+
+
+def burn_cpu(milliseconds: float):
+    end = time.perf_counter() + milliseconds / 1000
+    digest = b""
+    while time.perf_counter() < end:
+        digest = hashlib.sha256(digest).digest()
+
+
+def extract_info(url: str) -> dict:
+    video_id = url.rstrip("/").rsplit("/", 1)[-1]
+    time.sleep(FAKE_EXTRACTOR_LATENCY / 1000)
+    burn_cpu(FAKE_EXTRACTOR_CPU)
+
+    expire = int(time.time()) + FAKE_URL_LIFETIME
+    base_url = f"https://rr1---sn-bench.googlevideo.com/videoplayback?id={video_id}&expire={expire}"
+    return {
+        "id": video_id,
+        "title": f"Benchmark track {video_id}",
+        "thumbnail": f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg",
+        "channel": "Benchmark Channel",
+        "duration": 180 + int(hashlib.sha1(video_id.encode()).hexdigest(), 16) % 120,
+        "formats": [
+            {"format_id": "139", "ext": "m4a", "protocol": "https", "abr": 48, "url": f"{base_url}&itag=139"},
+            {"format_id": "140", "ext": "m4a", "protocol": "https", "abr": 129, "url": f"{base_url}&itag=140"},
+            {"format_id": "251", "ext": "webm", "protocol": "https", "abr": 135, "url": f"{base_url}&itag=251"},
+            {"format_id": "234", "ext": "mp4", "protocol": "m3u8_native", "abr": 192, "url": f"{base_url}&itag=234.m3u8"},
+        ],
+    }
@@ -0,0 +1,101 @@
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import random
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+#local stand-in for www.googleapis.com, replays the recorded responses in fixtures/
+#with the ids rewritten so every query and seed gets its own set of videos
+FIXTURES_DIR = os.getenv("FAKE_GOOGLE_FIXTURES", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures"))
+#milliseconds added to every response, plus up to FAKE_GOOGLE_JITTER more
+FAKE_GOOGLE_LATENCY = float(os.getenv("FAKE_GOOGLE_LATENCY", 80))
+FAKE_GOOGLE_JITTER = float(os.getenv("FAKE_GOOGLE_JITTER", 40))
+
+
+def load_fixture(name: str) -> dict:
+    with open(os.path.join(FIXTURES_DIR, f"{name}.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+fixtures = {name: load_fixture(name) for name in ("search", "videos", "playlists")}
+
+app = FastAPI(title="Fake Google API")
+
+
+#same input always gives the same ids so response caches behave like they do against youtube
+def make_video_id(seed: str, index: int) -> str:
+    return "b" + hashlib.sha1(f"{seed}:{index}".encode()).hexdigest()[:10]
+
+
+def recorded_video(index: int) -> dict:
+    items = fixtures["videos"]["items"]
+    return copy.deepcopy(items[index % len(items)])
+
+
+async def simulate_latency():
+    await asyncio.sleep((FAKE_GOOGLE_LATENCY + random.uniform(0, FAKE_GOOGLE_JITTER)) / 1000)
+
+
+def list_response(kind: str, items: list) -> dict:
+    return {
+        "kind": kind,
+        "etag": hashlib.sha1(json.dumps(items, sort_keys=True).encode()).hexdigest(),
+        "pageInfo": {"totalResults": len(items), "resultsPerPage": len(items)},
+        "items": items,
+    }
+
+
+@app.get("/youtube/v3/search")
+async def search(request: Request):
+    await simulate_latency()
+    params = request.query_params
+    seed = params.get("q") or params.get("channelId") or ""
+    max_results = int(params.get("maxResults", 25))
+    items = copy.deepcopy(fixtures["search"]["items"])[:max_results]
+    for index, item in enumerate(items):
+        item["id"]["videoId"] = make_video_id(seed, index)
+        if params.get("channelId"):
+            item["snippet"]["channelId"] = params["channelId"]
+    return list_response("youtube#searchListResponse", items)
+
+
+@app.get("/youtube/v3/videos")
+async def videos(request: Request):
+    await simulate_latency()
+    params = request.query_params
+    if params.get("myRating") or params.get("chart"):
+        items = copy.deepcopy(fixtures["videos"]["items"])[:int(params.get("maxResults", 50))]
+        return list_response("youtube#videoListResponse", items)
+
+    items = []
+    for video_id in params.get("id", "").split(","):
+        if not video_id:
+            continue
+        #pick the recorded video from the id so a track keeps its duration and tags
+        item = recorded_video(int(hashlib.sha1(video_id.encode()).hexdigest(), 16))
+        item["id"] = video_id
+        items.append(item)
+    return list_response("youtube#videoListResponse", items)
+
+
+@app.get("/youtube/v3/playlists")
+async def playlists():
+    await simulate_latency()
+    return fixtures["playlists"]
+
+
+@app.get("/oauth2/v1/userinfo")
+async def userinfo(request: Request):
+    await simulate_latency()
+    token = request.headers.get("authorization", "")
+    return {"id": hashlib.sha1(token.encode()).hexdigest()[:21], "name": "Bench User"}
+
+
+@app.post("/youtube/v3/playlistItems")
+async def insert_playlist_item():
+    await simulate_latency()
+    return JSONResponse({"kind": "youtube#playlistItem"})
@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Optional
+
+import httpx
+
+#runs the api against fake_google.py and fake_extractor.py, so no network or api key is needed,
+#and prints throughput and latency percentiles per endpoint as json
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "app")
+
+QUERIES = ["lofi", "synthwave", "piano covers", "workout mix", "jazz", "taylor swift", "k-pop", "ambient",
+           "rock classics", "indie folk", "drum and bass", "reggaeton", "90s hits", "acoustic", "edm"]
+
+#quota limits would turn a load test into a rate limit test
+BENCH_ENV = {
+    "YOUTUBE_API_KEY": "benchmark",
+    "SANBEATS_EXTRACTOR": "fake_extractor:extract_info",
+    "QUOTA_DAILY_BUDGET": "1000000000",
+    "QUOTA_RATE_SEARCH": "1000000",
+    "QUOTA_BURST_SEARCH": "1000000",
+    "QUOTA_RATE_READ": "1000000",
+    "QUOTA_BURST_READ": "1000000",
+}
+
+
+#each scenario turns the request number into a path, keys repeat so caches see realistic reuse
+def make_scenarios(distinct: int) -> dict[str, Callable[[int], str]]:
+    return {
+        "search": lambda i: f"/api/search?q={QUERIES[i % min(distinct, len(QUERIES))]}",
+        "info": lambda i: f"/api/info/bench{i % distinct:06d}",
+        "recommendation": lambda i: f"/api/recommendation/bench{i % distinct:06d}",
+        "trending": lambda i: "/api/trending",
+    }
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def start_server(app: str, port: int, cwd: str, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=cwd,
+        env=env,
+        #stdout is kept for the json, server logs still go to stderr
+        stdout=subprocess.DEVNULL,
+        #own process group so extraction workers are stopped along with the server
+        start_new_session=os.name == "posix",
+    )
+
+
+def stop_server(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    if os.name == "posix":
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server for {url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server for {url} did not start within {timeout}s")
+
+
+#nearest-rank percentile of an already sorted list
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+async def run_scenario(base_url: str, make_path: Callable[[int], str], requests: int, concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    next_request = 0
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal next_request, errors
+        while next_request < requests:
+            path = make_path(next_request)
+            next_request += 1
+            started = time.perf_counter()
+            try:
+                response = await client.get(path)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "mean": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+            "max": round(latencies[-1], 2) if latencies else 0.0,
+        },
+    }
+
+
+#relative change against an earlier run, negative latency and positive throughput are improvements
+def compare(results: dict, baseline: dict) -> dict:
+    changes = {}
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        change = {}
+        if previous["throughput"]:
+            change["throughput"] = round(current["throughput"] / previous["throughput"] - 1, 4)
+        for key, value in current["latency_ms"].items():
+            if previous["latency_ms"].get(key):
+                change[f"latency_{key}"] = round(value / previous["latency_ms"][key] - 1, 4)
+        changes[name] = change
+    return {"commit": baseline.get("commit"), "change": changes}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test for the SanBeats API")
+    parser.add_argument("--scenarios", default="search,info,recommendation,trending",
+                        help="comma separated, from search, info, recommendation, trending")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--distinct", type=int, default=50, help="distinct queries or video ids per scenario")
+    parser.add_argument("--google-latency", type=float, default=80, help="ms the fake google api waits per call")
+    parser.add_argument("--extractor-latency", type=float, default=600, help="ms the fake extractor waits per call")
+    parser.add_argument("--extractor-cpu", type=float, default=50, help="ms of cpu the fake extractor burns per call")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the api, e.g. --env EXTRACTION_POOL_ENABLED=0")
+    parser.add_argument("--output", help="write the json here instead of stdout")
+    parser.add_argument("--baseline", help="json of an earlier run to compare against")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    scenarios = make_scenarios(args.distinct)
+    selected = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in selected if name not in scenarios]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)}")
+
+    google_port = get_free_port()
+    app_port = get_free_port()
+    data_dir = tempfile.mkdtemp(prefix="sanbeats-bench-")
+
+    google_env = dict(os.environ, FAKE_GOOGLE_LATENCY=str(args.google_latency))
+    app_env = dict(os.environ, **BENCH_ENV)
+    app_env.update({
+        "GOOGLE_API_BASE_URL": f"http://127.0.0.1:{google_port}",
+        "SANBEATS_DATA_DIR": data_dir,
+        "FAKE_EXTRACTOR_LATENCY": str(args.extractor_latency),
+        "FAKE_EXTRACTOR_CPU": str(args.extractor_cpu),
+        "PYTHONPATH": os.pathsep.join(filter(None, [BENCH_DIR, os.environ.get("PYTHONPATH")])),
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        app_env[key] = value
+
+    processes = []
+    try:
+        processes.append(start_server("fake_google:app", google_port, BENCH_DIR, google_env))
+        wait_until_ready(f"http://127.0.0.1:{google_port}/youtube/v3/playlists", processes[-1])
+        processes.append(start_server("main:app", app_port, APP_DIR, app_env))
+        wait_until_ready(f"http://127.0.0.1:{app_port}/", processes[-1])
+
+        results = {
+            "commit": get_commit(),
+            "timestamp": int(time.time()),
+            "config": {
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "distinct": args.distinct,
+                "google_latency_ms": args.google_latency,
+                "extractor_latency_ms": args.extractor_latency,
+                "extractor_cpu_ms": args.extractor_cpu,
+                "env": args.env,
+            },
+            "scenarios": {},
+        }
+        for name in selected:
+            print(f"Running {name}...", file=sys.stderr)
+            results["scenarios"][name] = asyncio.run(
+                run_scenario(f"http://127.0.0.1:{app_port}", scenarios[name], args.requests, args.concurrency)
+            )
+    finally:
+        for process in reversed(processes):
+            stop_server(process)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            results["baseline"] = compare(results, json.load(f))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
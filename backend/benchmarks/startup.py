@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from run import APP_DIR, BENCH_DIR, BENCH_ENV, get_commit, get_free_port, start_server, stop_server, wait_until_ready
+
+#import time of main.py and time to the first responses of a fresh server, as json
+#exits with 1 when a budget is exceeded or a module that should load lazily was imported, for ci
+
+
+#python -X importtime lines look like "import time:  self [us] | cumulative | imported package"
+def parse_importtime(output: str) -> list[dict]:
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        try:
+            _, self_us, cumulative_us, name = [part.strip() for part in line.replace("import time:", "|", 1).split("|")]
+            modules.append({"module": name, "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+        except ValueError:
+            continue
+    return modules
+
+
+def measure_imports(env: dict, top: int) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=APP_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import main failed:\n{result.stderr}")
+    modules = parse_importtime(result.stderr)
+    total = next((module["cumulative_ms"] for module in modules if module["module"] == "main"), 0.0)
+    slowest = sorted(modules, key=lambda module: module["self_ms"], reverse=True)[:top]
+    return {
+        "total_ms": round(total, 1),
+        "modules": len(modules),
+        "imported": {module["module"] for module in modules},
+        "slowest": [{key: round(value, 1) if isinstance(value, float) else value for key, value in module.items()} for module in slowest],
+    }
+
+
+#poll tightly, wait_until_ready's interval is too coarse to time a startup
+def time_first_response(client: httpx.Client, url: str, started: float, timeout: float = 60) -> float:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if client.get(url, timeout=timeout).status_code == 200:
+                return round((time.perf_counter() - started) * 1000, 1)
+        except httpx.TransportError:
+            time.sleep(0.01)
+    raise RuntimeError(f"{url} did not answer within {timeout}s")
+
+
+def measure_first_responses(env: dict, google_latency: float) -> dict:
+    google_port = get_free_port()
+    app_port = get_free_port()
+    google_env = dict(os.environ, FAKE_GOOGLE_LATENCY=str(google_latency))
+    app_env = dict(env, GOOGLE_API_BASE_URL=f"http://127.0.0.1:{google_port}")
+
+    processes = []
+    try:
+        processes.append(start_server("fake_google:app", google_port, BENCH_DIR, google_env))
+        wait_until_ready(f"http://127.0.0.1:{google_port}/youtube/v3/playlists", processes[-1])
+
+        started = time.perf_counter()
+        processes.append(start_server("main:app", app_port, APP_DIR, app_env))
+        with httpx.Client(base_url=f"http://127.0.0.1:{app_port}") as client:
+            root = time_first_response(client, "/", started)
+            trending = time_first_response(client, "/api/trending", started)
+        return {"root_ms": root, "trending_ms": trending}
+    finally:
+        for process in reversed(processes):
+            stop_server(process)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Startup time report for the SanBeats API")
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    parser.add_argument("--google-latency", type=float, default=80, help="ms the fake google api waits per call")
+    parser.add_argument("--forbid", action="append", default=["yt_dlp"],
+                        help="module that must not be imported at startup, can be repeated")
+    parser.add_argument("--max-import-ms", type=float, help="fail when importing main takes longer")
+    parser.add_argument("--max-first-response-ms", type=float, help="fail when / or /api/trending answer later")
+    parser.add_argument("--output", help="write the json here instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    data_dir = tempfile.mkdtemp(prefix="sanbeats-startup-")
+    env = dict(os.environ, **BENCH_ENV)
+    env.update({
+        "SANBEATS_DATA_DIR": data_dir,
+        "PYTHONPATH": os.pathsep.join(filter(None, [BENCH_DIR, os.environ.get("PYTHONPATH")])),
+    })
+
+    imports = measure_imports(env, args.top)
+    imported = imports.pop("imported")
+    report = {
+        "commit": get_commit(),
+        "timestamp": int(time.time()),
+        "imports": imports,
+        "first_response": measure_first_responses(env, args.google_latency),
+        "failures": [],
+    }
+
+    for module in args.forbid:
+        if module in imported:
+            report["failures"].append(f"{module} is imported at startup")
+    if args.max_import_ms is not None and imports["total_ms"] > args.max_import_ms:
+        report["failures"].append(f"import main took {imports['total_ms']}ms, budget {args.max_import_ms}ms")
+    if args.max_first_response_ms is not None:
+        for name, value in report["first_response"].items():
+            if value > args.max_first_response_ms:
+                report["failures"].append(f"{name} was {value}ms, budget {args.max_first_response_ms}ms")
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if report["failures"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
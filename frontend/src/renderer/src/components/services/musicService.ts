@@ -1,5 +1,5 @@
 import axios from 'axios'
-import { baseUrl, recommendedMusic, audioInfoResults } from '../stores/Variables'
+import { baseUrl, clientId, recommendedMusic, audioInfoResults } from '../stores/Variables'
 import { push } from 'svelte-spa-router'
 import { clicked, currentTrackId } from '../stores/Variables'
 import { get } from 'svelte/store'
@@ -11,7 +11,9 @@ export const handlePlay = async (videoId: string): Promise<void> => {
   currentTrackId.set(videoId)
 
   try {
-    const response = await axios.get(`${baseUrl}/info/${videoId}`)
+    const response = await axios.get(`${baseUrl}/info/${videoId}`, {
+      params: { client_id: clientId }
+    })
     audioInfoResults.set(response?.data)
     await getRecommendation(videoId)
     push('/play') // Navigate to player page
@@ -4,6 +4,11 @@ import type { searchResultInterface, audioInfo } from '../interface/Interface'
 export const clicked = writable(false)
 export const currentTrackId = writable<string | null>(null)
 export const baseUrl = 'http://localhost:8000/api'
+
+// Stable per-install id so the backend keeps this player's listening session apart from others
+const storedClientId = localStorage.getItem('clientId') ?? crypto.randomUUID()
+localStorage.setItem('clientId', storedClientId)
+export const clientId = storedClientId
 export const searchResults = writable<searchResultInterface[]>([])
 export const audioInfoResults = writable<audioInfo>()
 export const trendingMusic = writable<searchResultInterface[]>([])